@@ -1,8 +1,17 @@
 import connexion
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP, AbstractResponseBodyValidator
+from flask import Response, request
 import json
-from pykafka import KafkaClient
+import envelope
+import metrics
+from indexer import Indexer, OffsetIndex
+from segments import SegmentStore
+from live import Broadcaster, StreamMiddleware
+import server
+from datetime import datetime, timezone
 import logging
-import logging.config
+import logging_setup
 import yaml
 import os
 from connexion.middleware import MiddlewarePosition
@@ -18,83 +27,183 @@ with open(app_conf_file, 'r') as f:
 KAFKA_HOST = app_config['events']['hostname']
 KAFKA_PORT = app_config['events']['port']
 KAFKA_TOPIC = app_config['events']['topic']
+INDEX_CONFIG = app_config.get('index', {})
+MAX_SCAN = INDEX_CONFIG.get('max_scan', 100000)
+NDJSON = "application/x-ndjson"
+SEGMENT_CONFIG = app_config.get('segments', {})
+HEARTBEAT_S = app_config.get('stream', {}).get('heartbeat_s', 15)
 
 log_conf_file = os.getenv("LOG_CONF_FILE", "/app/log_conf.yml")
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f)
 service_name = os.getenv("SERVICE_NAME", "default_service")
-log_file_path = f"logs/{service_name}.log"
-if "file" in log_config["handlers"]:
-    log_config["handlers"]["file"]["filename"] = log_file_path
-logging.config.dictConfig(log_config)
+logging_setup.configure(log_config, service_name)
 logger = logging.getLogger('basicLogger')
+# Once per event or request; sampled as configured in log_conf.yml
+event_logger = logging.getLogger(logging_setup.EVENT_LOGGER)
 
 logger.info(f"Logging initialized for service: {service_name}")
 
+# Opened when the app starts serving. Only the background role writes the
+# index and segments; processes in the api role open them read-only and
+# follow its checkpoints.
+offset_index = None
+segments = None
+indexer = None
+# Pushes the stats to dashboards at /analyzer/stats/stream
+stream = Broadcaster(HEARTBEAT_S)
+
+
+def get_event(event_type, index):
+    """Return the payload of the event of a type at an index.
+
+    Events are read from the local segments, and only fetched from Kafka
+    when they are older than the segments kept.
+    """
+    location = offset_index.get(event_type, index)
+    if location is None:
+        logger.warning(f"No {event_type} event found at index {index}")
+        return {"message": f"No message at index {index}!"}, 404
+    payload = segments.get(event_type, index)
+    if payload is not None:
+        return payload, 200
+    try:
+        value = indexer.fetch(*location)
+    except Exception as e:
+        logger.error(f"Fetching {event_type} event {index} at {location} failed ({e})")
+        return {"message": "Kafka is unavailable, retry later"}, 503
+    if value is None:
+        logger.warning(f"{event_type} event {index} at {location} is no longer on the topic")
+        return {"message": f"Message at index {index} has expired!"}, 404
+    return envelope.decode(value)['payload'], 200
 
 def get_temperature(index):
     index = int(index)  # Ensure index is an integer
-    logger.info(f"Fetching temperature event at index {index}")
-    client = KafkaClient(hosts=f'{KAFKA_HOST}:{KAFKA_PORT}')
-    topic = client.topics[str.encode(KAFKA_TOPIC)]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    counter = 0
-    for msg in consumer:
-        message = msg.value.decode("utf-8")
-        data = json.loads(message)
-        payload = data['payload']
-        event_type = data.get("type")
-        if event_type == 'temperature_condition':
-            if counter == index:
-                return payload, 200
-            counter += 1
-    logger.warning(f"No temperature event found at index {index}")
-    return {"message": f"No message at index {index}!"}, 404
+    event_logger.info("Fetching temperature event at index %d", index)
+    return get_event('temperature_condition', index)
 
 def get_traffic(index):
-    logger.info(f"Fetching traffic event at index {index}")
-    client = KafkaClient(hosts=f'{KAFKA_HOST}:{KAFKA_PORT}')
-    topic = client.topics[str.encode(KAFKA_TOPIC)]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    counter = 0
-    for msg in consumer:
-        message = msg.value.decode("utf-8")
-        data = json.loads(message)
-        payload = data["payload"]
-        logger.info(f"Payload: {payload}")
-        payload = data['payload']
-        event_type = data.get("type")
-        if event_type == 'traffic_condition':
-            if counter == index:
-                return payload, 200
-            counter += 1
-    logger.warning(f"No traffic event found at index {index}")
-    return { "message": f"No message at index {index}!"}, 404
+    index = int(index)
+    event_logger.info("Fetching traffic event at index %d", index)
+    return get_event('traffic_condition', index)
 
-def get_stats():
-    logger.info("Fetching statistics of events")
-    client = KafkaClient(hosts=f'{KAFKA_HOST}:{KAFKA_PORT}')
-    topic = client.topics[str.encode(KAFKA_TOPIC)]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+def load_events(event_type, matches):
+    """Yield the payloads of (ordinal, partition, offset) matches, in order.
+
+    Events are read from the local segments where they are kept; the rest
+    are fetched from Kafka, and skipped if they are no longer on the topic.
+    """
+    payloads = segments.get_many(event_type, [ordinal for ordinal, _, _ in matches])
+    fetched = indexer.fetch_many([(partition, offset) for payload, (_, partition, offset) in zip(payloads, matches)
+                                  if payload is None])
+    for payload in payloads:
+        if payload is None:
+            value = next(fetched)
+            if value is None:
+                continue
+            payload = envelope.decode(value)['payload']
+        yield payload
+
+def stream_events(event_type, matches):
+    """Yield events as NDJSON as the client reads."""
+    try:
+        for payload in load_events(event_type, matches):
+            yield json.dumps(payload) + "\n"
+    except Exception as e:
+        logger.error(f"Streaming events stopped early ({e})")
+
+def query_events(event_type, start, count, sensor_id, city_zone, start_timestamp, end_timestamp):
+    """Return up to `count` events of a type, from index `start` on, that match the filters.
+
+    While there may be more, the X-Next-Index header holds the start of the
+    next page. Sensor and zone filters use the secondary indexes, so only
+    matching events are read. Clients that accept application/x-ndjson
+    get the events streamed one per line.
+    """
+    matches, next_index = offset_index.find(event_type, start, count, sensor_id, city_zone,
+                                            start_timestamp, end_timestamp, MAX_SCAN)
+    event_logger.debug("Found %d %s events from index %d (next %s)", len(matches), event_type, start, next_index)
+    headers = {}
+    if next_index is not None:
+        headers["X-Next-Index"] = str(next_index)
+
+    if request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+        return Response(stream_events(event_type, matches), mimetype=NDJSON, headers=headers)
+
+    try:
+        events = list(load_events(event_type, matches))
+    except Exception as e:
+        logger.error(f"Fetching {len(matches)} {event_type} events failed ({e})")
+        return {"message": "Kafka is unavailable, retry later"}, 503, {"Content-Type": "application/json"}
+    headers["Content-Type"] = "application/json"
+    return events, 200, headers
+
+def get_temperature_events(start=0, count=100, sensorId=None, cityZone=None, start_timestamp=None,
+                           end_timestamp=None):
+    event_logger.info("Fetching %d temperature events from index %d", count, start)
+    return query_events('temperature_condition', start, count, sensorId, cityZone, start_timestamp, end_timestamp)
+
+def get_traffic_events(start=0, count=100, sensorId=None, start_timestamp=None, end_timestamp=None):
+    event_logger.info("Fetching %d traffic events from index %d", count, start)
+    return query_events('traffic_condition', start, count, sensorId, None, start_timestamp, end_timestamp)
+
+def current_stats():
+    """The event counts kept by the indexer, without touching Kafka."""
+    counts, zones, _ = offset_index.counts()
+    position = indexer.position()
     stats = {
-        "num_temperature": 0,
-        "num_traffic": 0
+        "num_temperature": counts["temperature_condition"],
+        "num_traffic": counts["traffic_condition"],
+        "temperature_by_zone": zones.get("temperature_condition", {}),
+        "lag": sum(partition["lag"] or 0 for partition in position),
+        "partitions": position,
     }
-    
-    for msg in consumer:
-        message = msg.value.decode("utf-8")
-        data = json.loads(message)
-        
-        event_type = data.get("type")
-        if event_type == "temperature_condition":
-            stats["num_temperature"] += 1
-        elif event_type == "traffic_condition":
-            stats["num_traffic"] += 1
-    
-    logger.info(f"Statistics: {stats}")
+    if indexer.checkpointed_at is not None:
+        stats["checkpointed_at"] = datetime.fromtimestamp(indexer.checkpointed_at, timezone.utc).isoformat()
+    return stats
+
+def publish_stats():
+    """Push the stats to the stream after each index checkpoint.
+
+    checkpointed_at is left out, so clients only hear about new events or a
+    change in lag.
+    """
+    stats = current_stats()
+    stats.pop("checkpointed_at", None)
+    stream.publish(stats)
+
+def get_stats():
+    event_logger.info("Fetching statistics of events")
+    stats = current_stats()
+    event_logger.debug("Statistics: %s", stats)
     return stats, 200
 
-app = connexion.FlaskApp(__name__, specification_dir='')
+def start_indexer():
+    """Open the index and segments, and start indexing the topic or following the index."""
+    global offset_index, segments, indexer
+    readonly = not server.runs_background()
+    offset_index = OffsetIndex(INDEX_CONFIG.get('directory', 'index'), list(envelope.EVENT_TYPES), readonly=readonly)
+    segments = SegmentStore(SEGMENT_CONFIG.get('directory', 'segments'),
+                            segment_records=SEGMENT_CONFIG.get('segment_records', 65536),
+                            max_bytes=SEGMENT_CONFIG.get('max_bytes'), readonly=readonly)
+    indexer = Indexer(f'{KAFKA_HOST}:{KAFKA_PORT}', KAFKA_TOPIC, offset_index,
+                      checkpoint_interval_ms=INDEX_CONFIG.get('checkpoint_interval_ms', 1000),
+                      segments=segments, on_checkpoint=publish_stats)
+    indexer.start()
+
+def stop_indexer():
+    """Stop the indexer, then close the segments before the index so its position is saved last."""
+    indexer.stop()
+    segments.close()
+    offset_index.close()
+
+class StreamedResponseValidator(AbstractResponseBodyValidator):
+    """Pass NDJSON responses through unvalidated so the stream is not buffered."""
+
+    def wrap_send(self, send):
+        return send
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=server.lifespan(start_indexer, stop_indexer))
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
         CORSMiddleware,
@@ -104,10 +213,14 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_methods=["*"],
         allow_headers=["*"],
     )
+app.add_middleware(StreamMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                   path="/analyzer/stats/stream", broadcaster=stream)
+app.add_middleware(metrics.MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/analyzer/metrics")
 app.add_api("AARONDIMA-Smart-City-App-1.0.0.yaml",
             strict_validation=True,
             base_path="/analyzer",
-            validate_responses=True)
+            validate_responses=True,
+            validator_map={"response": MediaTypeDict({**VALIDATOR_MAP["response"], NDJSON: StreamedResponseValidator})})
 
 if __name__ == "__main__":
     app.run(port=8110, host="0.0.0.0")
\ No newline at end of file
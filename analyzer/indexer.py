@@ -0,0 +1,499 @@
+"""Index of the events topic, kept up to date by a background consumer.
+
+The analyzer answers "the Nth event of type T" by looking up where that event
+is on the topic and fetching just that one message, instead of rescanning the
+topic from the start for every request. Each entry also holds the event's
+timestamp and codes for its sensor and city zone, and events are listed by
+sensor and by zone, so filtered range queries only fetch matching messages.
+
+The index is persisted to one file per event type of fixed-width records,
+plus a position file holding the number of valid records per type, the
+sensor and zone names the codes stand for, and the last offset consumed from
+each partition. The position file is replaced atomically after the record
+files are flushed, so on restart the record files are cut back to the counts
+it names and consumption resumes right after the offsets it names. The
+per-sensor and per-zone lists are rebuilt from the records.
+
+Other processes can open the index read-only and follow it: at every
+checkpoint of the writing process they read the records it added.
+"""
+import json
+import logging
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, Thread
+
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from pykafka.protocol import PartitionFetchRequest
+
+import envelope
+import metrics
+
+logger = logging.getLogger('basicLogger')
+consume_lag = metrics.CONSUME_LAG.labels("analyzer")
+fetch_latency = metrics.KAFKA_FETCH_LATENCY.labels("analyzer")
+
+# partition, offset, timestamp (microseconds since the epoch), sensor code, zone code
+RECORD = struct.Struct(">iqqii")
+RECORD_SUFFIX = ".idx"
+POSITION_FILE = "position.json"
+# Bumped whenever RECORD changes; an index in another format is rebuilt
+INDEX_VERSION = 2
+FETCH_MAX_BYTES = 1024 * 1024
+BACKFILL_BATCH = 1000
+NO_CODE = -1
+NO_TIMESTAMP = -2 ** 63
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+COLUMNS = (("partition", "i"), ("offset", "q"), ("timestamp", "q"), ("sensor", "i"), ("zone", "i"))
+KEYS = {"sensor": "sensorId", "zone": "cityZone"}
+
+
+def to_micros(value):
+    """Microseconds since the epoch of an ISO 8601 timestamp, or NO_TIMESTAMP."""
+    try:
+        timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return NO_TIMESTAMP
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - EPOCH) // _MICROSECOND
+
+
+class OffsetIndex:
+    """Topic position (partition, offset) of each event, by type and ordinal.
+
+    Ordinals count events of a type in the order the indexer consumed them.
+    Entries are held in parallel arrays (28 bytes per event), and the
+    ordinals of each sensor and zone in sorted arrays (8 bytes each).
+
+    A `readonly` index never writes its files; `refresh` catches up with
+    the last checkpoint of the process that does.
+    """
+
+    def __init__(self, directory, event_types, readonly=False):
+        self.directory = directory
+        self.readonly = readonly
+        self.lock = Lock()
+        self.event_types = event_types
+        self._clear()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.files = {} if readonly else {event_type: open(self._path(event_type), "ab") for event_type in event_types}
+
+    def _path(self, event_type):
+        return os.path.join(self.directory, event_type + RECORD_SUFFIX)
+
+    def _clear(self):
+        self.columns = {event_type: {name: array(code) for name, code in COLUMNS} for event_type in self.event_types}
+        self.names = {key: [] for key in KEYS}
+        self.codes = {key: {} for key in KEYS}
+        self.postings = {event_type: {key: {} for key in KEYS} for event_type in self.event_types}
+        self.consumed = {}
+
+    def _position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE), "r") as f:
+                position = json.load(f)
+        except FileNotFoundError:
+            position = None
+        if position is not None and position.get("version") != INDEX_VERSION:
+            if not self.readonly:
+                logger.warning(f"Index in {self.directory} has an old format, rebuilding it")
+            position = None
+        if position is None:
+            position = {"consumed": {}, "counts": {}, "names": {}}
+        return position
+
+    def _read(self, event_type, start, count):
+        """The records from ordinal `start` up to `count`, cutting off any after `count` unless read-only."""
+        try:
+            with open(self._path(event_type), "rb" if self.readonly else "r+b") as f:
+                f.seek(start * RECORD.size)
+                data = f.read((count - start) * RECORD.size)
+                if not self.readonly:
+                    # Records written after the last checkpoint are indexed again
+                    f.truncate(count * RECORD.size)
+        except FileNotFoundError:
+            data = b""
+        return data
+
+    def _apply(self, position, records):
+        self.consumed = {int(partition): offset for partition, offset in position["consumed"].items()}
+        for key in KEYS:
+            self.names[key] = position["names"].get(key, [])
+            self.codes[key] = {name: code for code, name in enumerate(self.names[key])}
+        for event_type, data in records.items():
+            for record in RECORD.iter_unpack(data):
+                self._append(event_type, record)
+
+    def _load(self):
+        position = self._position()
+        self._apply(position, {event_type: self._read(event_type, 0, position["counts"].get(event_type, 0))
+                               for event_type in self.columns})
+
+    def refresh(self):
+        """Read the records added since the last refresh, as of the writer's last checkpoint.
+
+        If the writer rebuilt the index, the whole index is read again.
+        """
+        position = self._position()
+        counts = {event_type: position["counts"].get(event_type, 0) for event_type in self.columns}
+        with self.lock:
+            known = {event_type: len(columns["offset"]) for event_type, columns in self.columns.items()}
+        rebuilt = any(counts[event_type] < known[event_type] for event_type in counts)
+        if rebuilt:
+            known = dict.fromkeys(known, 0)
+        if not rebuilt and counts == known and position["consumed"] == {str(partition): offset for partition, offset
+                                                                         in self.consumed.items()}:
+            return
+        records = {event_type: self._read(event_type, known[event_type], counts[event_type]) for event_type in counts}
+        with self.lock:
+            if rebuilt:
+                logger.info(f"Index in {self.directory} was rebuilt, reading it again")
+                self._clear()
+            self._apply(position, records)
+
+    def _append(self, event_type, record):
+        columns = self.columns[event_type]
+        ordinal = len(columns["offset"])
+        for (name, _), value in zip(COLUMNS, record):
+            columns[name].append(value)
+        for key in KEYS:
+            code = columns[key][ordinal]
+            if code != NO_CODE:
+                self.postings[event_type][key].setdefault(code, array("q")).append(ordinal)
+
+    def _code(self, key, name):
+        if name is None:
+            return NO_CODE
+        code = self.codes[key].get(name)
+        if code is None:
+            code = self.codes[key][name] = len(self.names[key])
+            self.names[key].append(name)
+        return code
+
+    def add(self, event_type, partition, offset, payload):
+        """Record that the next event of `event_type` is at (partition, offset)."""
+        with self.lock:
+            if event_type in self.columns:
+                record = (partition, offset, to_micros(payload.get("timestamp")),
+                          self._code("sensor", payload.get(KEYS["sensor"])),
+                          self._code("zone", payload.get(KEYS["zone"])))
+                self._append(event_type, record)
+                self.files[event_type].write(RECORD.pack(*record))
+            self.consumed[partition] = offset
+
+    def skip(self, partition, offset):
+        """Record that the message at (partition, offset) was consumed without indexing it."""
+        with self.lock:
+            self.consumed[partition] = offset
+
+    def get(self, event_type, index):
+        """Return the (partition, offset) of an event, or None if there is no such event."""
+        with self.lock:
+            columns = self.columns[event_type]
+            if 0 <= index < len(columns["offset"]):
+                return columns["partition"][index], columns["offset"][index]
+        return None
+
+    def find(self, event_type, start, count, sensor=None, zone=None, start_time=None, end_time=None,
+             max_scan=None):
+        """Find up to `count` events at or after ordinal `start` that match the filters.
+
+        Returns a list of (ordinal, partition, offset) and the ordinal to
+        continue from, which is None once there can be no more matches. With
+        a sensor or zone filter only that sensor's or zone's events are
+        looked at; at most `max_scan` entries are looked at per call.
+        """
+        wanted = {}
+        with self.lock:
+            columns = self.columns[event_type]
+            total = len(columns["offset"])
+            candidates = None
+            for key, name in (("sensor", sensor), ("zone", zone)):
+                if name is None:
+                    continue
+                code = self.codes[key].get(name)
+                postings = self.postings[event_type][key].get(code)
+                if postings is None:
+                    return [], None
+                wanted[key] = code
+                if candidates is None or len(postings) < len(candidates):
+                    candidates = postings
+            # Arrays are only ever appended to, so the first `size` entries
+            # can be read without holding the lock
+            size = len(candidates) if candidates is not None else total
+        low = to_micros(start_time) if start_time else None
+        high = to_micros(end_time) if end_time else None
+
+        if candidates is not None:
+            position = bisect_left(candidates, start, 0, size)
+            ordinals = (candidates[i] for i in range(position, size))
+        else:
+            ordinals = iter(range(start, size))
+        matches = []
+        scanned = 0
+        for ordinal in ordinals:
+            if len(matches) == count or (max_scan is not None and scanned == max_scan):
+                return matches, ordinal
+            scanned += 1
+            if any(columns[key][ordinal] != code for key, code in wanted.items()):
+                continue
+            timestamp = columns["timestamp"][ordinal]
+            if (low is not None and timestamp < low) or (high is not None and timestamp >= high):
+                continue
+            matches.append((ordinal, columns["partition"][ordinal], columns["offset"][ordinal]))
+        return matches, None
+
+    def count(self, event_type):
+        with self.lock:
+            return len(self.columns[event_type]["offset"])
+
+    def counts(self):
+        """Events indexed per type, per type and city zone, and the last offset consumed per partition."""
+        with self.lock:
+            counts = {event_type: len(columns["offset"]) for event_type, columns in self.columns.items()}
+            zones = {event_type: {self.names["zone"][code]: len(ordinals)
+                                  for code, ordinals in self.postings[event_type]["zone"].items()}
+                     for event_type in self.columns}
+            return counts, {event_type: by_zone for event_type, by_zone in zones.items() if by_zone}, dict(self.consumed)
+
+    def checkpoint(self):
+        """Make everything added so far durable."""
+        if self.readonly:
+            return
+        with self.lock:
+            for f in self.files.values():
+                f.flush()
+                os.fsync(f.fileno())
+            position = {
+                "version": INDEX_VERSION,
+                "consumed": dict(self.consumed),
+                "counts": {event_type: len(columns["offset"]) for event_type, columns in self.columns.items()},
+                "names": {key: list(names) for key, names in self.names.items()},
+            }
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(position, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        self.checkpoint()
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+
+
+class Indexer:
+    """Tails the events topic into an OffsetIndex and fetches indexed messages.
+
+    With a SegmentStore, every indexed event is also copied into it.
+    `on_checkpoint` is called after every checkpoint.
+
+    Over a read-only index (and segments) the indexer does not consume the
+    topic; it refreshes them every checkpoint interval instead, and
+    connects to Kafka only to fetch messages and report lag.
+    """
+
+    def __init__(self, hosts, topic_name, index, checkpoint_interval_ms=1000, segments=None, on_checkpoint=None):
+        self.hosts = hosts
+        self.topic_name = topic_name
+        self.index = index
+        self.segments = segments
+        self.on_checkpoint = on_checkpoint
+        if segments is not None and not index.readonly:
+            for event_type in segments.layouts:
+                segments.truncate(event_type, index.count(event_type))
+        self.checkpoint_interval = checkpoint_interval_ms / 1000
+        self.topic = None
+        self.latest = {}
+        self.checkpointed_at = None
+        self.stopping = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.follow if self.index.readonly else self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop consuming, after checkpointing what has been indexed."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def connect(self):
+        """Connect to Kafka, retrying with backoff until the broker is reachable or the indexer is stopped."""
+        delay = 1
+        while not self.stopping.is_set():
+            try:
+                client = KafkaClient(hosts=self.hosts)
+                return client.topics[str.encode(self.topic_name)]
+            except Exception as e:
+                logger.warning(f"Kafka is not available ({e}), retrying in {delay}s")
+                self.stopping.wait(delay)
+                delay = min(delay * 2, 30)
+        return None
+
+    def run(self):
+        topic = self.connect()
+        if topic is None:
+            return
+        consumer = topic.get_simple_consumer(reset_offset_on_start=True,
+                                             auto_offset_reset=OffsetType.EARLIEST,
+                                             consumer_timeout_ms=int(self.checkpoint_interval * 1000))
+        resume = [(consumer.partitions[partition], offset) for partition, offset in self.index.consumed.items()
+                  if partition in consumer.partitions]
+        if resume:
+            consumer.reset_offsets(resume)
+        self.topic = topic
+        if self.segments is not None:
+            self.backfill()
+        logger.info(f"Indexing {self.topic_name} from {dict(self.index.consumed) or 'the beginning'}")
+
+        next_checkpoint = time.monotonic() + self.checkpoint_interval
+        while not self.stopping.is_set():
+            msg = consumer.consume(block=True)
+            if msg is not None:
+                try:
+                    event = envelope.decode(msg.value)
+                except envelope.MalformedEnvelope as e:
+                    logger.error(f"Skipped the message at partition {msg.partition_id} offset {msg.offset} ({e})")
+                    self.index.skip(msg.partition_id, msg.offset)
+                    continue
+                metrics.observe_consumed(consume_lag, event["datetime"])
+                self.index.add(event["type"], msg.partition_id, msg.offset, event["payload"])
+                if self.segments is not None and event["type"] in self.segments.layouts:
+                    self.segments.append(event["type"], event["payload"])
+            if time.monotonic() >= next_checkpoint:
+                if self.segments is not None:
+                    self.segments.flush()
+                self.index.checkpoint()
+                self.checkpointed_at = time.time()
+                self.update_latest(topic)
+                if self.on_checkpoint is not None:
+                    self.on_checkpoint()
+                next_checkpoint = time.monotonic() + self.checkpoint_interval
+        if self.segments is not None:
+            self.segments.flush()
+        self.index.checkpoint()
+        consumer.stop()
+        logger.info(f"Stopped indexing {self.topic_name} at {dict(self.index.consumed)}")
+
+    def follow(self):
+        """Keep a read-only index and segments up to date with the checkpoints of the indexing process."""
+        logger.info(f"Following the index in {self.index.directory}")
+        while True:
+            try:
+                self.index.refresh()
+                if self.segments is not None:
+                    self.segments.refresh()
+                self.checkpointed_at = os.path.getmtime(os.path.join(self.index.directory, POSITION_FILE))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Could not refresh the index ({e})")
+            # Kafka is only needed for events older than the segments and for the lag
+            if self.topic is None:
+                try:
+                    self.topic = KafkaClient(hosts=self.hosts).topics[str.encode(self.topic_name)]
+                except Exception as e:
+                    logger.warning(f"Kafka is not available ({e})")
+            if self.topic is not None:
+                self.update_latest(self.topic)
+            if self.on_checkpoint is not None:
+                self.on_checkpoint()
+            if self.stopping.wait(self.checkpoint_interval):
+                return
+
+    def backfill(self):
+        """Copy the events indexed before the segments existed into them, fetching them from Kafka.
+
+        Events no longer on the topic are stored as missing, to keep the
+        segments aligned with the index.
+        """
+        for event_type in self.segments.layouts:
+            start = self.segments.count(event_type)
+            total = self.index.count(event_type)
+            if start < total:
+                logger.info(f"Copying {event_type} events {start}-{total - 1} from Kafka into the segments")
+            while start < total:
+                matches, _ = self.index.find(event_type, start, BACKFILL_BATCH)
+                try:
+                    values = list(self.fetch_many([(partition, offset) for _, partition, offset in matches]))
+                except Exception as e:
+                    logger.warning(f"Copying {event_type} events from {start} failed ({e}), retrying in 1s")
+                    if self.stopping.wait(1):
+                        return
+                    continue
+                for value in values:
+                    self.segments.append(event_type, envelope.decode(value)["payload"] if value is not None else None)
+                start += len(matches)
+            self.segments.flush()
+
+    def update_latest(self, topic):
+        """Refresh the offset after the newest message of each partition, to report lag."""
+        try:
+            self.latest = {partition: response.offset[0]
+                           for partition, response in topic.latest_available_offsets().items()}
+        except Exception as e:
+            logger.warning(f"Could not fetch the latest offsets of {self.topic_name} ({e})")
+            return
+        for partition in self.position():
+            if partition["lag"] is not None:
+                metrics.CONSUMER_LAG.labels("analyzer", str(partition["partition"])).set(partition["lag"])
+
+    def position(self):
+        """How far the indexer has read into each partition, and how far behind it is."""
+        _, _, consumed = self.index.counts()
+        partitions = []
+        for partition in sorted(set(consumed) | set(self.latest)):
+            offset = consumed.get(partition, -1)
+            latest = self.latest.get(partition)
+            partitions.append({
+                "partition": partition,
+                "offset": offset,
+                "latest": latest,
+                "lag": max(0, latest - offset - 1) if latest is not None else None,
+            })
+        return partitions
+
+    def fetch_batch(self, partition, offset):
+        """Fetch the messages from an offset with a single request to the partition leader.
+
+        Returns {offset: value}. A fetch returns whole (possibly compressed)
+        batches, so this can include messages before the requested offset.
+        """
+        if self.topic is None:
+            raise RuntimeError("Kafka is not connected yet")
+        leader = self.topic.partitions[partition].leader
+        started = time.perf_counter()
+        response = leader.fetch_messages([PartitionFetchRequest(self.topic.name, partition, offset, FETCH_MAX_BYTES)],
+                                         timeout=1000)
+        fetch_latency.observe(time.perf_counter() - started)
+        return {message.offset: message.value for message in response.topics[self.topic.name][partition].messages}
+
+    def fetch(self, partition, offset):
+        """Fetch the value of one message. Returns None if it is no longer on the topic."""
+        return self.fetch_batch(partition, offset).get(offset)
+
+    def fetch_many(self, locations):
+        """Yield the value (or None) of each (partition, offset), in order.
+
+        Messages that came back with an earlier fetch are not fetched again,
+        so nearby events cost one request per batch rather than per event.
+        """
+        fetched = {}
+        for partition, offset in locations:
+            batch = fetched.get(partition)
+            if batch is None or offset not in batch:
+                batch = fetched[partition] = self.fetch_batch(partition, offset)
+            yield batch.get(offset)
@@ -0,0 +1,134 @@
+"""Server-Sent Events stream of a service's stats, for the dashboard.
+
+A Broadcaster holds the latest stats published by the service. Every client
+of the stream first gets them whole as a `stats` event, then a `delta` event
+each time they change, holding a JSON merge patch (RFC 7386) from the
+previous stats to the new ones, and a comment line as a heartbeat when
+nothing has changed for a while. Events are serialized once when published,
+and clients wait on the event loop without polling or holding a thread, so
+the cost of publishing does not grow with the number of open dashboards.
+
+Event ids are `<boot>-<version>`. A client that reconnects with the id of
+the current stats (Last-Event-ID) is not sent them again; one that missed
+any change gets the whole stats again.
+
+StreamMiddleware serves the stream at a fixed path, ahead of the connexion
+routes, because a long-lived response does not fit the request/response
+cycle of a spec operation.
+
+This module is shared by the processing and analyzer services; keep the
+copies identical.
+"""
+import asyncio
+import json
+import uuid
+from threading import Lock
+
+
+def merge_patch(old, new):
+    """JSON merge patch turning `old` into `new`; removed keys are set to null."""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    patch = {key: None for key in old if key not in new}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif old[key] != value:
+            patch[key] = merge_patch(old[key], value)
+    return patch
+
+
+def sse(event, data, event_id):
+    return f"event: {event}\nid: {event_id}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class Broadcaster:
+    """The latest stats of a service, and the clients waiting for them to change."""
+
+    def __init__(self, heartbeat_s=15):
+        self.heartbeat_s = heartbeat_s
+        self.boot = uuid.uuid4().hex[:8]
+        self.lock = Lock()
+        self.stats = None
+        self.version = 0
+        self.full = None
+        self.delta = None
+        self.waiters = set()
+
+    def publish(self, stats):
+        """Make `stats` the current stats, notifying clients if they changed. Safe from any thread."""
+        with self.lock:
+            if stats == self.stats:
+                return
+            event_id = f"{self.boot}-{self.version + 1}"
+            self.delta = sse("delta", merge_patch(self.stats, stats), event_id) if self.stats is not None else None
+            self.full = sse("stats", stats, event_id)
+            self.stats = stats
+            self.version += 1
+            waiters = list(self.waiters)
+        for loop, changed in waiters:
+            loop.call_soon_threadsafe(changed.set)
+
+    def current(self):
+        with self.lock:
+            return self.version, self.full, self.delta
+
+    async def serve(self, scope, receive, send):
+        """Stream the stats to one client until it disconnects."""
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            # Keep nginx from buffering the stream
+            (b"x-accel-buffering", b"no"),
+        ]})
+        headers = dict(scope["headers"])
+        last_id = headers.get(b"last-event-id", b"").decode()
+        sent = self.version if last_id == f"{self.boot}-{self.version}" else None
+
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        changed = waiter[1]
+        with self.lock:
+            self.waiters.add(waiter)
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            while not disconnected.done():
+                changed.clear()
+                version, full, delta = self.current()
+                if full is not None and version != sent:
+                    body = delta if sent is not None and version == sent + 1 and delta is not None else full
+                    sent = version
+                else:
+                    body = None
+                if body is not None:
+                    await send({"type": "http.response.body", "body": body, "more_body": True})
+                    continue
+                wait = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait({wait, disconnected}, timeout=self.heartbeat_s,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                wait.cancel()
+                if not done:
+                    await send({"type": "http.response.body", "body": b": heartbeat\n\n", "more_body": True})
+        finally:
+            disconnected.cancel()
+            with self.lock:
+                self.waiters.discard(waiter)
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+class StreamMiddleware:
+    """ASGI middleware answering GET `path` with the stream of a Broadcaster."""
+
+    def __init__(self, app, path, broadcaster):
+        self.app = app
+        self.path = path
+        self.broadcaster = broadcaster
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == self.path and scope["method"] == "GET":
+            await self.broadcaster.serve(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
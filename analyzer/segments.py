@@ -0,0 +1,425 @@
+"""Local copy of the events topic, in memory-mapped segment files.
+
+The analyzer keeps every event it indexes in append-only segments, one
+series per event type, so historical events are read from local disk instead
+of being fetched from Kafka and decoded again. A segment holds the events of
+consecutive ordinals (the same ordinals as the OffsetIndex) in three files:
+
+    <first ordinal>.rec  fixed-width records: field flags, flags of the
+                         numeric fields that are integers, then the numeric
+                         fields as 64 bit integers or doubles
+    <first ordinal>.off  for each record, the end of each string field in
+                         the heap (unsigned 32 bit); a field starts where the
+                         previous one ends
+    <first ordinal>.str  the string fields, UTF-8 encoded back to back
+
+The newest segment of each type is held in memory and appended to its files
+as events arrive. Once it has `segment_records` events it is sealed and from
+then on read through read-only memory maps, so lookups and scans copy only
+the fields they return. When the segments take more than `max_bytes`, the
+oldest sealed segments are deleted, and events before the oldest remaining
+segment are fetched from Kafka again.
+
+The fields listed in SCHEMAS get their own columns. Any other field of a
+payload, or a field whose value is not of its column's type, is kept in one
+more string field as JSON, so events read back exactly as they were
+decoded from the topic. Segments written in an older format are deleted
+when the store is opened, and the indexer copies the events back into them.
+
+Other processes can open the segments read-only, mapping every segment
+including the newest, and refresh the maps to see what has been added.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from threading import Lock
+
+logger = logging.getLogger('basicLogger')
+
+# For each event type: the numeric fields and the string fields
+SCHEMAS = {
+    "temperature_condition": (("temperature",), ("sensorId", "timestamp", "cityZone", "eventID", "trace_id")),
+    "traffic_condition": (("trafficDensity",), ("sensorId", "timestamp", "incidentReport", "eventID", "trace_id")),
+}
+# Set in the flags of every record of an event; records of events that were
+# no longer on the topic when the segments were built have no flags set
+STORED = 0x8000
+SUFFIXES = (".rec", ".off", ".str")
+END = struct.Struct(">I")
+DOUBLE = struct.Struct(">d")
+INTEGER = struct.Struct(">q")
+# Bumped whenever the record format changes
+FORMAT_VERSION = 2
+VERSION_FILE = "version"
+
+
+class Layout:
+    """The record and offsets table formats of one event type."""
+
+    def __init__(self, numbers, strings):
+        self.numbers = numbers
+        self.strings = strings
+        # Field flags for the columns and the JSON of the other fields
+        if len(numbers) + len(strings) + 1 > 15:
+            raise ValueError("Too many fields for the record flags")
+        self.record = struct.Struct(">HH" + "8s" * len(numbers))
+        self.offsets = struct.Struct(">" + "I" * (len(strings) + 1))
+
+    def pack(self, payload, heap_size):
+        """Encode a payload (None for a missing event) to a record, its string ends and its strings."""
+        flags = 0
+        integers = 0
+        numbers = []
+        ends = []
+        strings = []
+        if payload is not None:
+            flags = STORED
+            rest = dict(payload)
+            for bit, field in enumerate(self.numbers):
+                value = rest.get(field)
+                if isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63:
+                    integers |= 1 << bit
+                    numbers.append(INTEGER.pack(value))
+                elif isinstance(value, float):
+                    numbers.append(DOUBLE.pack(value))
+                else:
+                    numbers.append(bytes(8))
+                    continue
+                flags |= 1 << bit
+                del rest[field]
+            values = []
+            for field in self.strings:
+                value = rest.get(field)
+                values.append(rest.pop(field) if isinstance(value, str) else None)
+            values.append(json.dumps(rest) if rest else None)
+            for bit, value in enumerate(values, len(self.numbers)):
+                if value is not None:
+                    flags |= 1 << bit
+                    encoded = value.encode()
+                    strings.append(encoded)
+                    heap_size += len(encoded)
+                ends.append(heap_size)
+        else:
+            numbers = [bytes(8)] * len(self.numbers)
+            ends = [heap_size] * (len(self.strings) + 1)
+        return self.record.pack(flags, integers, *numbers), self.offsets.pack(*ends), b"".join(strings)
+
+    def unpack(self, records, offsets, heap, index):
+        """Decode record `index` of a segment's buffers. Returns None for a missing event."""
+        flags, integers, *numbers = self.record.unpack_from(records, index * self.record.size)
+        if not flags & STORED:
+            return None
+        payload = {}
+        for bit, (field, value) in enumerate(zip(self.numbers, numbers)):
+            if flags & 1 << bit:
+                payload[field] = (INTEGER if integers & 1 << bit else DOUBLE).unpack(value)[0]
+        start = END.unpack_from(offsets, index * self.offsets.size - END.size)[0] if index else 0
+        ends = self.offsets.unpack_from(offsets, index * self.offsets.size)
+        for bit, (field, end) in enumerate(zip(self.strings + (None,), ends), len(self.numbers)):
+            if flags & 1 << bit:
+                value = heap[start:end].decode()
+                if field is None:
+                    payload.update(json.loads(value))
+                else:
+                    payload[field] = value
+            start = end
+        return payload
+
+
+class Segment:
+    """The events of one type from ordinal `first` on."""
+
+    def __init__(self, path, first, layout):
+        self.path = path
+        self.first = first
+        self.layout = layout
+        self.count = 0
+        self.files = None
+        self.maps = None
+        self.buffers = (bytearray(), bytearray(), bytearray())
+        self.sealed_at = None
+
+    @property
+    def end(self):
+        return self.first + self.count
+
+    def nbytes(self):
+        return sum(len(buffer) for buffer in self.buffers)
+
+    def _read(self, suffix):
+        try:
+            with open(self.path + suffix, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return b""
+
+    def open(self, count=None):
+        """Load the segment into memory to append to it, keeping at most `count` records."""
+        records, offsets, heap = (self._read(suffix) for suffix in SUFFIXES)
+        self.count = min(len(records) // self.layout.record.size, len(offsets) // self.layout.offsets.size)
+        if count is not None:
+            self.count = min(self.count, count)
+        heap_size = END.unpack_from(offsets, self.count * self.layout.offsets.size - END.size)[0] \
+            if self.count else 0
+        self.buffers = (bytearray(records[:self.count * self.layout.record.size]),
+                        bytearray(offsets[:self.count * self.layout.offsets.size]),
+                        bytearray(heap[:heap_size]))
+        self.files = []
+        for suffix, buffer in zip(SUFFIXES, self.buffers):
+            f = open(self.path + suffix, "ab")
+            # Drop whatever was written after the last checkpoint
+            f.truncate(len(buffer))
+            self.files.append(f)
+
+    def map(self):
+        """Read a sealed segment through read-only memory maps."""
+        self.maps = []
+        for suffix in SUFFIXES:
+            with open(self.path + suffix, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                # Empty files cannot be mapped
+                self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b"")
+        self.buffers = tuple(self.maps)
+        records, offsets, heap = self.buffers
+        self.count = min(len(records) // self.layout.record.size, len(offsets) // self.layout.offsets.size)
+        # A segment still being written can have records whose strings are not on disk yet
+        while self.count and \
+                END.unpack_from(offsets, self.count * self.layout.offsets.size - END.size)[0] > len(heap):
+            self.count -= 1
+        self.sealed_at = os.stat(self.path + SUFFIXES[0]).st_mtime
+
+    def append(self, payload):
+        parts = self.layout.pack(payload, len(self.buffers[2]))
+        for buffer, f, part in zip(self.buffers, self.files, parts):
+            buffer += part
+            f.write(part)
+        self.count += 1
+
+    def get(self, ordinal):
+        return self.layout.unpack(*self.buffers, ordinal - self.first)
+
+    def flush(self):
+        if self.files:
+            for f in self.files:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def seal(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+        self.files = None
+        self.map()
+
+    def close(self):
+        for f in self.files or ():
+            f.close()
+        for m in self.maps or ():
+            if isinstance(m, mmap.mmap):
+                m.close()
+        self.files = self.maps = None
+
+    def delete(self):
+        self.close()
+        for suffix in SUFFIXES:
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+class SegmentStore:
+    """Segments of every event type, appended to by the indexer and read by the API.
+
+    A `readonly` store never writes its files; `refresh` maps what the
+    process writing them has added.
+    """
+
+    def __init__(self, directory, segment_records=65536, max_bytes=None, readonly=False):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.lock = Lock()
+        self.layouts = {event_type: Layout(*schema) for event_type, schema in SCHEMAS.items()}
+        self.segments = {}
+        for event_type in self.layouts:
+            os.makedirs(self._directory(event_type), exist_ok=True)
+        if not readonly and not self._current():
+            self._clear()
+        for event_type in self.layouts:
+            self.segments[event_type] = self._load(event_type)
+
+    def _directory(self, event_type):
+        return os.path.join(self.directory, event_type)
+
+    def _current(self):
+        """Whether the segments are in the current format."""
+        try:
+            with open(os.path.join(self.directory, VERSION_FILE), "r") as f:
+                return f.read().strip() == str(FORMAT_VERSION)
+        except FileNotFoundError:
+            return False
+
+    def _clear(self):
+        """Delete segments in an older format, then mark the directory as current."""
+        removed = 0
+        for event_type in self.layouts:
+            for name in os.listdir(self._directory(event_type)):
+                if name.endswith(SUFFIXES):
+                    os.remove(os.path.join(self._directory(event_type), name))
+                    removed += 1
+        with open(os.path.join(self.directory, VERSION_FILE), "w") as f:
+            f.write(str(FORMAT_VERSION))
+        if removed:
+            logger.warning(f"Segments in {self.directory} had an old format, copying the events again")
+
+    def _segment(self, event_type, first):
+        path = os.path.join(self._directory(event_type), f"{first:012d}")
+        return Segment(path, first, self.layouts[event_type])
+
+    def _firsts(self, event_type):
+        # A reader waits for the writer to bring the segments up to date
+        if self.readonly and not self._current():
+            return []
+        return sorted(int(name[:-len(SUFFIXES[0])]) for name in os.listdir(self._directory(event_type))
+                      if name.endswith(SUFFIXES[0]))
+
+    def _load(self, event_type):
+        segments = [self._segment(event_type, first) for first in self._firsts(event_type)]
+        if self.readonly:
+            return self._map(event_type, segments)
+        for segment in segments[:-1]:
+            segment.map()
+        if segments:
+            segments[-1].open()
+        else:
+            segments.append(self._segment(event_type, 0))
+            segments[-1].open()
+        return segments
+
+    def _map(self, event_type, segments):
+        """Map the segments not mapped yet, leaving out those that were deleted."""
+        mapped = []
+        for segment in segments:
+            try:
+                if segment.maps is None:
+                    segment.map()
+                mapped.append(segment)
+            except FileNotFoundError:
+                # Deleted by the writer since the directory was listed
+                segment.close()
+        return mapped or [self._segment(event_type, 0)]
+
+    def refresh(self):
+        """Map the segments added since the last refresh, and the events added to the newest one."""
+        for event_type in self.layouts:
+            firsts = self._firsts(event_type)
+            with self.lock:
+                previous = self.segments[event_type]
+                known = {segment.first: segment for segment in previous if segment.maps is not None}
+                newest = {previous[-1].first, firsts[-1] if firsts else None}
+                segments = []
+                for first in firsts:
+                    segment = known.pop(first, None)
+                    # Sealed segments never change; the newest, then and now, are mapped again
+                    if segment is None or first in newest:
+                        if segment is not None:
+                            segment.close()
+                        segment = self._segment(event_type, first)
+                    segments.append(segment)
+                for segment in known.values():
+                    segment.close()
+                self.segments[event_type] = self._map(event_type, segments)
+
+    def count(self, event_type):
+        """The ordinal after the newest stored event."""
+        with self.lock:
+            return self.segments[event_type][-1].end
+
+    def first(self, event_type):
+        """The ordinal of the oldest stored event."""
+        with self.lock:
+            return self.segments[event_type][0].first
+
+    def nbytes(self):
+        with self.lock:
+            return self._nbytes()
+
+    def _nbytes(self):
+        return sum(segment.nbytes() for segments in self.segments.values() for segment in segments)
+
+    def truncate(self, event_type, count):
+        """Drop the events from ordinal `count` on, left by a crash before the index was checkpointed."""
+        with self.lock:
+            segments = self.segments[event_type]
+            if segments[-1].end <= count:
+                return
+            while len(segments) > 1 and segments[-1].first >= count:
+                segments.pop().delete()
+            last = segments[-1]
+            if last.first > count:
+                # The index was rebuilt; start over at its end
+                last.delete()
+                segments[-1] = last = self._segment(event_type, count)
+            last.close()
+            last.open(count - last.first)
+            logger.info(f"Cut the {event_type} segments back to {count} events")
+
+    def append(self, event_type, payload):
+        """Store the event with the next ordinal. A payload of None marks an event that is gone."""
+        with self.lock:
+            segments = self.segments[event_type]
+            active = segments[-1]
+            active.append(payload)
+            if active.count >= self.segment_records:
+                active.seal()
+                new = self._segment(event_type, active.end)
+                new.open()
+                segments.append(new)
+                self._enforce_budget()
+
+    def _enforce_budget(self):
+        if self.max_bytes is None:
+            return
+        while self._nbytes() > self.max_bytes:
+            sealed = [(segments[0].sealed_at, event_type) for event_type, segments in self.segments.items()
+                      if len(segments) > 1]
+            if not sealed:
+                return
+            _, event_type = min(sealed)
+            segment = self.segments[event_type].pop(0)
+            segment.delete()
+            logger.info(f"Deleted {event_type} segment {segment.first}-{segment.end - 1} to stay within "
+                        f"{self.max_bytes} bytes")
+
+    def get(self, event_type, ordinal):
+        """Return a stored event's payload, or None if it is not stored here."""
+        return self.get_many(event_type, [ordinal])[0]
+
+    def get_many(self, event_type, ordinals):
+        with self.lock:
+            segments = self.segments[event_type]
+            firsts = [segment.first for segment in segments]
+            payloads = []
+            for ordinal in ordinals:
+                segment = segments[bisect_right(firsts, ordinal) - 1] if ordinal >= firsts[0] else None
+                payloads.append(segment.get(ordinal) if segment is not None and ordinal < segment.end else None)
+            return payloads
+
+    def flush(self):
+        """Make every appended event durable."""
+        with self.lock:
+            for segments in self.segments.values():
+                segments[-1].flush()
+
+    def close(self):
+        with self.lock:
+            for segments in self.segments.values():
+                if not self.readonly:
+                    segments[-1].flush()
+                for segment in segments:
+                    segment.close()
@@ -0,0 +1,262 @@
+"""In-process stand-in for the Kafka broker, for the benchmarks.
+
+Implements the part of the pykafka API the services use: sync, async and
+delivery-report producers with partitioners, simple and managed balanced
+consumers with consumer groups and committed offsets, latest offsets, and
+fetching by offset from a partition leader. `install()` puts it in place of
+pykafka.KafkaClient, so it must run before a service's app module is
+imported.
+
+Messages are kept in memory. `save` and `load` carry the topic between the
+benchmark stages, which run in separate processes.
+"""
+import itertools
+import pickle
+import queue
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pykafka
+from pykafka.common import OffsetType
+
+
+class Message:
+    __slots__ = ("value", "partition_key", "partition_id", "offset", "timestamp")
+
+    def __init__(self, value, partition_key, partition_id, offset):
+        self.value = value
+        self.partition_key = partition_key
+        self.partition_id = partition_id
+        self.offset = offset
+        self.timestamp = time.time()
+
+
+class Leader:
+    def __init__(self, topic):
+        self.topic = topic
+
+    def fetch_messages(self, requests, timeout=None):
+        """Answer PartitionFetchRequests with up to 100 messages from each requested offset."""
+        topics = {}
+        for request in requests:
+            log = self.topic.logs[request.partition_id]
+            messages = log[max(0, request.offset):request.offset + 100]
+            topics.setdefault(self.topic.name, {})[request.partition_id] = SimpleNamespace(messages=messages)
+        return SimpleNamespace(topics=topics)
+
+
+class Partition:
+    def __init__(self, topic, partition_id):
+        self.id = partition_id
+        self.topic = topic
+        self.leader = Leader(topic)
+
+    def __lt__(self, other):
+        return self.id < other.id
+
+    def __repr__(self):
+        return f"<Partition {self.id}>"
+
+
+class Producer:
+    def __init__(self, topic, partitioner=None, delivery_reports=False, **_):
+        self.topic = topic
+        self.partitioner = partitioner
+        self.delivery_reports = delivery_reports
+        self.reports = threading.local()
+        self.round_robin = itertools.cycle(sorted(topic.partitions))
+
+    def produce(self, value, partition_key=None, timestamp=None):
+        if self.partitioner is not None:
+            partition = self.partitioner(list(self.topic.partitions.values()), partition_key).id
+        else:
+            partition = next(self.round_robin)
+        message = self.topic.append(partition, partition_key, value)
+        if self.delivery_reports:
+            if not hasattr(self.reports, "queue"):
+                self.reports.queue = queue.Queue()
+            self.reports.queue.put((message, None))
+        return message
+
+    def get_delivery_report(self, block=True, timeout=None):
+        if not hasattr(self.reports, "queue"):
+            self.reports.queue = queue.Queue()
+        return self.reports.queue.get(block, timeout)
+
+    def stop(self):
+        pass
+
+
+class Consumer:
+    """Consumes the partitions assigned to it, from their committed offsets."""
+
+    def __init__(self, topic, consumer_group=None, reset_offset_on_start=False,
+                 auto_offset_reset=OffsetType.EARLIEST, consumer_timeout_ms=-1, **_):
+        self.topic = topic
+        self.group = consumer_group
+        self.reset_offset_on_start = reset_offset_on_start
+        self.auto_offset_reset = auto_offset_reset
+        self.timeout = None if consumer_timeout_ms < 0 else consumer_timeout_ms / 1000
+        self.partitions = {}
+        self.held = {}
+        self.next_partition = 0
+
+    def assign(self, partition_ids):
+        committed = self.topic.committed.get(self.group, {})
+        self.partitions = {pid: self.topic.partitions[pid] for pid in partition_ids}
+        held = {}
+        for pid in partition_ids:
+            if pid in self.held:
+                held[pid] = self.held[pid]
+            elif not self.reset_offset_on_start and pid in committed:
+                held[pid] = committed[pid]
+            elif self.auto_offset_reset == OffsetType.LATEST:
+                held[pid] = len(self.topic.logs[pid]) - 1
+            else:
+                held[pid] = -1
+        self.held = held
+
+    @property
+    def held_offsets(self):
+        return dict(self.held)
+
+    def reset_offsets(self, partition_offsets):
+        for partition, offset in partition_offsets:
+            self.held[partition.id] = offset
+
+    def consume(self, block=True):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.topic.arrived:
+            while True:
+                pids = list(self.held)
+                for i in range(len(pids)):
+                    pid = pids[(self.next_partition + i) % len(pids)]
+                    log = self.topic.logs[pid]
+                    if self.held[pid] + 1 < len(log):
+                        self.held[pid] += 1
+                        self.next_partition = (self.next_partition + i + 1) % len(pids)
+                        return log[self.held[pid]]
+                if not block:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.topic.arrived.wait(remaining)
+
+    def commit_offsets(self):
+        self.topic.committed.setdefault(self.group, {}).update(self.held)
+
+    def stop(self):
+        pass
+
+
+class BalancedConsumer(Consumer):
+    """A member of a consumer group; the topic's partitions are spread over the members."""
+
+    def __init__(self, topic, post_rebalance_callback=None, **kwargs):
+        super().__init__(topic, **kwargs)
+        self.callback = post_rebalance_callback
+        topic.join(self)
+
+    def stop(self):
+        self.topic.leave(self)
+
+
+class Topic:
+    def __init__(self, name, num_partitions):
+        self.name = name
+        self.partitions = {pid: Partition(self, pid) for pid in range(num_partitions)}
+        self.logs = {pid: [] for pid in range(num_partitions)}
+        self.committed = {}
+        self.members = {}
+        self.lock = threading.Lock()
+        self.arrived = threading.Condition(self.lock)
+
+    def append(self, partition, key, value):
+        with self.arrived:
+            log = self.logs[partition]
+            message = Message(value, key, partition, len(log))
+            log.append(message)
+            self.arrived.notify_all()
+        return message
+
+    def join(self, consumer):
+        with self.lock:
+            self.members.setdefault(consumer.group, []).append(consumer)
+            self._rebalance(consumer.group)
+
+    def leave(self, consumer):
+        with self.lock:
+            self.members[consumer.group].remove(consumer)
+            self._rebalance(consumer.group)
+
+    def _rebalance(self, group):
+        members = self.members[group]
+        for index, member in enumerate(members):
+            old = member.held_offsets
+            member.assign([pid for pid in sorted(self.partitions) if pid % len(members) == index])
+            if member.callback is not None:
+                member.callback(member, old, member.held_offsets)
+
+    def get_sync_producer(self, **kwargs):
+        return Producer(self, **kwargs)
+
+    def get_producer(self, **kwargs):
+        return Producer(self, **kwargs)
+
+    def get_simple_consumer(self, **kwargs):
+        consumer = Consumer(self, **kwargs)
+        consumer.assign(sorted(self.partitions))
+        return consumer
+
+    def get_balanced_consumer(self, **kwargs):
+        return BalancedConsumer(self, **kwargs)
+
+    def latest_available_offsets(self):
+        with self.lock:
+            return {pid: SimpleNamespace(offset=[len(log)]) for pid, log in self.logs.items()}
+
+    def size(self):
+        with self.lock:
+            return sum(len(log) for log in self.logs.values())
+
+    def lag(self, group):
+        """Messages not yet committed by a consumer group."""
+        with self.lock:
+            committed = self.committed.get(group, {})
+            return sum(len(log) - committed.get(pid, -1) - 1 for pid, log in self.logs.items())
+
+    def save(self, path):
+        with self.lock:
+            logs = {pid: [(m.partition_key, m.value) for m in log] for pid, log in self.logs.items()}
+        with open(path, "wb") as f:
+            pickle.dump({"name": self.name, "logs": logs}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        topic = cls(data["name"], len(data["logs"]))
+        for pid, log in data["logs"].items():
+            topic.logs[pid] = [Message(value, key, pid, offset) for offset, (key, value) in enumerate(log)]
+        return topic
+
+
+class Client:
+    """Replaces pykafka.KafkaClient; every client sees the same topics."""
+
+    topics = {}
+
+    def __init__(self, hosts=None, **_):
+        pass
+
+
+def install(topic_name="events", num_partitions=4, path=None):
+    """Make pykafka.KafkaClient connect to an in-process topic, loaded from `path` if given."""
+    topic = Topic.load(path) if path else Topic(topic_name.encode(), num_partitions)
+    Client.topics = {topic.name: topic}
+    pykafka.KafkaClient = Client
+    random.seed(0)
+    return topic
@@ -0,0 +1,62 @@
+"""Synthetic sensor readings for the benchmarks.
+
+Each sensor has a fixed zone and a baseline it reports around, so queries
+by sensor and zone, the per-sensor stats and the storage rollups see the
+cardinality they would from a real deployment of `sensors` sensors. The
+same seed gives the same sequence of readings.
+"""
+import random
+from datetime import datetime, timezone
+
+ZONES = ("downtown", "harbourfront", "university", "industrial", "westside", "eastside", "airport", "suburbs")
+INCIDENTS = ("accident", "roadblock", "construction", "stalled vehicle", "police activity")
+
+
+class LoadGenerator:
+    """Readings from `sensors` temperature and `sensors` traffic sensors.
+
+    `temperature_share` of the readings are temperature conditions, and
+    `incident_rate` of the traffic conditions carry an incident report.
+    """
+
+    def __init__(self, sensors=500, temperature_share=0.5, incident_rate=0.02, seed=1):
+        self.random = random.Random(seed)
+        self.temperature_share = temperature_share
+        self.incident_rate = incident_rate
+        self.temperature_sensors = [(f"temp-{i:05d}", ZONES[i % len(ZONES)], self.random.uniform(-10, 30))
+                                    for i in range(sensors)]
+        self.traffic_sensors = [(f"traffic-{i:05d}", self.random.uniform(5, 150)) for i in range(sensors)]
+
+    def temperature(self):
+        sensor_id, zone, baseline = self.random.choice(self.temperature_sensors)
+        return {
+            "sensorId": sensor_id,
+            "timestamp": timestamp(),
+            "temperature": round(baseline + self.random.gauss(0, 1.5), 2),
+            "cityZone": zone,
+        }
+
+    def traffic(self):
+        sensor_id, baseline = self.random.choice(self.traffic_sensors)
+        reading = {
+            "sensorId": sensor_id,
+            "timestamp": timestamp(),
+            "trafficDensity": max(0, round(self.random.gauss(baseline, baseline * 0.25))),
+        }
+        if self.random.random() < self.incident_rate:
+            reading["incidentReport"] = self.random.choice(INCIDENTS)
+        return reading
+
+    def event(self):
+        """The next reading, as (event type, payload)."""
+        if self.random.random() < self.temperature_share:
+            return "temperature_condition", self.temperature()
+        return "traffic_condition", self.traffic()
+
+    def sensor_ids(self, event_type):
+        sensors = self.temperature_sensors if event_type == "temperature_condition" else self.traffic_sensors
+        return [sensor[0] for sensor in sensors]
+
+
+def timestamp():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -0,0 +1,412 @@
+"""End-to-end throughput and latency benchmark of the services, on one machine.
+
+    python benchmarks/run.py --events 20000 --concurrency 32 --out results.json
+    python benchmarks/run.py --baseline baseline.json    # exits 1 on a regression
+
+Kafka is replaced by the in-process broker in broker.py and storage's MySQL
+by SQLite, so nothing but the services' Python dependencies is needed. Each
+service runs the repository's code in its own process, with its dev config
+and the repository's log_conf.yml, changed only to keep every file in a
+temporary work directory. The stages run one after the other:
+
+1. receiver: `--events` readings from load.py are posted to the receiver
+   by `--concurrency` clients, at `--rate` events a second in total (0: as
+   fast as it answers), one per request or in `--batch-size` batches.
+   Measures requests and events a second and request latency.
+2. storage: the topic the receiver produced is replayed to the storage
+   consumers at `--rate`. Measures ingest rate, consumer lag, the time to
+   catch up once the replay ends, and flush latency.
+3. processing: the stats engine tails the topic, then a rollup run reads
+   storage's rollups of the same events. Measures tail rate, snapshot time
+   and the duration of a rollup run.
+4. analyzer: the topic is indexed, then `--lookups` single-event lookups
+   and as many filtered range queries are made. Measures index rate and
+   request latency.
+
+Results are written as JSON, with the run settings under "meta" and the
+measurements under "metrics". With `--baseline`, each metric is compared to
+the baseline's and the run fails if any is more than `--tolerance` worse:
+metrics ending in _per_s are better higher, all others lower.
+
+Absolute numbers depend on the machine, so no baseline is kept in the
+repository: record one with `--save-baseline` on the machine that will run
+the comparisons, from the same settings.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+import yaml
+
+from load import LoadGenerator
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+STAGE = os.path.join(BENCHMARKS, "stage.py")
+EVENT_PATHS = {"temperature_condition": "/receiver/temperature/condition",
+               "traffic_condition": "/receiver/traffic/condition"}
+RANGE_COUNT = 100
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_configs(workdir, ports):
+    """Write each service's dev config, with its files moved to the work directory, and log_conf.yml."""
+    def load(service):
+        with open(os.path.join(REPO, "configs", "dev", service, "app_conf.yml")) as f:
+            return yaml.safe_load(f)
+
+    configs = {service: load(service) for service in ("receiver", "storage", "processing", "analyzer")}
+    configs["receiver"]["spool"]["directory"] = os.path.join(workdir, "spool")
+    configs["storage"]["datastore"] = {"url": f"sqlite:///{os.path.join(workdir, 'storage.db')}", "echo": False}
+    configs["storage"]["cache"]["directory"] = os.path.join(workdir, "cache")
+    configs["processing"]["datastore"] = {"filename": os.path.join(workdir, "processing", "data.json"),
+                                          "snapshot": os.path.join(workdir, "processing", "engine.json")}
+    configs["processing"]["stats"]["source"] = "kafka"
+    configs["processing"]["stats"]["watermark_s"] = 2
+    for event_type in ("temperature", "traffic"):
+        configs["processing"]["eventstores"][event_type]["url"] = (
+            f"http://127.0.0.1:{ports['storage']}/storage/{event_type}/rollup")
+    configs["analyzer"]["index"]["directory"] = os.path.join(workdir, "index")
+    configs["analyzer"]["segments"]["directory"] = os.path.join(workdir, "index", "segments")
+
+    for service, config in configs.items():
+        with open(os.path.join(workdir, f"{service}_conf.yml"), "w") as f:
+            yaml.safe_dump(config, f)
+    shutil.copy(os.path.join(REPO, "configs", "log_conf.yml"), os.path.join(workdir, "log_conf.yml"))
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+
+
+class Stage:
+    """A stage.py process for one service; its output goes to <workdir>/<name>.out."""
+
+    def __init__(self, name, workdir, timeout_s):
+        self.name = name
+        self.workdir = workdir
+        self.timeout_s = timeout_s
+        env = dict(os.environ,
+                   APP_CONF_FILE=os.path.join(workdir, f"{name}_conf.yml"),
+                   LOG_CONF_FILE=os.path.join(workdir, "log_conf.yml"),
+                   SERVICE_NAME=name,
+                   PYTHONPATH=os.pathsep.join(filter(None, [os.path.join(REPO, name),
+                                                            os.environ.get("PYTHONPATH")])))
+        self.output = open(os.path.join(workdir, f"{name}.out"), "w")
+        self.process = subprocess.Popen([sys.executable, STAGE, name, workdir], cwd=workdir, env=env,
+                                        stdout=self.output, stderr=subprocess.STDOUT)
+
+    def check(self):
+        if self.process.poll() is not None and not os.path.exists(self.result_path()):
+            self.output.flush()
+            with open(self.output.name) as f:
+                tail = f.read()[-3000:]
+            raise RuntimeError(f"The {self.name} stage exited with {self.process.returncode}:\n{tail}")
+
+    def result_path(self):
+        return os.path.join(self.workdir, f"{self.name}.json")
+
+    def result(self):
+        """Wait for the stage's measurements."""
+        deadline = time.monotonic() + self.timeout_s
+        while not os.path.exists(self.result_path()):
+            self.check()
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The {self.name} stage did not finish in {self.timeout_s}s")
+            time.sleep(0.05)
+        with open(self.result_path()) as f:
+            return json.load(f)
+
+    def wait_ready(self, url, ready=lambda response: response.status_code == 200):
+        deadline = time.monotonic() + self.timeout_s
+        while True:
+            self.check()
+            try:
+                if ready(httpx.get(url, timeout=1)):
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"The {self.name} stage did not come up in {self.timeout_s}s")
+            time.sleep(0.05)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(self.timeout_s)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.output.close()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def drive(base_url, requests, concurrency, rate):
+    """Make `requests` ((method, path, params, body, events) tuples) from `concurrency` clients.
+
+    With a rate, requests start at `rate` events a second in total. Returns
+    the latencies in ms of successful requests, the number of failed ones,
+    and the elapsed seconds.
+    """
+    latencies = []
+    errors = 0
+    pending = iter(requests)
+    started = time.perf_counter()
+    sent = 0
+
+    async def client_loop(client):
+        nonlocal errors, sent
+        for method, path, params, body, events in pending:
+            if rate:
+                delay = started + sent / rate - time.perf_counter()
+                sent += events
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            request_started = time.perf_counter()
+            try:
+                response = await client.request(method, path, params=params, json=body)
+                ok = response.status_code < 300
+            except httpx.TransportError:
+                ok = False
+            if ok:
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def latency_metrics(prefix, latencies, errors, elapsed, unit="requests"):
+    return {
+        f"{prefix}_{unit}_per_s": len(latencies) / elapsed,
+        f"{prefix}_p50_ms": percentile(latencies, 0.50),
+        f"{prefix}_p95_ms": percentile(latencies, 0.95),
+        f"{prefix}_p99_ms": percentile(latencies, 0.99),
+        f"{prefix}_errors": errors,
+    }
+
+
+def receiver_requests(generator, events, batch_size):
+    remaining = events
+    while remaining:
+        if batch_size > 1:
+            size = min(batch_size, remaining)
+            batch = [dict(zip(("type", "payload"), generator.event())) for _ in range(size)]
+            yield "POST", "/receiver/events:batch", None, batch, size
+        else:
+            size = 1
+            event_type, payload = generator.event()
+            yield "POST", EVENT_PATHS[event_type], None, payload, 1
+        remaining -= size
+
+
+def lookup_requests(counts, lookups):
+    rng = random.Random(2)
+    for i in range(lookups):
+        event_type = ("temperature_condition", "traffic_condition")[i % 2]
+        if counts[event_type]:
+            path = "/analyzer/TemperatureEvent" if i % 2 == 0 else "/analyzer/TrafficEvent"
+            yield "GET", path, {"index": rng.randrange(counts[event_type])}, None, 1
+
+
+def range_requests(generator, lookups):
+    """Filtered pages of events: by sensor, by zone, and by sensor with a time range."""
+    rng = random.Random(3)
+    temperature_sensors = generator.sensor_ids("temperature_condition")
+    traffic_sensors = generator.sensor_ids("traffic_condition")
+    zones = sorted({sensor[1] for sensor in generator.temperature_sensors})
+    end = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    for i in range(lookups):
+        kind = i % 3
+        if kind == 0:
+            params = {"sensorId": rng.choice(temperature_sensors), "count": RANGE_COUNT}
+            yield "GET", "/analyzer/TemperatureEvents", params, None, 1
+        elif kind == 1:
+            params = {"cityZone": rng.choice(zones), "count": RANGE_COUNT}
+            yield "GET", "/analyzer/TemperatureEvents", params, None, 1
+        else:
+            params = {"sensorId": rng.choice(traffic_sensors), "count": RANGE_COUNT,
+                      "start_timestamp": "2000-01-01T00:00:00Z", "end_timestamp": end}
+            yield "GET", "/analyzer/TrafficEvents", params, None, 1
+
+
+def run(args, workdir):
+    ports = {service: free_port() for service in ("receiver", "storage", "analyzer")}
+    write_configs(workdir, ports)
+    with open(os.path.join(workdir, "settings.json"), "w") as f:
+        json.dump({"ports": ports, "partitions": args.partitions, "rate": args.rate,
+                   "timeout_s": args.timeout}, f)
+    generator = LoadGenerator(sensors=args.sensors, seed=args.seed)
+    started_at = datetime.now(timezone.utc)
+    metrics = {}
+    counts = {}
+
+    print("receiver: posting events", file=sys.stderr)
+    stage = Stage("receiver", workdir, args.timeout)
+    try:
+        base_url = f"http://127.0.0.1:{ports['receiver']}"
+        # Until the spool is drained, events are spooled rather than produced
+        stage.wait_ready(base_url + "/receiver/spool",
+                         lambda response: response.status_code == 200 and not response.json()["spooling"])
+        latencies, errors, elapsed = asyncio.run(drive(
+            base_url, receiver_requests(generator, args.events, args.batch_size), args.concurrency, args.rate))
+        metrics.update(latency_metrics("receiver", latencies, errors, elapsed))
+        metrics["receiver_events_per_s"] = (args.events - errors * args.batch_size) / elapsed
+    finally:
+        stage.stop()
+    counts["produced"] = stage.result()["produced"]
+    if not counts["produced"]:
+        raise RuntimeError(f"The receiver produced no events, see {stage.output.name}")
+
+    print("storage: replaying the topic", file=sys.stderr)
+    storage = Stage("storage", workdir, args.timeout)
+    try:
+        result = storage.result()
+        counts["stored"] = result["stored"]
+        metrics.update({f"storage_{name}": result[name] for name in
+                        ("ingest_events_per_s", "drain_ms", "max_lag_events", "avg_flush_ms")})
+        storage.wait_ready(f"http://127.0.0.1:{ports['storage']}/storage/consumer/stats")
+
+        print("processing: tailing the topic, then reading rollups", file=sys.stderr)
+        stage = Stage("processing", workdir, args.timeout + 60)
+        try:
+            result = stage.result()
+        finally:
+            stage.stop()
+        counts["rollup_events"] = result["rollup_events"]
+        metrics.update({f"processing_{name}": result[name] for name in
+                        ("tail_events_per_s", "snapshot_ms", "rollup_cycle_ms")})
+    finally:
+        storage.stop()
+
+    print("analyzer: indexing the topic and serving lookups", file=sys.stderr)
+    stage = Stage("analyzer", workdir, args.timeout)
+    try:
+        result = stage.result()
+        counts["indexed"] = sum(result["counts"].values())
+        metrics["analyzer_index_events_per_s"] = result["index_events_per_s"]
+        base_url = f"http://127.0.0.1:{ports['analyzer']}"
+        stage.wait_ready(base_url + "/analyzer/stats")
+        metrics.update(latency_metrics("analyzer_lookup", *asyncio.run(drive(
+            base_url, lookup_requests(result["counts"], args.lookups), args.concurrency, 0))))
+        metrics.update(latency_metrics("analyzer_range", *asyncio.run(drive(
+            base_url, range_requests(generator, args.lookups), args.concurrency, 0))))
+    finally:
+        stage.stop()
+
+    for name, count in counts.items():
+        if count != counts["produced"]:
+            print(f"Warning: {count} events {name}, of {counts['produced']} produced", file=sys.stderr)
+
+    return {
+        "meta": {
+            "started_at": started_at.isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "settings": {name: getattr(args, name) for name in
+                         ("events", "rate", "concurrency", "batch_size", "sensors", "partitions", "lookups", "seed")},
+            "counts": counts,
+        },
+        "metrics": metrics,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(metrics, baseline, tolerance):
+    """Return (metric, baseline, result, change) for every metric more than `tolerance` worse than the baseline."""
+    regressions = []
+    for name, expected in baseline.items():
+        if name not in metrics:
+            continue
+        value = metrics[name]
+        if name.endswith("_per_s"):
+            worse = value < expected * (1 - tolerance)
+        else:
+            worse = value > expected * (1 + tolerance)
+        if worse:
+            change = (value - expected) / expected if expected else float("inf")
+            regressions.append((name, expected, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=20000, help="readings to post to the receiver")
+    parser.add_argument("--rate", type=float, default=0, help="events a second in total; 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent HTTP clients")
+    parser.add_argument("--batch-size", type=int, default=1, help="readings per receiver request, up to 500")
+    parser.add_argument("--sensors", type=int, default=500, help="sensors of each type")
+    parser.add_argument("--partitions", type=int, default=4, help="partitions of the events topic")
+    parser.add_argument("--lookups", type=int, default=2000, help="analyzer lookups, and range queries, to make")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300, help="seconds a stage may take")
+    parser.add_argument("--out", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with the results in this file")
+    parser.add_argument("--save-baseline", help="also write the results to this file, as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction a metric may be worse than the baseline")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory, with each stage's output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="smartcity-bench-")
+    try:
+        results = run(args, workdir)
+    finally:
+        if args.keep:
+            print(f"Work directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    body = json.dumps(results, indent=4)
+    print(body)
+    for path in filter(None, (args.out, args.save_baseline)):
+        with open(path, "w") as f:
+            f.write(body + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["settings"] != results["meta"]["settings"]:
+            print("Warning: the baseline was recorded with different settings", file=sys.stderr)
+        regressions = compare(results["metrics"], baseline["metrics"], args.tolerance)
+        for name, expected, value, change in regressions:
+            print(f"REGRESSION {name}: {value:.2f} against {expected:.2f} ({change:+.0%})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No metric is more than {args.tolerance:.0%} worse than the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""One stage of the benchmark: a service running against the in-process broker.
+
+Started by run.py as `python stage.py <stage> <workdir>`, with the
+service's directory first on sys.path and APP_CONF_FILE and LOG_CONF_FILE
+pointing at the configs run.py wrote to the work directory. The stage
+writes what it measures inside the service to <workdir>/<stage>.json;
+stages that serve HTTP do so once that file is written, until they are
+sent SIGINT. Serving runs the app's lifespan, which starts its background
+work as `SERVICE_ROLE=all` does in production.
+"""
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import uvicorn
+
+import broker
+
+POLL_S = 0.01
+
+
+def load_settings(workdir):
+    with open(os.path.join(workdir, "settings.json")) as f:
+        return json.load(f)
+
+
+def write_result(workdir, stage, result):
+    path = os.path.join(workdir, f"{stage}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(result, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def wait_until(condition, timeout_s, what):
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out after {timeout_s}s waiting for {what}")
+        time.sleep(POLL_S)
+
+
+def serve(app, port):
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def receiver(workdir, settings):
+    """Serve the receiver; once it is stopped, save the topic it produced for the later stages."""
+    topic = broker.install(num_partitions=settings["partitions"])
+    import app
+    serve(app.app, settings["ports"]["receiver"])
+    topic.save(os.path.join(workdir, "topic.pkl"))
+    write_result(workdir, "receiver", {"produced": topic.size()})
+
+
+def storage(workdir, settings):
+    """Replay the receiver's topic to the storage consumers and time how long storing it takes.
+
+    The consumers start on an empty topic, as they would in production, and
+    the events are appended at settings["rate"] a second (0: all at once)
+    while the lag of the consumer group is sampled. Storage serves its API
+    throughout, for the processing stage's rollup queries.
+    """
+    source = broker.Topic.load(os.path.join(workdir, "topic.pkl"))
+    topic = broker.install(num_partitions=len(source.partitions))
+    import app
+    threading.Thread(target=replay, args=(workdir, settings, app, source, topic), daemon=True).start()
+    serve(app.app, settings["ports"]["storage"])
+
+
+def replay(workdir, settings, app, source, topic):
+    wait_until(lambda: app.worker_stats and all(worker["partitions"] for worker in app.worker_stats.values()),
+               settings["timeout_s"], "the storage consumers to be assigned partitions")
+
+    messages = sorted((message for log in source.logs.values() for message in log),
+                      key=lambda message: (message.offset, message.partition_id))
+    lag = []
+    appended = threading.Event()
+
+    def sample_lag():
+        while not appended.is_set() or topic.lag(app.CONSUMER_GROUP):
+            lag.append(topic.lag(app.CONSUMER_GROUP))
+            time.sleep(POLL_S)
+
+    sampler = threading.Thread(target=sample_lag, daemon=True)
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    sampler.start()
+    rate = settings["rate"]
+    for count, message in enumerate(messages):
+        if rate:
+            delay = started + count / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        topic.append(message.partition_id, message.partition_key, message.value)
+    appended_at = time.perf_counter()
+    appended.set()
+    wait_until(lambda: not sampler.is_alive(), settings["timeout_s"], "storage to commit every event")
+    finished = time.perf_counter()
+
+    stats, _ = app.get_consumer_stats()
+    write_result(workdir, "storage", {
+        "stored": stats["events"],
+        "started_at": started_at.isoformat(),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "ingest_events_per_s": len(messages) / (finished - started),
+        "drain_ms": (finished - appended_at) * 1000,
+        "max_lag_events": max(lag, default=0),
+        "mean_lag_events": statistics.fmean(lag) if lag else 0,
+        "avg_flush_ms": stats["avg_flush_ms"],
+        "avg_batch_size": stats["avg_batch_size"],
+    })
+
+
+def processing(workdir, settings):
+    """Time both stats sources: tailing the topic, and a rollup run against the storage stage.
+
+    Storage rollups only cover whole minutes, so the rollup run waits for the
+    minute storage finished in to close, and then for processing's watermark.
+    """
+    topic = broker.install(path=os.path.join(workdir, "topic.pkl"))
+    import app
+
+    def consumed():
+        return app.engine.temperature.total.count + app.engine.traffic.total.count
+
+    started = time.perf_counter()
+    app.init_scheduler()
+    wait_until(lambda: consumed() >= topic.size(), settings["timeout_s"], "processing to consume the topic")
+    tail_s = time.perf_counter() - started
+
+    snapshot_ms = []
+    for _ in range(5):
+        started = time.perf_counter()
+        app.save_snapshot(datetime.now(timezone.utc).isoformat())
+        snapshot_ms.append((time.perf_counter() - started) * 1000)
+
+    with open(os.path.join(workdir, "storage.json")) as f:
+        stored = json.load(f)
+    app.engine = app.StatsEngine(app.RELATIVE_ACCURACY)
+    app.engine.last_updated = (datetime.fromisoformat(stored["started_at"]).replace(second=0, microsecond=0)
+                               .isoformat())
+    closed = (datetime.fromisoformat(stored["finished_at"]).replace(second=0, microsecond=0) + timedelta(minutes=1)
+              + timedelta(seconds=app.ROLLUP_WATERMARK_S))
+    time.sleep(max(0.0, (closed - datetime.now(timezone.utc)).total_seconds()))
+    started = time.perf_counter()
+    app.populate_stats()
+    rollup_ms = (time.perf_counter() - started) * 1000
+
+    write_result(workdir, "processing", {
+        "tail_events_per_s": topic.size() / tail_s,
+        "snapshot_ms": statistics.median(snapshot_ms),
+        "rollup_cycle_ms": rollup_ms,
+        "rollup_events": consumed(),
+    })
+
+
+def analyzer(workdir, settings):
+    """Index the topic, timing it from the indexer's start, then serve lookups."""
+    topic = broker.install(path=os.path.join(workdir, "topic.pkl"))
+    import app
+
+    def indexed():
+        counts, _, _ = app.offset_index.counts()
+        return sum(counts.values())
+
+    def measure():
+        wait_until(lambda: app.indexer is not None, settings["timeout_s"], "the analyzer to start")
+        started = time.perf_counter()
+        wait_until(lambda: indexed() >= topic.size(), settings["timeout_s"], "the analyzer to index the topic")
+        counts, _, _ = app.offset_index.counts()
+        write_result(workdir, "analyzer", {
+            "index_events_per_s": topic.size() / (time.perf_counter() - started),
+            "counts": counts,
+        })
+
+    threading.Thread(target=measure, daemon=True).start()
+    serve(app.app, settings["ports"]["analyzer"])
+
+
+STAGES = {"receiver": receiver, "storage": storage, "processing": processing, "analyzer": analyzer}
+
+if __name__ == "__main__":
+    stage, workdir = sys.argv[1], sys.argv[2]
+    STAGES[stage](workdir, load_settings(workdir))
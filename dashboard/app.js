@@ -6,8 +6,14 @@ const baseUrl = window.location.hostname === 'localhost'
 const PROCESSING_SERVICE_URL = `${baseUrl}/processing`;
 const ANALYZER_SERVICE_URL = `${baseUrl}/analyzer`;
 
-// Update frequency in milliseconds (4 seconds)
+// Update frequency in milliseconds (4 seconds), when polling
 const UPDATE_INTERVAL = 4000;
+// How often a new random event may be picked (30 seconds)
+const RANDOM_EVENT_INTERVAL = 30000;
+
+// Events the analyzer had indexed at the last stats update, and when the random event was last picked
+let analyzedTotal = null;
+let sampledTotal;
 
 // Function to format date
 function getLocaleDateStr() {
@@ -64,26 +70,28 @@ const updateCodeDiv = (result, elemId) => {
     }
 };
 
+// Function to show processing stats
+function renderProcessingStats(data) {
+    // Update main stats
+    const totalEvents = (data.num_temperature_readings || 0) + (data.num_traffic_readings || 0);
+
+    updateElementText('totalEvents', totalEvents);
+    updateElementText('failedEvents', '0');
+    updateElementText('successEvents', totalEvents);
+    updateElementText('lastUpdated', getLocaleDateStr());
+
+    // Update additional metrics
+    updateElementText('maxTemperature', data.max_temperature || 0); 
+    updateElementText('maxTrafficDensity', data.max_traffic_density || 0);
+
+    // Update processing stats display if element exists
+    updateCodeDiv(data, "processing-stats");
+}
+
 // Function to fetch processing stats
 async function fetchProcessingStats() {
     try {
-        const data = await makeRequest(`${PROCESSING_SERVICE_URL}/stats`);
-        
-        // Update main stats
-        const totalEvents = (data.num_temperature_readings || 0) + (data.num_traffic_readings || 0);
-        
-        updateElementText('totalEvents', totalEvents);
-        updateElementText('failedEvents', '0');
-        updateElementText('successEvents', totalEvents);
-        updateElementText('lastUpdated', getLocaleDateStr());
-        
-        // Update additional metrics
-        updateElementText('maxTemperature', data.max_temperature || 0); 
-        updateElementText('maxTrafficDensity', data.max_traffic_density || 0);
-        
-        // Update processing stats display if element exists
-        updateCodeDiv(data, "processing-stats");
-        
+        renderProcessingStats(await makeRequest(`${PROCESSING_SERVICE_URL}/stats`));
     } catch (error) {
         console.error('Error fetching processing stats:', error);
         updateElementText('totalEvents', 'Error');
@@ -92,21 +100,24 @@ async function fetchProcessingStats() {
     }
 }
 
+// Function to show analyzer stats
+function renderAnalyzerStats(data) {
+    // Update analyzer stats
+    const totalAnalyzed = (data.num_temperature || 0) + (data.num_traffic || 0);
+    analyzedTotal = totalAnalyzed;
+
+    updateElementText('totalAnalyzed', totalAnalyzed);
+    updateElementText('tempEvents', data.num_traffic || 0); // Note: These seem swapped in the HTML
+    updateElementText('trafficEvents', data.num_temperature || 0); // Note: These seem swapped in the HTML
+
+    // Update analyzer stats display if element exists
+    updateCodeDiv(data, "analyzer-stats");
+}
+
 // Function to fetch analyzer stats
 async function fetchAnalyzerStats() {
     try {
-        const data = await makeRequest(`${ANALYZER_SERVICE_URL}/stats`);
-        
-        // Update analyzer stats
-        const totalAnalyzed = (data.num_temperature || 0) + (data.num_traffic || 0);
-        
-        updateElementText('totalAnalyzed', totalAnalyzed);
-        updateElementText('tempEvents', data.num_traffic || 0); // Note: These seem swapped in the HTML
-        updateElementText('trafficEvents', data.num_temperature || 0); // Note: These seem swapped in the HTML
-        
-        // Update analyzer stats display if element exists
-        updateCodeDiv(data, "analyzer-stats");
-        
+        renderAnalyzerStats(await makeRequest(`${ANALYZER_SERVICE_URL}/stats`));
     } catch (error) {
         console.error('Error fetching analyzer stats:', error);
         updateElementText('totalAnalyzed', 'Error');
@@ -151,25 +162,82 @@ async function fetchRandomEvent() {
     }
 }
 
-// Function to update all data
-async function updateDashboard() {
-    // Update last updated timestamp - using the existing element in your HTML
-    updateElementText('lastUpdated', getLocaleDateStr());
-    
-    await Promise.all([
-        fetchProcessingStats(),
-        fetchAnalyzerStats(),
-        fetchRandomEvent()
-    ]);
+// Pick a new random event, but only while the tab is visible and once the
+// analyzer has indexed new events, so idle dashboards do not keep polling it
+function refreshRandomEvent() {
+    if (document.hidden || analyzedTotal === sampledTotal) {
+        return;
+    }
+    sampledTotal = analyzedTotal;
+    fetchRandomEvent();
+}
+
+// Apply a JSON merge patch (RFC 7386) to a copy of target
+function applyMergePatch(target, patch) {
+    if (patch === null || typeof patch !== 'object' || Array.isArray(patch)) {
+        return patch;
+    }
+    const result = (target !== null && typeof target === 'object' && !Array.isArray(target)) ? { ...target } : {};
+    for (const [key, value] of Object.entries(patch)) {
+        if (value === null) {
+            delete result[key];
+        } else {
+            result[key] = applyMergePatch(result[key], value);
+        }
+    }
+    return result;
+}
+
+// Follow a service's stats stream: the whole stats first, then only what changed.
+// While the stream is down (or not supported), poll instead.
+function followStats(streamUrl, render, poll) {
+    let timer = null;
+    const startPolling = () => {
+        if (timer === null) {
+            poll();
+            timer = setInterval(poll, UPDATE_INTERVAL);
+        }
+    };
+    const stopPolling = () => {
+        if (timer !== null) {
+            clearInterval(timer);
+            timer = null;
+        }
+    };
+
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    let stats = null;
+    const show = (data) => {
+        stats = data;
+        render(stats);
+        updateElementText('lastUpdated', getLocaleDateStr());
+    };
+    const source = new EventSource(streamUrl);
+    source.onopen = stopPolling;
+    // The browser reconnects on its own; poll until it does
+    source.onerror = startPolling;
+    source.addEventListener('stats', (e) => show(JSON.parse(e.data)));
+    source.addEventListener('delta', (e) => {
+        if (stats !== null) {
+            show(applyMergePatch(stats, JSON.parse(e.data)));
+        }
+    });
 }
 
 // Function to set up the dashboard
 function setup() {
-    // Initial update
-    updateDashboard();
-    
-    // Set up periodic updates
-    setInterval(updateDashboard, UPDATE_INTERVAL);
+    updateElementText('lastUpdated', getLocaleDateStr());
+
+    followStats(`${PROCESSING_SERVICE_URL}/stats/stream`, renderProcessingStats, fetchProcessingStats);
+    followStats(`${ANALYZER_SERVICE_URL}/stats/stream`, renderAnalyzerStats, fetchAnalyzerStats);
+
+    refreshRandomEvent();
+    setInterval(refreshRandomEvent, RANDOM_EVENT_INTERVAL);
+    document.addEventListener('visibilitychange', refreshRandomEvent);
 }
 
 // Initialize when the DOM is fully loaded
@@ -1,16 +1,27 @@
 import connexion
-from connexion import NoContent
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 from apscheduler.schedulers.background import BackgroundScheduler
 import logging
-import logging.config
-from flask import Flask
+import logging_setup
+from flask import Flask, Response, request
+from werkzeug.http import http_date
+import hashlib
 import yaml
 import json
 import os
 import httpx
+import asyncio
+import time
+from threading import Event, Lock, Thread
 from datetime import datetime, timedelta, timezone
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+import envelope
+import metrics
+from stats_engine import StatsEngine
+from live import Broadcaster, StreamMiddleware
+import server
 
 from dotenv import load_dotenv
 
@@ -23,6 +34,19 @@ with open(app_conf_file, 'r') as f:
 TEMPERATURE_URL = app_config['eventstores']['temperature']['url']
 TRAFFIC_URL = app_config['eventstores']['traffic']['url']
 stats_file = app_config['datastore']['filename']
+SNAPSHOT_FILE = app_config['datastore'].get('snapshot', os.path.join(os.path.dirname(stats_file), 'engine.json'))
+STATS_SOURCE = app_config.get('stats', {}).get('source', 'kafka')
+RELATIVE_ACCURACY = app_config.get('stats', {}).get('relative_accuracy', 0.01)
+# How long after a minute ends its rollup bucket is read, so storage has committed the events in it
+ROLLUP_WATERMARK_S = app_config.get('stats', {}).get('watermark_s', 60)
+SNAPSHOT_INTERVAL_S = app_config['scheduler']['interval']
+FETCH_CONFIG = app_config['eventstores']
+FETCH_RETRIES = FETCH_CONFIG.get('retries', 3)
+KAFKA_HOST = app_config['events']['hostname'] + ":" + str(app_config['events']['port'])
+KAFKA_TOPIC = app_config['events']['topic']
+KAFKA_GROUP = app_config['events'].get('group', 'processing_group').encode()
+HEARTBEAT_S = app_config.get('stream', {}).get('heartbeat_s', 15)
+GRACEFUL_TIMEOUT_S = app_config.get('server', {}).get('graceful_timeout_s', 30)
 app = Flask(__name__)
 
 log_conf_file = os.getenv("LOG_CONF_FILE", "/app/log_conf.yml")
@@ -30,108 +54,340 @@ log_conf_file = os.getenv("LOG_CONF_FILE", "/app/log_conf.yml")
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f)
 service_name = os.getenv("SERVICE_NAME", "default_service")
-log_file_path = f"logs/{service_name}.log"
-if "file" in log_config["handlers"]:
-    log_config["handlers"]["file"]["filename"] = log_file_path
-logging.config.dictConfig(log_config)
+logging_setup.configure(log_config, service_name)
 logger = logging.getLogger('basicLogger')
+# Once per event or request; sampled as configured in log_conf.yml
+event_logger = logging.getLogger(logging_setup.EVENT_LOGGER)
 
+engine = StatsEngine(RELATIVE_ACCURACY)
+# Rollup fetching: a pooled async client on a long-lived event loop
+client = None
+fetch_loop = None
+populate_lock = Lock()
+# The serialized stats served by /stats, replaced whenever a snapshot is saved
+current_stats = {"body": None, "etag": None, "last_modified": None}
+stats_lock = Lock()
+# Pushes the stats to dashboards at /processing/stats/stream
+stream = Broadcaster(HEARTBEAT_S)
+consume_lag = metrics.CONSUME_LAG.labels("processing")
+# Set on shutdown; the background work saves a last snapshot and exits
+stopping = Event()
+threads = []
+sched = None
+# How often the api role checks the stats file for a newer snapshot
+FOLLOW_INTERVAL_S = 1
 
-def populate_stats():
-    logger.info("Periodic processing has started")
 
-    stats_file = app_config['datastore']['filename']
-    stats_dir = os.path.dirname(stats_file)
+def publish_stats(body, last_modified):
+    """Make serialized stats the ones served by /stats and pushed to the stream."""
+    etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+    with stats_lock:
+        if etag == current_stats["etag"]:
+            return
+        current_stats.update(body=body, etag=etag, last_modified=last_modified.replace(microsecond=0))
+    stream.publish(json.loads(body))
 
-    # Ensure the directory exists
-    if stats_dir and not os.path.exists(stats_dir):
-        os.makedirs(stats_dir)
-        logger.info(f"Created missing directory: {stats_dir}")
-    
-    default_stats = {
-        "num_temperature_readings": 0,
-        "max_temperature": 0,
-        "num_traffic_readings": 0,
-        "max_traffic_density": 0,
-        "last_updated": (datetime.now(timezone.utc) - timedelta(minutes=5)).isoformat()
-    }
-
-    # Check if stats file exists, if not create it with default values
-    if os.path.exists(stats_file):
-        logger.info(f"Found existing stats file: {stats_file}")
-        with open(stats_file, 'r') as f:
-            stats = json.load(f)
-    else:
-        logger.info(f"File not found, creating {stats_file} with default values")
-        stats = default_stats
-        # Ensure the file gets created
-        with open(stats_file, 'w') as f:
-            json.dump(stats, f, indent=4)
-        logger.info(f"Created the file: {stats_file}")
-
-    logger.info(f"Last updated timestamp in file: {stats['last_updated']}")
-    last_updated = stats["last_updated"]
-    current_time = datetime.now(timezone.utc).isoformat()
-    logger.debug(f"Current time: {current_time}")
-    
-    # Ensure 'last_updated' field is being updated
-    if last_updated != current_time:
-        logger.info(f"Updating 'last_updated' timestamp to {current_time}")
-        stats["last_updated"] = current_time
-    
-    params = {"start_timestamp": last_updated, "end_timestamp": current_time}
-    logger.info(f"Fetching events from {TEMPERATURE_URL} and {TRAFFIC_URL} with params {params}")
-    temperature_response = httpx.get(TEMPERATURE_URL, params=params)
-    traffic_response = httpx.get(TRAFFIC_URL, params=params)
-    
-    temperature_events = temperature_response.json() if temperature_response.status_code == 200 else []
-    traffic_events = traffic_response.json() if traffic_response.status_code == 200 else []
-    logger.debug(f"Temperature events received: {temperature_events[:2]}")
-    logger.debug(f"Traffic events received: {traffic_events[:2]}")
-    
-    if not temperature_events and not traffic_events:
-        logger.error("Failed to get events or no new events found.")
-
-    
-    if temperature_events:
-        temperature_values = [event["temperature"] for event in temperature_events]
-        stats["num_temperature_readings"] += len(temperature_values)
-        stats["max_temperature"] = max(stats["max_temperature"], max(temperature_values))
-        
-    if traffic_events:
-        traffic_values = [event["trafficDensity"] for event in traffic_events]
-        stats["num_traffic_readings"] += len(traffic_values)
-        stats["max_traffic_density"] = max(stats["max_traffic_density"], max(traffic_values))
-    
-    # After updating, save stats back to the file
-    with open(stats_file, 'w') as f:
-        json.dump(stats, f, indent=4)
-    
-    logger.info("Periodic processing has ended")
+def save_snapshot(last_updated):
+    """Persist the engine and the stats served by /stats.
+
+    Files are written to a temporary name and renamed over the old ones, so
+    a reader never sees a partly written file.
+    """
+    engine.save(SNAPSHOT_FILE, last_updated)
+    write_stats()
+
+def write_stats():
+    """Write the engine's stats to the stats file and serve them."""
+    body = json.dumps(engine.summary(), indent=4)
+    with open(stats_file + ".tmp", 'w') as f:
+        f.write(body)
+    os.replace(stats_file + ".tmp", stats_file)
+    publish_stats(body, datetime.now(timezone.utc))
+
+def tail_events():
+    """Feed every event on the events topic into the engine.
+
+    A snapshot is saved every scheduler interval and the consumer offsets are
+    committed right after it, so on restart the engine resumes from the
+    snapshot at the first event it does not include. When consuming fails,
+    the engine is rolled back to that snapshot the same way and the topic is
+    tailed again once Kafka is back.
+    """
+    delay = 1
+    while not stopping.is_set():
+        try:
+            client = KafkaClient(hosts=KAFKA_HOST)
+            topic = client.topics[str.encode(KAFKA_TOPIC)]
+            consumer = topic.get_simple_consumer(consumer_group=KAFKA_GROUP,
+                                                 reset_offset_on_start=False,
+                                                 auto_offset_reset=OffsetType.EARLIEST,
+                                                 consumer_timeout_ms=1000)
+        except Exception as e:
+            logger.warning(f"Kafka is not available ({e}), retrying in {delay}s")
+            stopping.wait(delay)
+            delay = min(delay * 2, 30)
+            continue
+        delay = 1
+        logger.info(f"Tailing {KAFKA_TOPIC} as consumer group {KAFKA_GROUP.decode()}")
+        try:
+            consume_events(topic, consumer)
+        except Exception as e:
+            logger.error(f"Tailing {KAFKA_TOPIC} failed ({e}), resuming from the last snapshot in {delay}s")
+            # The events added since are consumed again from its offsets
+            engine.load(SNAPSHOT_FILE)
+            try:
+                consumer.stop()
+            except Exception:
+                pass
+            stopping.wait(delay)
+
+def consume_events(topic, consumer):
+    """Add the events from `consumer` to the engine until the service stops."""
+    num_events = 0
+    skipped = 0
+    next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL_S
+    while not stopping.is_set():
+        msg = consumer.consume(block=True)
+        if msg is not None:
+            try:
+                event = envelope.decode(msg.value)
+                metrics.observe_consumed(consume_lag, event["datetime"])
+                engine.add_event(event["type"], event["payload"])
+                num_events += 1
+            except Exception as e:
+                logger.error(f"Skipped the message at partition {msg.partition_id} offset {msg.offset} ({e!r})")
+                skipped += 1
+        if time.monotonic() >= next_snapshot:
+            # Nothing is saved while no events arrive, so the stats (and
+            # their ETag) only change when there is something new
+            if num_events:
+                with metrics.JOB_DURATION.labels("snapshot").time():
+                    save_snapshot(datetime.now(timezone.utc).isoformat())
+                    consumer.commit_offsets()
+                logger.info(f"Saved stats snapshot ({num_events} new events)")
+            elif skipped:
+                consumer.commit_offsets()
+            num_events = 0
+            skipped = 0
+            record_lag(topic, consumer)
+            next_snapshot = time.monotonic() + SNAPSHOT_INTERVAL_S
+    if num_events:
+        save_snapshot(datetime.now(timezone.utc).isoformat())
+        consumer.commit_offsets()
+        logger.info(f"Saved stats snapshot on shutdown ({num_events} new events)")
+    elif skipped:
+        consumer.commit_offsets()
+    consumer.stop()
+
+def record_lag(topic, consumer):
+    """Export how many events are waiting in each partition."""
+    try:
+        latest = topic.latest_available_offsets()
+    except Exception as e:
+        logger.warning(f"Could not fetch the latest offsets of {KAFKA_TOPIC} ({e})")
+        return
+    for partition, offset in (consumer.held_offsets or {}).items():
+        if partition in latest:
+            metrics.CONSUMER_LAG.labels("processing", str(partition)).set(
+                max(0, latest[partition].offset[0] - offset - 1))
+
+def run_in_fetch_loop(coro):
+    """Run a coroutine on the fetch event loop and wait for its result.
+
+    The loop lives in its own thread for the life of the process, so the
+    pooled client and its open connections are reused by every run.
+    """
+    global fetch_loop
+    if fetch_loop is None:
+        fetch_loop = asyncio.new_event_loop()
+        t = Thread(target=fetch_loop.run_forever)
+        t.daemon = True
+        t.start()
+    return asyncio.run_coroutine_threadsafe(coro, fetch_loop).result()
+
+def get_client():
+    global client
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=FETCH_CONFIG.get('timeout_s', 10),
+            limits=httpx.Limits(max_connections=FETCH_CONFIG.get('max_connections', 10),
+                                max_keepalive_connections=FETCH_CONFIG.get('max_connections', 10))
+        )
+    return client
+
+async def fetch_rollup(url, params):
+    """Return the per-group buckets of a storage rollup query.
+
+    Connection errors, timeouts and 5xx responses are retried with backoff.
+    Raises once FETCH_RETRIES attempts have failed.
+    """
+    delay = 0.5
+    for attempt in range(1, FETCH_RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            response = await get_client().get(url, params=params)
+            metrics.HTTP_CLIENT_LATENCY.labels(url, str(response.status_code)).observe(time.perf_counter() - started)
+            if response.status_code < 500:
+                response.raise_for_status()
+                return response.json().get("groups", [])
+            error = f"status {response.status_code}"
+        except httpx.TransportError as e:
+            metrics.HTTP_CLIENT_LATENCY.labels(url, "error").observe(time.perf_counter() - started)
+            error = repr(e)
+        if attempt == FETCH_RETRIES:
+            raise RuntimeError(f"Request to {url} failed after {attempt} attempts ({error})")
+        logger.warning(f"Request to {url} failed ({error}), retrying in {delay}s")
+        await asyncio.sleep(delay)
+        delay *= 2
+
+def next_window(start, end):
+    """Split the next sub-window off [start, end).
+
+    Whole hours are read from the hourly rollups, anything else a minute at a
+    time up to the next hour, so a long backlog costs one bucket per sensor
+    per hour and a window never holds more than an hour of buckets.
+    """
+    next_hour = start.replace(minute=0) + timedelta(hours=1)
+    if start.minute == 0 and next_hour <= end:
+        return next_hour, "hour"
+    return min(next_hour, end), "minute"
+
+async def fetch_window(start, end, granularity):
+    """Fetch temperature and traffic buckets of one window concurrently."""
+    params = {"start_timestamp": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+              "end_timestamp": end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+              "granularity": granularity}
+    return await asyncio.gather(fetch_rollup(TEMPERATURE_URL, dict(params, group_by="sensor,zone")),
+                                fetch_rollup(TRAFFIC_URL, dict(params, group_by="sensor")))
+
+def populate_stats():
+    """Add the storage rollup buckets closed since the last run to the engine.
+
+    Only whole minutes that ended at least ROLLUP_WATERMARK_S ago are read.
+    Storage stamps events with the time their batch started and commits
+    them later, so a bucket is never added while it may still gain events.
+    A backlog is worked through in sub-windows, oldest first, and a snapshot
+    is saved after each one; if a window keeps failing the run stops and the
+    next run resumes from it.
+    """
+    if not populate_lock.acquire(blocking=False):
+        logger.warning("Previous periodic processing run is still going, skipping this one")
+        return
+    started = time.perf_counter()
+    try:
+        logger.info("Periodic processing has started")
+        last_updated = engine.last_updated or (datetime.now(timezone.utc) - timedelta(minutes=5)).isoformat()
+        start = datetime.fromisoformat(last_updated).replace(second=0, microsecond=0)
+        end = (datetime.now(timezone.utc) - timedelta(seconds=ROLLUP_WATERMARK_S)).replace(second=0, microsecond=0)
+        buckets = 0
+        while start < end:
+            window_end, granularity = next_window(start, end)
+            try:
+                temperature_groups, traffic_groups = run_in_fetch_loop(fetch_window(start, window_end, granularity))
+            except Exception as e:
+                logger.error(f"Fetching rollups from {start} to {window_end} failed ({e})")
+                break
+            for group in temperature_groups:
+                engine.add_temperature_summary(group["count"], group["min"], group["max"], group["sum"],
+                                               group["sensor"], group["zone"])
+            for group in traffic_groups:
+                engine.add_traffic_summary(group["count"], group["min"], group["max"], group["sum"],
+                                           group["sensor"])
+            save_snapshot(window_end.isoformat())
+            buckets += len(temperature_groups) + len(traffic_groups)
+            logger.debug(f"Added {granularity} rollups from {start} to {window_end}")
+            start = window_end
+        logger.info(f"Periodic processing has ended, added {buckets} buckets")
+    finally:
+        metrics.JOB_DURATION.labels("populate_stats").observe(time.perf_counter() - started)
+        populate_lock.release()
 
 @app.route("/stats", methods=["GET"])
 def get_stats():
-    logger.info("Request received for event statistics")
+    """Serve the stats from memory, or 304 if the client already has them."""
+    event_logger.info("Request received for event statistics")
 
-    stats_file = app_config['datastore']['filename']
+    with stats_lock:
+        body, etag, last_modified = current_stats["body"], current_stats["etag"], current_stats["last_modified"]
 
-    if not os.path.exists(stats_file):
+    if body is None:
         logger.error("Statistics do not exist")
         return {"message": "Statistics do not exist"}, 404
 
-    with open(stats_file, 'r') as f:
-        stats = json.load(f)
+    # no-cache makes browsers revalidate with If-None-Match on every poll
+    headers = {"ETag": etag, "Last-Modified": http_date(last_modified), "Cache-Control": "no-cache"}
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag.strip('"'))
+    else:
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not_modified:
+        event_logger.info("Request for event statistics completed, not modified")
+        return Response(status=304, headers=headers)
+
+    event_logger.info("Request for event statistics completed")
+    return Response(body, mimetype="application/json", headers=headers)
 
-    logger.debug(f"Stats content: {stats}")
-    logger.info("Request for event statistics completed")
-    return stats, 200
+def follow_stats():
+    """Serve the stats file whenever the background role saves a newer one."""
+    last_seen = None
+    while not stopping.wait(FOLLOW_INTERVAL_S):
+        try:
+            mtime = os.path.getmtime(stats_file)
+            if mtime == last_seen:
+                continue
+            with open(stats_file, 'r') as f:
+                publish_stats(f.read(), datetime.fromtimestamp(mtime, timezone.utc))
+            last_seen = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read {stats_file} ({e})")
 
 def init_scheduler():
-    sched = BackgroundScheduler(daemon=True)
-    sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['interval'])
-    sched.start()
+    """Restore the last snapshot and start feeding the engine from the configured source.
+
+    Processes in the api role only serve the stats, following the file the
+    background role saves them to.
+    """
+    global sched
+    stats_dir = os.path.dirname(stats_file)
+    if stats_dir and not os.path.exists(stats_dir):
+        os.makedirs(stats_dir)
+        logger.info(f"Created missing directory: {stats_dir}")
+    if engine.load(SNAPSHOT_FILE):
+        logger.info(f"Restored stats snapshot from {SNAPSHOT_FILE} (last updated {engine.last_updated})")
+    if os.path.exists(stats_file):
+        with open(stats_file, 'r') as f:
+            publish_stats(f.read(), datetime.fromtimestamp(os.path.getmtime(stats_file), timezone.utc))
+    elif server.runs_background():
+        # Zeroed stats until the first snapshot, which may be a while coming
+        # as nothing is saved while no events arrive
+        write_stats()
+
+    if not server.runs_background():
+        t = Thread(target=follow_stats)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    elif STATS_SOURCE == 'kafka':
+        t = Thread(target=tail_events)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    else:
+        sched = BackgroundScheduler(daemon=True)
+        sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['interval'],
+                      max_instances=1, coalesce=True)
+        sched.start()
+
+def stop_scheduler():
+    """Stop the background work, saving a last snapshot and committing its offsets."""
+    stopping.set()
+    if sched is not None:
+        sched.shutdown(wait=True)
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT_S
+    for t in threads:
+        t.join(max(0, deadline - time.monotonic()))
 
-app = connexion.FlaskApp(__name__, specification_dir="")
+app = connexion.FlaskApp(__name__, specification_dir="", lifespan=server.lifespan(init_scheduler, stop_scheduler))
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
         CORSMiddleware,
@@ -141,6 +397,9 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_methods=["*"],
         allow_headers=["*"],
     )
+app.add_middleware(StreamMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION,
+                   path="/processing/stats/stream", broadcaster=stream)
+app.add_middleware(metrics.MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/processing/metrics")
 app.add_api(
     "AARONDIMA-Smart-City-App-1.0.0.yaml",
     strict_validation=True,
@@ -149,5 +408,4 @@ app.add_api(
 )
 
 if __name__ == "__main__":
-    init_scheduler()
     app.run(port=8100, host="0.0.0.0")
\ No newline at end of file
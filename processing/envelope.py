@@ -0,0 +1,140 @@
+"""Encoding of the event envelopes carried on the events topic.
+
+Two formats can be on the topic at the same time:
+
+* JSON (legacy): the object {"type", "datetime", "payload"}. It always
+  starts with "{".
+* Binary, version 1: a 10 byte header followed by the payload encoded
+  with MessagePack, zlib-compressed when the format byte says so.
+
+      byte 0     format (FORMAT_MSGPACK or FORMAT_MSGPACK_ZLIB), with
+                 PRODUCED set if bytes 10-17 follow
+      byte 1     event type code, see EVENT_TYPES
+      bytes 2-9  envelope datetime as microseconds since the epoch (UTC)
+      bytes 10-17  optional: when the event was produced, likewise
+
+Consumers look at the first byte to tell the formats apart, so producers can
+switch encoding without the topic being drained first. Both formats decode
+to the same dict.
+
+The envelope datetime is when the receiver accepted the event. `stamp`
+adds the time it is handed to the Kafka producer, which can be much later
+for events that waited in the receiver's spool; decode returns it as
+"produced". Consumers must understand the PRODUCED flag before producers
+stamp events.
+
+decode raises MalformedEnvelope for anything that is not a well-formed
+envelope in either format, so consumers can skip such messages.
+
+This module is shared by the receiver, storage, processing and analyzer
+services; keep the copies identical.
+"""
+import json
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import msgpack
+
+FORMAT_JSON = ord("{")
+FORMAT_MSGPACK = 0x01
+FORMAT_MSGPACK_ZLIB = 0x02
+PRODUCED = 0x80
+HEADER = struct.Struct(">BBq")
+STAMP = struct.Struct(">q")
+
+EVENT_TYPES = {
+    "temperature_condition": 1,
+    "traffic_condition": 2,
+}
+EVENT_NAMES = {code: name for name, code in EVENT_TYPES.items()}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class MalformedEnvelope(ValueError):
+    """A message on the topic that is not an event envelope."""
+
+
+def encode(event_type, payload, timestamp=None, encoding="json", compress_min_bytes=None):
+    """Build the bytes for one event envelope.
+
+    `encoding` is "json" or "msgpack". With msgpack, payloads of at least
+    `compress_min_bytes` bytes are zlib-compressed.
+    """
+    timestamp = timestamp or datetime.now(timezone.utc)
+    if encoding == "json":
+        return json.dumps({
+            "type": event_type,
+            "datetime": timestamp.isoformat(),
+            "payload": payload
+        }).encode("utf-8")
+
+    body = msgpack.packb(payload)
+    fmt = FORMAT_MSGPACK
+    if compress_min_bytes is not None and len(body) >= compress_min_bytes:
+        body = zlib.compress(body)
+        fmt = FORMAT_MSGPACK_ZLIB
+    micros = (timestamp - EPOCH) // _MICROSECOND
+    return HEADER.pack(fmt, EVENT_TYPES[event_type], micros) + body
+
+
+def stamp(data, produced=None):
+    """Return the envelope with its produced time set, to now unless given.
+
+    Binary envelopes only gain an 8 byte field; JSON ones are re-encoded.
+    """
+    produced = produced or datetime.now(timezone.utc)
+    if data[0] == FORMAT_JSON:
+        event = json.loads(data)
+        event["produced"] = produced.isoformat()
+        return json.dumps(event).encode("utf-8")
+    body = data[HEADER.size + STAMP.size:] if data[0] & PRODUCED else data[HEADER.size:]
+    return (bytes((data[0] | PRODUCED,)) + data[1:HEADER.size]
+            + STAMP.pack((produced - EPOCH) // _MICROSECOND) + body)
+
+
+def decode(data):
+    """Decode an envelope in either format to {"type", "datetime", "payload"},
+    plus "produced" if it was stamped."""
+    try:
+        event = _decode(data)
+    except (IndexError, TypeError, ValueError, OverflowError, struct.error, zlib.error, msgpack.UnpackException) as e:
+        raise MalformedEnvelope(f"Cannot decode envelope ({e})") from e
+    if not isinstance(event, dict) or not isinstance(event.get("payload"), dict) \
+            or not isinstance(event.get("type"), str) or not isinstance(event.get("datetime"), str):
+        raise MalformedEnvelope("Envelope has no type, datetime or payload")
+    return event
+
+
+def _decode(data):
+    fmt = data[0]
+    if fmt == FORMAT_JSON:
+        return json.loads(data)
+    fmt, type_code, micros = HEADER.unpack_from(data)
+    produced = None
+    body = data[HEADER.size:]
+    if fmt & PRODUCED:
+        (produced,) = STAMP.unpack_from(data, HEADER.size)
+        body = body[STAMP.size:]
+        fmt &= ~PRODUCED
+    if fmt == FORMAT_MSGPACK_ZLIB:
+        body = zlib.decompress(body)
+    elif fmt != FORMAT_MSGPACK:
+        raise ValueError(f"Unknown envelope format {fmt}")
+    event = {
+        "type": EVENT_NAMES.get(type_code),
+        "datetime": (EPOCH + _MICROSECOND * micros).isoformat(),
+        "payload": msgpack.unpackb(body)
+    }
+    if produced is not None:
+        event["produced"] = (EPOCH + _MICROSECOND * produced).isoformat()
+    return event
+
+
+def event_type(data):
+    """Return just the event type. Binary envelopes are not decoded to do so."""
+    if data[0] == FORMAT_JSON:
+        return json.loads(data).get("type")
+    return EVENT_NAMES.get(data[1])
@@ -0,0 +1,114 @@
+"""Logging setup shared by the services: log_conf.yml applied with
+non-blocking handlers and sampling of per-event messages.
+
+`configure` applies log_conf.yml with logging.config.dictConfig, then puts
+each handler behind a bounded queue drained by its own background thread,
+so writing to the console or a file never happens on the request path.
+Records are queued unformatted: the message is only built, from the format
+string and arguments, by the thread that writes it. When a queue is full,
+records are dropped rather than blocking the caller.
+
+The `queue` section of log_conf.yml controls this:
+
+    queue:
+      enabled: true     # false writes from the calling thread, as before
+      max_size: 10000   # records waiting per handler; more are dropped
+
+Messages logged once per event or request go to the EVENT_LOGGER child of
+basicLogger. Give it a SamplingFilter in log_conf.yml to keep a fraction of
+them, or at most a number per second, and log them with %-style arguments
+rather than f-strings so the ones sampled out are never formatted.
+
+This module is shared by the receiver, storage, processing and analyzer
+services; keep the copies identical.
+"""
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import time
+from threading import Lock
+
+EVENT_LOGGER = "basicLogger.events"
+
+
+class SamplingFilter(logging.Filter):
+    """Keep one in `every` records below WARNING, and at most `per_second` of those a second.
+
+    Warnings and errors always pass.
+    """
+
+    def __init__(self, every=1, per_second=None):
+        super().__init__()
+        self.every = every
+        self.per_second = per_second
+        self.lock = Lock()
+        self.seen = 0
+        self.second = None
+        self.passed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            self.seen += 1
+            if self.seen % self.every:
+                return False
+            if self.per_second is not None:
+                second = int(time.monotonic())
+                if second != self.second:
+                    self.second = second
+                    self.passed = 0
+                if self.passed >= self.per_second:
+                    return False
+                self.passed += 1
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for a writer thread as they are, dropping them when the queue is full.
+
+    Since formatting is deferred, objects passed as arguments should not be
+    changed after they are logged.
+    """
+
+    def __init__(self, records, level):
+        super().__init__(records)
+        self.setLevel(level)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(log_config, service_name):
+    """Apply a log_conf.yml dict, logging to logs/<service_name>.log. Returns the queue handlers."""
+    queue_config = log_config.pop("queue", None) or {}
+    if "file" in log_config["handlers"]:
+        log_config["handlers"]["file"]["filename"] = f"logs/{service_name}.log"
+    logging.config.dictConfig(log_config)
+    if not queue_config.get("enabled", True):
+        return {}
+
+    loggers = [logging.getLogger()] + [logging.getLogger(name) for name in log_config.get("loggers", {})]
+    queued = {}
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            if handler not in queued:
+                queued[handler] = NonBlockingQueueHandler(queue.Queue(queue_config.get("max_size", 10000)),
+                                                          handler.level)
+                listener = logging.handlers.QueueListener(queued[handler].queue, handler,
+                                                          respect_handler_level=True)
+                listener.start()
+                # Write out what is still queued when the service stops
+                atexit.register(listener.stop)
+            logger.removeHandler(handler)
+            logger.addHandler(queued[handler])
+    return queued
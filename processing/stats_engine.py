@@ -0,0 +1,300 @@
+"""Running aggregates of the temperature and traffic readings.
+
+The processing service feeds every reading into a StatsEngine once and keeps
+the aggregates in memory, so a stats cycle costs the same however many events
+have been seen. Snapshots of the engine are saved to disk and reloaded on
+startup.
+
+Each aggregate tracks count, min, max, mean and variance (Welford's method)
+and approximate quantiles from a QuantileSketch. Aggregates can also be fed
+pre-summarized buckets (count, min, max, sum), such as storage's rollups. Those
+carry no spread, so variance and quantiles are reported as null from then on.
+"""
+import json
+import math
+import os
+from threading import Lock
+
+QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+class QuantileSketch:
+    """Streaming quantile estimates with a bounded relative error (DDSketch).
+
+    Values are counted in logarithmically sized bins, so any quantile is
+    returned within `relative_accuracy` of a value that was actually seen,
+    using memory that grows with the range of values instead of their count.
+    """
+
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def _bin(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value):
+        if value > self.MIN_VALUE:
+            index = self._bin(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < -self.MIN_VALUE:
+            index = self._bin(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive))
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": self.positive,
+            "negative": self.negative,
+            "zeros": self.zeros,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        # JSON object keys are strings
+        sketch.positive = {int(index): count for index, count in data["positive"].items()}
+        sketch.negative = {int(index): count for index, count in data["negative"].items()}
+        sketch.zeros = data["zeros"]
+        sketch.count = sum(sketch.positive.values()) + sum(sketch.negative.values()) + sketch.zeros
+        return sketch
+
+
+class RunningStats:
+    """Count, min, max, mean, variance and quantiles of a stream of values."""
+
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.exact = True
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, value):
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.sketch.add(value)
+
+    def add_summary(self, count, low, high, total):
+        """Fold in a bucket of `count` values known only by their min, max and sum."""
+        if not count:
+            return
+        self.mean = (self.mean * self.count + total) / (self.count + count)
+        self.count += count
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.exact = False
+
+    def summary(self):
+        stats = {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean if self.count else None,
+            "variance": self.m2 / self.count if self.count and self.exact else None,
+        }
+        for name, q in QUANTILES.items():
+            stats[name] = self.sketch.quantile(q) if self.exact else None
+        return stats
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "m2": self.m2,
+            "exact": self.exact,
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count = data["count"]
+        stats.min = data["min"]
+        stats.max = data["max"]
+        stats.mean = data["mean"]
+        stats.m2 = data["m2"]
+        stats.exact = data["exact"]
+        stats.sketch = QuantileSketch.from_dict(data["sketch"])
+        return stats
+
+
+class Breakdown:
+    """RunningStats for all values and for each value of the grouping fields."""
+
+    def __init__(self, groups, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.total = RunningStats(relative_accuracy)
+        self.groups = {group: {} for group in groups}
+
+    def _group(self, group, key):
+        stats = self.groups[group].get(key)
+        if stats is None:
+            stats = self.groups[group][key] = RunningStats(self.relative_accuracy)
+        return stats
+
+    def add(self, value, keys):
+        self.total.add(value)
+        for group, key in keys.items():
+            if key is not None:
+                self._group(group, key).add(value)
+
+    def add_summary(self, count, low, high, total, keys):
+        self.total.add_summary(count, low, high, total)
+        for group, key in keys.items():
+            if key is not None:
+                self._group(group, key).add_summary(count, low, high, total)
+
+    def summary(self):
+        stats = self.total.summary()
+        for group, members in self.groups.items():
+            stats[group] = {key: member.summary() for key, member in sorted(members.items())}
+        return stats
+
+    def to_dict(self):
+        return {
+            "total": self.total.to_dict(),
+            "groups": {group: {key: member.to_dict() for key, member in members.items()}
+                       for group, members in self.groups.items()},
+        }
+
+    def load(self, data):
+        self.total = RunningStats.from_dict(data["total"])
+        for group, members in data["groups"].items():
+            self.groups[group] = {key: RunningStats.from_dict(member) for key, member in members.items()}
+
+
+class StatsEngine:
+    """Aggregates of temperature readings (by city zone and sensor) and
+    traffic density (by sensor). Safe to use from several threads."""
+
+    def __init__(self, relative_accuracy=0.01):
+        self.lock = Lock()
+        self.relative_accuracy = relative_accuracy
+        self._clear()
+
+    def _clear(self):
+        self.temperature = Breakdown(("zones", "sensors"), self.relative_accuracy)
+        self.traffic = Breakdown(("sensors",), self.relative_accuracy)
+        self.last_updated = None
+
+    def add_event(self, event_type, payload):
+        """Add one event from the events topic. Other event types are ignored.
+
+        Raises KeyError, TypeError or ValueError, leaving the engine as it
+        was, if the payload has no usable reading.
+        """
+        # Converted first, so a bad reading fails before anything is counted
+        if event_type == "temperature_condition":
+            value = float(payload["temperature"])
+        elif event_type == "traffic_condition":
+            # Densities are whole vehicle counts, as storage keeps them
+            value = int(payload["trafficDensity"])
+        else:
+            return
+        with self.lock:
+            if event_type == "temperature_condition":
+                self.temperature.add(value, {
+                    "zones": payload.get("cityZone"),
+                    "sensors": payload.get("sensorId"),
+                })
+            else:
+                self.traffic.add(value, {
+                    "sensors": payload.get("sensorId"),
+                })
+
+    def add_temperature_summary(self, count, low, high, total, sensor_id, city_zone):
+        with self.lock:
+            self.temperature.add_summary(count, low, high, total, {"zones": city_zone or None,
+                                                                   "sensors": sensor_id})
+
+    def add_traffic_summary(self, count, low, high, total, sensor_id):
+        with self.lock:
+            self.traffic.add_summary(count, low, high, total, {"sensors": sensor_id})
+
+    def summary(self):
+        """The statistics served by /stats."""
+        with self.lock:
+            temperature = self.temperature.summary()
+            traffic = self.traffic.summary()
+            last_updated = self.last_updated
+        return {
+            "num_temperature_readings": temperature["count"],
+            "max_temperature": temperature["max"] or 0,
+            "num_traffic_readings": traffic["count"],
+            "max_traffic_density": int(traffic["max"] or 0),
+            "last_updated": last_updated,
+            "temperature": temperature,
+            "traffic": traffic,
+        }
+
+    def save(self, filename, last_updated=None):
+        """Write a snapshot of the engine, replacing the previous one atomically."""
+        with self.lock:
+            if last_updated is not None:
+                self.last_updated = last_updated
+            data = {
+                "last_updated": self.last_updated,
+                "temperature": self.temperature.to_dict(),
+                "traffic": self.traffic.to_dict(),
+            }
+        with open(filename + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(filename + ".tmp", filename)
+
+    def load(self, filename):
+        """Replace the engine's state with the snapshot written by save().
+
+        Returns False, leaving the engine empty, if there is none.
+        """
+        if not os.path.exists(filename):
+            with self.lock:
+                self._clear()
+            return False
+        with open(filename, "r") as f:
+            data = json.load(f)
+        with self.lock:
+            self._clear()
+            self.last_updated = data["last_updated"]
+            self.temperature.load(data["temperature"])
+            self.traffic.load(data["traffic"])
+        return True
@@ -1,15 +1,24 @@
 import connexion
 from connexion import NoContent
+from connexion.middleware import MiddlewarePosition
 import uuid
 import yaml
 import logging
-import logging.config
+import logging_setup
 from pykafka import KafkaClient
-import datetime
-from datetime import timezone
-import json
+from pykafka.common import CompressionType
+from pykafka.exceptions import ProducerQueueFullError
+from pykafka.partitioners import hashing_partitioner
+import random
+import time
+from threading import Event, Lock, Thread
 import os
+from queue import Empty, Full, Queue
 from dotenv import load_dotenv
+from spool import Spool
+import envelope
+import metrics
+import server
 
 load_dotenv()
 
@@ -24,11 +33,10 @@ log_conf_file = os.getenv("LOG_CONF_FILE", "/app/log_conf.yml")
 with open(log_conf_file, "r") as f:
     log_config = yaml.safe_load(f.read())
 service_name = os.getenv("SERVICE_NAME", "default_service")
-log_file_path = f"logs/{service_name}.log"
-if "file" in log_config["handlers"]:
-    log_config["handlers"]["file"]["filename"] = log_file_path
-logging.config.dictConfig(log_config)
+logging_setup.configure(log_config, service_name)
 logger = logging.getLogger('basicLogger')
+# Once per event or request; sampled as configured in log_conf.yml
+event_logger = logging.getLogger(logging_setup.EVENT_LOGGER)
 
 logger = logging.getLogger('basicLogger')
 # def report_temperature(body):
@@ -52,46 +60,407 @@ logger = logging.getLogger('basicLogger')
 KAFKA_HOST = app_config['events']['hostname']
 KAFKA_PORT = app_config['events']['port']
 KAFKA_TOPIC = app_config['events']['topic']
+ENCODING = app_config['events'].get('encoding', 'json')
+COMPRESS_MIN_BYTES = app_config['events'].get('compress_min_bytes')
+PRODUCER_CONFIG = app_config['events'].get('producer', {})
+PRODUCER_MODE = PRODUCER_CONFIG.get('mode', 'sync')
+RETRY_AFTER = str(PRODUCER_CONFIG.get('retry_after', 1))
+PARTITION_KEY = PRODUCER_CONFIG.get('partition_key', 'sensorId')
+COMPRESSION = {
+    "none": CompressionType.NONE,
+    "gzip": CompressionType.GZIP,
+    "snappy": CompressionType.SNAPPY,
+    "lz4": CompressionType.LZ4,
+}
+BATCH_CONFIG = app_config['events'].get('batch', {})
+BATCH_LINGER_MS = BATCH_CONFIG.get('linger_ms', 5)
+BATCH_TIMEOUT_S = BATCH_CONFIG.get('timeout_ms', 10000) / 1000
+SPOOL_CONFIG = app_config.get('spool', {})
+REPLAY_RATE = SPOOL_CONFIG.get('replay_rate', 1000)
 print(KAFKA_HOST, KAFKA_PORT, KAFKA_TOPIC)
-client = KafkaClient(hosts=f'{KAFKA_HOST}:{KAFKA_PORT}')
-topic = client.topics[str.encode(KAFKA_TOPIC)]
-producer = topic.get_sync_producer()
 
-def report_temperature(body):
-    """Forward temperature event to Kafka."""
+# Opened when the process starts serving; every worker process has its own
+spool = None
+
+# Kafka is connected in the background so startup never waits on the broker.
+# Until it is up, and until everything spooled earlier has been replayed,
+# new events are appended to the spool so the topic keeps their order.
+topic = None
+producer = None
+batch_producer = None
+replay_producer = None
+spooling = True
+spool_lock = Lock()
+stopping = Event()
+drainer = None
+# In async mode request threads leave events here for the forwarder, which
+# is the only thread producing them: pykafka hands each delivery report to
+# the thread that produced the message, so only it learns of failed ones.
+outbox = Queue(maxsize=PRODUCER_CONFIG.get('max_queued_messages', 10000))
+forwarder = None
+produce_latency = metrics.KAFKA_PRODUCE_LATENCY.labels(PRODUCER_MODE)
+batch_produce_latency = metrics.KAFKA_PRODUCE_LATENCY.labels("batch")
+replay_produce_latency = metrics.KAFKA_PRODUCE_LATENCY.labels("replay")
+
+def sensor_partitioner(partitions, key):
+    """Send all events with the same key to the same partition, so consumers
+    see each sensor's events in order. Events without a key are spread out."""
+    if key is None:
+        return random.choice(list(partitions))
+    return hashing_partitioner(partitions, key)
+
+def partition_key(body):
+    """The Kafka key of an event: its PARTITION_KEY field, or None when unset."""
+    value = body.get(PARTITION_KEY) if PARTITION_KEY else None
+    return None if value is None else str(value).encode()
+
+def build_producer():
+    """Create the producer used for single events.
+
+    In sync mode every request waits for the broker to acknowledge the write.
+    In async mode the forwarder produces the messages and a background worker
+    flushes them in batches; the producer reports the delivery of each one so
+    messages it gives up on are spooled. When its queue is full the forwarder
+    waits, and requests find the outbox full instead.
+    """
+    if PRODUCER_MODE == 'sync':
+        return topic.get_sync_producer(partitioner=sensor_partitioner)
+    return topic.get_producer(
+        delivery_reports=True,
+        partitioner=sensor_partitioner,
+        min_queued_messages=PRODUCER_CONFIG.get('batch_size', 1000),
+        linger_ms=PRODUCER_CONFIG.get('linger_ms', 10),
+        compression=COMPRESSION[PRODUCER_CONFIG.get('compression', 'none')],
+        max_queued_messages=PRODUCER_CONFIG.get('max_queued_messages', 10000),
+        block_on_queue_full=True
+    )
+
+def build_batch_producer():
+    """Create a producer that reports delivery of each message.
+
+    Batches are queued in one go and flushed together by the producer worker;
+    delivery reports are thread-local, so each caller only sees its own.
+    """
+    return topic.get_producer(delivery_reports=True,
+                              partitioner=sensor_partitioner,
+                              linger_ms=BATCH_LINGER_MS,
+                              min_queued_messages=BATCH_CONFIG.get('max_items', 500),
+                              compression=COMPRESSION[PRODUCER_CONFIG.get('compression', 'none')],
+                              max_queued_messages=PRODUCER_CONFIG.get('max_queued_messages', 10000),
+                              block_on_queue_full=False)
+
+def connect_kafka():
+    """Connect to Kafka, retrying with backoff until the broker is reachable."""
+    global topic, producer, batch_producer, replay_producer
+    delay = 1
+    while True:
+        try:
+            client = KafkaClient(hosts=f'{KAFKA_HOST}:{KAFKA_PORT}')
+            kafka_topic = client.topics[str.encode(KAFKA_TOPIC)]
+            break
+        except Exception as e:
+            logger.warning(f"Kafka is not available ({e}), retrying in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+    topic = kafka_topic
+    producer = build_producer()
+    batch_producer = build_batch_producer()
+    replay_producer = build_batch_producer()
+    logger.info(f"Connected to Kafka at {KAFKA_HOST}:{KAFKA_PORT}")
+
+def spool_message(msg, key=None):
+    """Append a message to the spool and keep spooling until the drainer catches up.
+
+    Returns 202 if the message was spooled or 503 if the spool is full.
+    """
+    global spooling
+    with spool_lock:
+        spooling = True
+        if spool.append(msg, key):
+            return 202
+    logger.error("Spool is full, rejecting event")
+    return 503
+
+def send_message(msg, key=None):
+    """Hand a message to Kafka, or to the spool while Kafka cannot take it.
+
+    Returns 201 if the producer took the message, 202 if it was spooled and
+    503 if there was no room for it in either.
+    """
+    if spooling:
+        return spool_message(msg, key)
+    if PRODUCER_MODE != 'sync':
+        try:
+            outbox.put_nowait((msg, key))
+            return 201
+        except Full:
+            return 503
+    try:
+        started = time.perf_counter()
+        producer.produce(envelope.stamp(msg), partition_key=key)
+        produce_latency.observe(time.perf_counter() - started)
+        return 201
+    except ProducerQueueFullError:
+        return 503
+    except Exception as e:
+        logger.error(f"Kafka produce failed ({e}), spooling events until it recovers")
+        return spool_message(msg, key)
+
+def forward_messages():
+    """Produce the events in the outbox, and spool the ones Kafka fails to deliver.
+
+    Once the process stops it empties the outbox, then flushes the producer
+    and spools whatever could not be delivered.
+    """
+    while not (stopping.is_set() and outbox.empty()):
+        try:
+            msg, key = outbox.get(timeout=0.1)
+        except Empty:
+            pass
+        else:
+            try:
+                started = time.perf_counter()
+                producer.produce(envelope.stamp(msg), partition_key=key)
+                produce_latency.observe(time.perf_counter() - started)
+            except Exception as e:
+                logger.error(f"Kafka produce failed ({e}), spooling events until it recovers")
+                spool_message(msg, key)
+        spool_failed_deliveries()
+    if producer is not None:
+        producer.stop()
+        spool_failed_deliveries()
+
+def spool_failed_deliveries():
+    """Spool the events the async producer has given up on since the last call."""
+    if producer is None:
+        return
+    failed = 0
+    while True:
+        try:
+            delivered, exc = producer.get_delivery_report(block=False)
+        except Empty:
+            break
+        if exc is not None:
+            failed += 1
+            error = exc
+            spool_message(delivered.value, delivered.partition_key)
+    if failed:
+        logger.error(f"Kafka failed to deliver {failed} events ({error}), spooling events until it recovers")
+
+def deliver(records):
+    """Produce spooled records and wait until Kafka has acknowledged all of them.
+
+    Reports are matched to messages by their stamped envelope, which holds
+    the event's trace id and the time it was produced, so reports left over
+    from an earlier attempt are ignored. Raises TimeoutError if the records
+    are not all acknowledged within BATCH_TIMEOUT_S.
+    """
+    started = time.perf_counter()
+    deadline = time.monotonic() + BATCH_TIMEOUT_S
+    pending = set()
+    for key, value in records:
+        stamped = envelope.stamp(value)
+        replay_producer.produce(stamped, partition_key=key)
+        pending.add(stamped)
+    while pending:
+        try:
+            delivered, exc = replay_producer.get_delivery_report(block=True,
+                                                                 timeout=max(0, deadline - time.monotonic()))
+        except Empty:
+            raise TimeoutError(f"{len(pending)} events were not acknowledged in time")
+        if delivered.value not in pending:
+            continue
+        if exc is not None:
+            raise exc
+        pending.discard(delivered.value)
+    replay_produce_latency.observe(time.perf_counter() - started)
+    metrics.BATCH_SIZE.labels("replay").observe(len(records))
+
+def drain_spool():
+    """Replay spooled events into Kafka in order, at most REPLAY_RATE per second."""
+    global spooling
+    while not stopping.is_set():
+        if replay_producer is None:
+            time.sleep(1)
+            continue
+        with spool_lock:
+            if spool.is_empty():
+                if spooling:
+                    logger.info("Spool drained, sending events to Kafka directly")
+                spooling = False
+        if not spooling:
+            time.sleep(0.5)
+            continue
+
+        started = time.monotonic()
+        records, position = spool.read(REPLAY_RATE)
+        try:
+            deliver(records)
+        except Exception as e:
+            logger.warning(f"Replaying spooled events failed ({e}), retrying")
+            time.sleep(1)
+            continue
+        spool.advance(position)
+        logger.info(f"Replayed {len(records)} spooled events, {spool.depth()['messages']} remaining")
+        time.sleep(max(0, 1 - (time.monotonic() - started)))
+
+def init_kafka():
+    """Open this process's spool, then start the Kafka connection and the spool drainer in background threads.
+
+    Each worker process spools to a directory of its own, and replays it
+    with its own producer, so the events of a worker keep their order.
+    """
+    global spool, drainer, forwarder
+    spool = Spool(server.worker_directory(SPOOL_CONFIG.get('directory', 'spool')),
+                  segment_bytes=SPOOL_CONFIG.get('segment_bytes', 16 * 1024 * 1024),
+                  max_bytes=SPOOL_CONFIG.get('max_bytes', 1024 * 1024 * 1024),
+                  fsync=SPOOL_CONFIG.get('fsync', 'interval'),
+                  fsync_interval_ms=SPOOL_CONFIG.get('fsync_interval_ms', 1000))
+    t = Thread(target=connect_kafka)
+    t.daemon = True
+    t.start()
+    drainer = Thread(target=drain_spool)
+    drainer.daemon = True
+    drainer.start()
+    if PRODUCER_MODE != 'sync':
+        forwarder = Thread(target=forward_messages)
+        forwarder.daemon = True
+        forwarder.start()
+
+def stop_producers():
+    """Flush anything still queued once the process has stopped serving."""
+    logger.info("Flushing Kafka producers")
+    stopping.set()
+    # Let a replay in progress finish, so it is not replayed again on restart
+    drainer.join(BATCH_TIMEOUT_S)
+    # and the forwarder spool what the async producer could not deliver
+    if forwarder is not None:
+        forwarder.join(BATCH_TIMEOUT_S)
+    with spool_lock:
+        for p in (producer, batch_producer, replay_producer):
+            if p is not None:
+                p.stop()
+        spool.close()
+
+EVENT_FIELDS = {
+    "temperature_condition": ("sensorId", "timestamp", "temperature"),
+    "traffic_condition": ("sensorId", "timestamp", "trafficDensity"),
+}
+
+def build_message(event_type, body):
+    """Attach a trace id to the event and wrap it in the Kafka envelope."""
     trace_id = str(uuid.uuid4())
     body["trace_id"] = trace_id
-    msg = {
-        "type": "temperature_condition",
-        "datetime": datetime.datetime.now(timezone.utc).isoformat(),
-        "payload": body
-    }
-
-    logger.info(f"Received event temperature_condition with a trace id of {trace_id}")
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
-    
-    logger.info(f"Event temperature_condition (id: {trace_id}) sent to Kafka")
+    msg = envelope.encode(event_type, body,
+                          encoding=ENCODING,
+                          compress_min_bytes=COMPRESS_MIN_BYTES)
+    return trace_id, msg
+
+def report_temperature(body):
+    """Forward temperature event to Kafka."""
+    trace_id, msg = build_message("temperature_condition", body)
+    event_logger.info("Received event temperature_condition with a trace id of %s", trace_id)
+    status = send_message(msg, partition_key(body))
+    if status == 503:
+        logger.warning(f"No room to queue event {trace_id}, rejecting it")
+        return {"message": "Event queue is full, retry later"}, 503, {"Retry-After": RETRY_AFTER}
+
+    event_logger.info("Event temperature_condition (id: %s) %s", trace_id, "sent to Kafka" if status == 201 else "spooled")
     return NoContent, 201  # Return HTTP 201 Created
 
 def report_traffic(body):
     """Forward traffic event to Kafka."""
-    trace_id = str(uuid.uuid4())
-    body["trace_id"] = trace_id
-    msg = {
-        "type": "traffic_condition",
-        "datetime": datetime.datetime.now(timezone.utc).isoformat(),
-        "payload": body
-    }
-
-    logger.info(f"Received event temperature_condition with a trace id of {trace_id}")
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
-    
-    logger.info(f"Event traffic_condition (id: {trace_id}) sent to Kafka")
+    trace_id, msg = build_message("traffic_condition", body)
+    event_logger.info("Received event traffic_condition with a trace id of %s", trace_id)
+    status = send_message(msg, partition_key(body))
+    if status == 503:
+        logger.warning(f"No room to queue event {trace_id}, rejecting it")
+        return {"message": "Event queue is full, retry later"}, 503, {"Retry-After": RETRY_AFTER}
+
+    event_logger.info("Event traffic_condition (id: %s) %s", trace_id, "sent to Kafka" if status == 201 else "spooled")
     return NoContent, 201  # Return HTTP 201 Created
 
-app = connexion.FlaskApp(__name__, specification_dir="")
+def produce_batch(events):
+    """Send a list of (event_type, payload) pairs to Kafka as one batch.
+
+    Returns one result per event, in the order they were given.
+    """
+    results = [None] * len(events)
+    pending = {}
+    metrics.BATCH_SIZE.labels("receive_batch").observe(len(events))
+    started = time.perf_counter()
+    for index, (event_type, payload) in enumerate(events):
+        missing = [field for field in EVENT_FIELDS[event_type] if field not in payload]
+        if missing:
+            results[index] = {"index": index, "status": 400,
+                              "error": f"Missing fields for {event_type}: {', '.join(missing)}"}
+            continue
+        trace_id, msg = build_message(event_type, payload)
+        key = partition_key(payload)
+        results[index] = {"index": index, "trace_id": trace_id, "status": 201}
+        if spooling:
+            results[index]["status"] = spool_message(msg, key)
+            continue
+        try:
+            stamped = envelope.stamp(msg)
+            batch_producer.produce(stamped, partition_key=key)
+            pending[stamped] = (index, msg, key)
+        except ProducerQueueFullError:
+            results[index]["status"] = 503
+        except Exception as e:
+            logger.error(f"Failed to queue event {trace_id} ({e}), spooling it")
+            results[index]["status"] = spool_message(msg, key)
+
+    # Reports are matched by stamped envelope, as in deliver; ones from an
+    # earlier batch that timed out are ignored
+    deadline = time.monotonic() + BATCH_TIMEOUT_S
+    while pending:
+        try:
+            delivered, exc = batch_producer.get_delivery_report(block=True,
+                                                                timeout=max(0, deadline - time.monotonic()))
+        except Empty:
+            logger.error(f"Timed out waiting for {len(pending)} delivery reports, spooling them")
+            for index, msg, key in pending.values():
+                results[index]["status"] = spool_message(msg, key)
+            break
+        entry = pending.pop(delivered.value, None)
+        if entry is not None and exc is not None:
+            logger.error(f"Delivery of event {results[entry[0]]['trace_id']} failed ({exc}), spooling it")
+            results[entry[0]]["status"] = spool_message(entry[1], entry[2])
+    batch_produce_latency.observe(time.perf_counter() - started)
+
+    for result in results:
+        if result["status"] == 503:
+            result["error"] = "Event queue is full, retry later"
+    failed = sum(1 for result in results if result["status"] not in (201, 202))
+    event_logger.info("Batch of %d events received (%d failed)", len(events), failed)
+    summary = {"accepted": len(events) - failed, "rejected": failed, "results": results}
+    if any(result["status"] == 503 for result in results):
+        return summary, 207, {"Retry-After": RETRY_AFTER}
+    return summary, 201 if failed == 0 else 207
+
+def get_spool():
+    """Report how many events are waiting in the spool."""
+    depth = spool.depth()
+    depth["spooling"] = spooling
+    depth["kafka_connected"] = topic is not None
+    return depth, 200
+
+def report_temperature_batch(body):
+    """Forward a batch of temperature events to Kafka."""
+    return produce_batch([("temperature_condition", event) for event in body])
+
+def report_traffic_batch(body):
+    """Forward a batch of traffic events to Kafka."""
+    return produce_batch([("traffic_condition", event) for event in body])
+
+def report_events_batch(body):
+    """Forward a batch of mixed temperature and traffic events to Kafka."""
+    return produce_batch([(item["type"], item["payload"]) for item in body])
+
+# Every process of the receiver produces on its own, so all roles do the same
+app = connexion.FlaskApp(__name__, specification_dir="", lifespan=server.lifespan(init_kafka, stop_producers))
+app.add_middleware(metrics.MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/receiver/metrics")
 app.add_api("AARONDIMA-Smart-City-App-1.0.0.yaml", strict_validation=True, base_path="/receiver", validate_responses=True)
 
 if __name__ == "__main__":
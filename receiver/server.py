@@ -0,0 +1,117 @@
+"""Production entry point: the service's app under uvicorn, in one or more worker processes.
+
+    SERVICE_ROLE=api WORKERS=4 python server.py
+
+Settings come from the `server` section of app_conf.yml; the WORKERS and
+PORT environment variables override it:
+
+    server:
+      port: 8090
+      workers: 1              # worker processes
+      graceful_timeout_s: 30  # how long shutdown waits for requests in flight
+
+SERVICE_ROLE says what a process does besides answering requests:
+
+    all  (default) also runs the service's background work: the Kafka
+         consumers, the analyzer's indexer and the processing scheduler.
+         That work must only run once, so this role runs a single worker.
+    api  only answers requests, and may run any number of workers. State
+         kept by the background work is read from the files it writes.
+
+Apps pass their startup and shutdown to `lifespan`, so nothing connects to
+Kafka or the database or opens state files until a worker starts serving,
+and on SIGTERM the requests in flight are answered before producers are
+flushed and consumer offsets committed.
+
+With several workers, Prometheus metrics are gathered across the worker
+processes through PROMETHEUS_MULTIPROC_DIR (a temporary directory if
+unset; it is emptied at startup).
+
+This module is shared by the receiver, storage, processing and analyzer
+services; keep the copies identical.
+"""
+import asyncio
+import contextlib
+import fcntl
+import glob
+import os
+import sys
+import tempfile
+
+import yaml
+
+ROLES = ("all", "api")
+ROLE = os.getenv("SERVICE_ROLE", "all")
+if ROLE not in ROLES:
+    raise ValueError(f"SERVICE_ROLE must be one of {', '.join(ROLES)}, not {ROLE!r}")
+
+# Lock files of the worker directories this process holds, kept open until it exits
+_claimed = []
+
+
+def runs_background():
+    """Whether this process runs the service's background work."""
+    return ROLE == "all"
+
+
+def lifespan(start, stop):
+    """An ASGI lifespan calling `start()` before the app serves and `stop()` once it has stopped."""
+    @contextlib.asynccontextmanager
+    async def run(app):
+        await asyncio.to_thread(start)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(stop)
+    return run
+
+
+def worker_directory(directory):
+    """A directory under `directory` that no other live process of the service uses.
+
+    Worker processes claim numbered slots, lowest free first, so state left
+    by a worker is picked up by whichever worker takes its slot after a
+    restart. Slot 0 is `directory` itself, so a single worker uses the same
+    files as before.
+    """
+    os.makedirs(directory, exist_ok=True)
+    slot = 0
+    while True:
+        lock = open(os.path.join(directory, f".worker-{slot}.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            lock.close()
+            slot += 1
+    _claimed.append(lock)
+    if slot == 0:
+        return directory
+    path = os.path.join(directory, f"worker-{slot}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def main():
+    with open(os.getenv("APP_CONF_FILE", "/app/app_conf.yml"), "r") as f:
+        config = yaml.safe_load(f).get("server", {})
+    workers = int(os.getenv("WORKERS", config.get("workers", 1)))
+    if ROLE == "all" and workers > 1:
+        sys.exit("SERVICE_ROLE=all runs the background work, which must only run once. "
+                 "Run more workers with SERVICE_ROLE=api.")
+    if workers > 1:
+        # Read by prometheus_client when the workers import it
+        directory = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="prometheus-"))
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+    import uvicorn
+    uvicorn.run("app:app",
+                host=config.get("host", "0.0.0.0"),
+                port=int(os.getenv("PORT", config.get("port", 8080))),
+                workers=workers,
+                timeout_graceful_shutdown=config.get("graceful_timeout_s", 30))
+
+
+if __name__ == "__main__":
+    main()
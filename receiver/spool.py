@@ -0,0 +1,176 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Each record is: crc32, key length, value length, key bytes, value bytes.
+# The crc covers the key and value so a torn write at the tail of a segment
+# is detected (and cut off) when the spool is reopened.
+HEADER = struct.Struct(">III")
+SEGMENT_SUFFIX = ".log"
+POSITION_FILE = "position"
+
+
+class Spool:
+    """Append-only, segmented on-disk log of Kafka records.
+
+    The receiver appends here while Kafka cannot take writes, and a drainer
+    reads the records back in order with `read()` and acknowledges them with
+    `advance()` once they have been delivered. Fully drained segments are
+    deleted.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024,
+                 fsync="interval", fsync_interval_ms=1000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.lock = threading.Lock()
+        self.last_fsync = time.monotonic()
+        self.messages = 0
+        self.bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.read_segment, self.read_offset = self._load_position()
+        segments = self._segments()
+        self.write_segment = segments[-1] if segments else self.read_segment
+        for segment in segments:
+            if segment < self.read_segment:
+                os.remove(self._path(segment))
+            else:
+                self._scan(segment)
+        self.writer = open(self._path(self.write_segment), "ab")
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE), "r") as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (FileNotFoundError, ValueError):
+            return 0, 0
+
+    def _save_position(self):
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{self.read_segment} {self.read_offset}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _scan(self, segment):
+        """Count the unread records in a segment and truncate any torn tail."""
+        start = self.read_offset if segment == self.read_segment else 0
+        valid_end = 0
+        with open(self._path(segment), "rb") as f:
+            for _, _, end in self._records(f, 0):
+                if end > start:
+                    self.messages += 1
+                    self.bytes += end - valid_end
+                valid_end = end
+            size = f.seek(0, os.SEEK_END)
+        if size > valid_end:
+            with open(self._path(segment), "r+b") as f:
+                f.truncate(valid_end)
+
+    def _records(self, f, offset, limit=None):
+        """Yield (key, value, end_offset) for each valid record from offset."""
+        f.seek(offset)
+        count = 0
+        while limit is None or count < limit:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            crc, key_len, value_len = HEADER.unpack(header)
+            data = f.read(key_len + value_len)
+            if len(data) < key_len + value_len or zlib.crc32(data) != crc:
+                return
+            offset += HEADER.size + len(data)
+            count += 1
+            yield data[:key_len] or None, data[key_len:], offset
+
+    def _maybe_fsync(self):
+        if self.fsync == "always" or (
+                self.fsync == "interval" and time.monotonic() - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.writer.fileno())
+            self.last_fsync = time.monotonic()
+
+    def append(self, value, key=None):
+        """Append a record. Returns False if the spool is full."""
+        key = key or b""
+        data = key + value
+        record = HEADER.pack(zlib.crc32(data), len(key), len(value)) + data
+        with self.lock:
+            if self.bytes + len(record) > self.max_bytes:
+                return False
+            if self.writer.tell() >= self.segment_bytes:
+                self.writer.close()
+                self.write_segment += 1
+                self.writer = open(self._path(self.write_segment), "ab")
+            self.writer.write(record)
+            self.writer.flush()
+            self._maybe_fsync()
+            self.messages += 1
+            self.bytes += len(record)
+        return True
+
+    def is_empty(self):
+        return self.messages == 0
+
+    def read(self, limit):
+        """Return up to `limit` unread records as (key, value) pairs, oldest first,
+        along with the position to pass to `advance()` once they are delivered."""
+        records = []
+        size = 0
+        segment, offset = self.read_segment, self.read_offset
+        while len(records) < limit and segment <= self.write_segment:
+            try:
+                with open(self._path(segment), "rb") as f:
+                    for key, value, end in self._records(f, offset, limit - len(records)):
+                        records.append((key, value))
+                        size += end - offset
+                        offset = end
+            except FileNotFoundError:
+                pass
+            if len(records) < limit and segment < self.write_segment:
+                segment, offset = segment + 1, 0
+            else:
+                break
+        return records, (segment, offset, len(records), size)
+
+    def advance(self, position):
+        """Mark the records returned by a `read()` as delivered."""
+        segment, offset, count, size = position
+        with self.lock:
+            for old in range(self.read_segment, segment):
+                try:
+                    os.remove(self._path(old))
+                except FileNotFoundError:
+                    pass
+            self.read_segment, self.read_offset = segment, offset
+            self.messages -= count
+            self.bytes -= size
+            self._save_position()
+
+    def depth(self):
+        with self.lock:
+            return {
+                "messages": self.messages,
+                "bytes": self.bytes,
+                "segments": self.write_segment - self.read_segment + 1,
+            }
+
+    def close(self):
+        with self.lock:
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.writer.close()
@@ -1,21 +1,36 @@
 import connexion
-from connexion import NoContent
-from datetime import datetime
+from connexion.datastructures import MediaTypeDict
+from connexion.middleware import MiddlewarePosition
+from connexion.validators import VALIDATOR_MAP, AbstractResponseBodyValidator
+from datetime import datetime, timezone
 import functools
+import itertools
+import base64
 import json
-from threading import Thread
+from collections import OrderedDict
+import envelope
+import metrics
+from threading import Event, Lock, Thread
+import socket
+import time
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
 import logging
-import logging.config
+import logging_setup
 import yaml
 from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy import and_, insert, or_, select
+from sqlalchemy.exc import OperationalError
 from database import engine, get_db
-from models import Base, TemperatureEvent, TrafficEvent
-from flask import jsonify
+from models import Base, TemperatureEvent, TemperatureRollup, TrafficEvent, TrafficRollup
+import rollups
+import partitions
+import latency
+import result_cache
+import export
+from flask import Response, jsonify, request
 import os
-Base.metadata.create_all(bind=engine)
+import server
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -25,20 +40,79 @@ with open(app_conf_file, 'r') as f:
 # Configurations from app_conf.yml
 KAFKA_HOST = app_config['events']['hostname'] + ":" + str(app_config['events']['port'])
 KAFKA_TOPIC = app_config['events']['topic']
+CONSUMER_CONFIG = app_config['events'].get('consumer', {})
+BATCH_SIZE = CONSUMER_CONFIG.get('batch_size', 500)
+FLUSH_INTERVAL_MS = CONSUMER_CONFIG.get('flush_interval_ms', 200)
+DEDUP_CACHE_SIZE = CONSUMER_CONFIG.get('dedup_cache_size', 100000)
+CONSUMER_MODE = CONSUMER_CONFIG.get('mode', 'balanced')
+CONSUMER_WORKERS = CONSUMER_CONFIG.get('workers', 2)
+CONSUMER_GROUP = CONSUMER_CONFIG.get('group', 'event_group').encode()
+LAG_INTERVAL_S = CONSUMER_CONFIG.get('lag_interval_ms', 5000) / 1000
+STREAM_CHUNK_SIZE = app_config.get('queries', {}).get('stream_chunk_size', 1000)
+NDJSON = "application/x-ndjson"
+RETENTION_CONFIG = app_config.get('retention', {})
+EVENT_RETENTION_DAYS = RETENTION_CONFIG.get('event_days', 30)
+MINUTE_ROLLUP_RETENTION_DAYS = RETENTION_CONFIG.get('minute_rollup_days', 7)
+PARTITION_DAYS = RETENTION_CONFIG.get('partition_days', 1)
+PARTITIONS_AHEAD = RETENTION_CONFIG.get('partitions_ahead', 7)
+RETENTION_INTERVAL_S = RETENTION_CONFIG.get('check_interval_s', 3600)
+LATENCY_CONFIG = app_config.get('latency', {})
+CACHE_CONFIG = app_config.get('cache', {})
+EXPORT_CONFIG = app_config.get('export', {})
+EXPORT_BATCH_ROWS = EXPORT_CONFIG.get('batch_rows', 50000)
+EXPORT_COMPRESSION = EXPORT_CONFIG.get('compression', 'zstd')
+# How long shutdown waits for the background work, as server.py waits for requests
+GRACEFUL_TIMEOUT_S = app_config.get('server', {}).get('graceful_timeout_s', 30)
 
 log_conf_file = os.getenv("LOG_CONF_FILE", "/app/log_conf.yml")
 with open(log_conf_file, 'r') as f:
     log_config = yaml.safe_load(f)
 service_name = os.getenv("SERVICE_NAME", "default_service")
-log_file_path = f"logs/{service_name}.log"
-if "file" in log_config["handlers"]:
-    log_config["handlers"]["file"]["filename"] = log_file_path
-logging.config.dictConfig(log_config)
+logging_setup.configure(log_config, service_name)
 logger = logging.getLogger('basicLogger')
+# Once per event or request; sampled as configured in log_conf.yml
+event_logger = logging.getLogger(logging_setup.EVENT_LOGGER)
+
+consumer_stats = {
+    "batches": 0,
+    "events": 0,
+    "last_batch_size": 0,
+    "max_batch_size": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "total_flush_ms": 0.0,
+    "duplicates_dropped": 0,
+}
+# Per worker thread: held partitions, their lag and what the worker stored
+worker_stats = {}
+consumer_stats_lock = Lock()
+# Set on shutdown; the consumer and retention threads finish what they are doing and exit
+stopping = Event()
+threads = []
+# Partitioned event tables check_partitioned has already warned about
+partitioned_tables = set()
+# Bound once, since they are updated for every event or batch
+consume_lag = metrics.CONSUME_LAG.labels("storage")
+batch_sizes = metrics.BATCH_SIZE.labels("store_batch")
+store_latency = metrics.DB_TRANSACTION.labels("store_batch")
+# Responses of event queries over windows that can no longer change
+results = result_cache.ResultCache(max_bytes=CACHE_CONFIG.get('max_bytes', 64 * 1024 * 1024),
+                                   watermark_s=CACHE_CONFIG.get('watermark_s', 60),
+                                   retention_s=EVENT_RETENTION_DAYS * 24 * 3600,
+                                   directory=CACHE_CONFIG.get('directory'),
+                                   disk_max_bytes=CACHE_CONFIG.get('disk_max_bytes', 1024 * 1024 * 1024))
+# Per-stage latency from the receiver to a committed row, served at /latency
+hops = latency.HopTracker(window_s=LATENCY_CONFIG.get('window_s', 300),
+                          max_samples=LATENCY_CONFIG.get('max_samples', 100000),
+                          timelines=LATENCY_CONFIG.get('timelines', 10000))
 
 
 def parse_timestamp(timestamp_str):
-    return datetime.fromisoformat(timestamp_str.replace("Z", ""))  
+    """Parse an ISO 8601 timestamp into a naive UTC datetime, as stored."""
+    dt = datetime.fromisoformat(timestamp_str.replace("Z", ""))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
 
 def use_db_session(func):
     @functools.wraps(func)
@@ -50,126 +124,588 @@ def use_db_session(func):
             db.close()
     return wrapper
 
-@use_db_session
-def report_temperature(db: Session, body):
-    """Store a temperature event in the database."""
-    logger.info(body)
-    event = TemperatureEvent(
-        event_id=body.get("eventID"),
-        sensor_id=body.get("sensorId"),
-        temperature=body.get("temperature"),
-        timestamp=parse_timestamp(body.get("timestamp")),
-        city_zone=body.get("cityZone"),
-        trace_id=body.get("trace_id")
-    )
-    db.add(event)
-    db.commit()
-    logger.debug(f"Stored event temperature_condition with a trace id of {event.trace_id}")
-    return NoContent, 200
+def temperature_row(body):
+    """Map a temperature event payload to a temperature_events row."""
+    return {
+        "event_id": body.get("eventID", body.get("trace_id")),
+        "sensor_id": body.get("sensorId"),
+        "temperature": body.get("temperature"),
+        "timestamp": parse_timestamp(body.get("timestamp")),
+        "city_zone": body.get("cityZone"),
+        "trace_id": body.get("trace_id")
+    }
+
+def traffic_row(body):
+    """Map a traffic event payload to a traffic_events row."""
+    return {
+        "event_id": body.get("eventID", body.get("trace_id")),
+        "sensor_id": body.get("sensorId"),
+        "traffic_density": body.get("trafficDensity"),
+        "timestamp": parse_timestamp(body.get("timestamp")),
+        "incident_report": body.get("incidentReport"),
+        "trace_id": body.get("trace_id")
+    }
+
+class RecentIds:
+    """Bounded set of recently stored trace ids, evicting the least recently seen."""
+
+    def __init__(self, size):
+        self.size = size
+        self.ids = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, trace_id):
+        with self.lock:
+            if trace_id in self.ids:
+                self.ids.move_to_end(trace_id)
+                return True
+            return False
+
+    def add_all(self, trace_ids):
+        with self.lock:
+            for trace_id in trace_ids:
+                self.ids[trace_id] = None
+                self.ids.move_to_end(trace_id)
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+recent_ids = RecentIds(DEDUP_CACHE_SIZE)
+
+def insert_new(db: Session, model, rows):
+    """Insert rows whose trace_id is not stored yet. Returns the rows that were new."""
+    if not rows:
+        return []
+    existing = set(db.execute(
+        select(model.trace_id).where(model.trace_id.in_([row["trace_id"] for row in rows]))
+    ).scalars())
+    new_rows = [row for row in rows if row["trace_id"] not in existing]
+    if new_rows:
+        # The unique trace_id index still guards against a row stored by
+        # someone else between the lookup above and this insert, except on
+        # partitioned tables where it cannot be unique (see partitions.py);
+        # check_partitioned warns when that is the case.
+        statement = insert(model).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite")
+        db.execute(statement, new_rows)
+    return new_rows
 
 @use_db_session
-def report_traffic(db: Session, body):
-    """Store a traffic event in the database."""
-    logger.info(body)
-    event = TrafficEvent(
-        event_id=body.get("eventID"),
-        sensor_id=body.get("sensorId"),
-        traffic_density=body.get("trafficDensity"),
-        timestamp=parse_timestamp(body.get("timestamp")),
-        incident_report=body.get("incidentReport"),
-        trace_id=body.get("trace_id")
-    )
-    db.add(event)
+def store_batch(db: Session, messages):
+    """Store a batch of decoded event messages in a single transaction.
+
+    Events that were already stored are skipped, so replaying the topic or
+    the receiver spool does not create duplicate rows.
+    """
+    started = time.perf_counter()
+    temperature_rows = []
+    traffic_rows = []
+    seen = {}
+    cached = 0
+    # Set here rather than by the database default so the stored value is
+    # exactly what keyset cursors compare against on every backend. Whole
+    # seconds, as MySQL DATETIME would round anything finer on insert and
+    # rollups bucket this value rather than the stored one.
+    created = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    for msg in messages:
+        trace_id = msg["payload"].get("trace_id")
+        if trace_id in seen or trace_id in recent_ids:
+            cached += 1
+            continue
+        seen[trace_id] = msg
+        if msg["type"] == "temperature_condition":
+            temperature_rows.append(temperature_row(msg["payload"]) | {"date_created": created})
+        elif msg["type"] == "traffic_condition":
+            traffic_rows.append(traffic_row(msg["payload"]) | {"date_created": created})
+
+    new_temperature_rows = insert_new(db, TemperatureEvent, temperature_rows)
+    new_traffic_rows = insert_new(db, TrafficEvent, traffic_rows)
+    # Rollups are updated in the same transaction so they never count an
+    # event that was not stored, or miss one that was.
+    rollups.add(db, TemperatureRollup, new_temperature_rows)
+    rollups.add(db, TrafficRollup, new_traffic_rows)
     db.commit()
-    logger.debug(f"Stored event traffic_condition with a trace id of {event.trace_id}")
-    return NoContent, 200
+    store_latency.observe(time.perf_counter() - started)
+    hops.record({row["trace_id"]: seen[row["trace_id"]] for row in new_temperature_rows + new_traffic_rows})
+    recent_ids.add_all(seen)
+    stored = len(temperature_rows) + len(traffic_rows) - len(new_temperature_rows) - len(new_traffic_rows)
+    if cached or stored:
+        with consumer_stats_lock:
+            consumer_stats["duplicates_dropped"] += cached + stored
+        logger.info(f"Dropped {cached + stored} duplicate events ({cached} from the recent id cache)")
+    logger.debug(f"Stored {len(temperature_rows)} temperature_condition and "
+                 f"{len(traffic_rows)} traffic_condition events")
 
 # API for querying events
+TEMPERATURE_COLUMNS = (TemperatureEvent.id, TemperatureEvent.date_created, TemperatureEvent.trace_id,
+                       TemperatureEvent.sensor_id, TemperatureEvent.temperature, TemperatureEvent.city_zone)
+TRAFFIC_COLUMNS = (TrafficEvent.id, TrafficEvent.date_created, TrafficEvent.trace_id,
+                   TrafficEvent.sensor_id, TrafficEvent.traffic_density, TrafficEvent.incident_report)
+
+def temperature_json(row):
+    return {
+        "trace_id": row.trace_id,
+        "sensorId": row.sensor_id,
+        "temperature": row.temperature,
+        "timestamp": row.date_created.isoformat(),
+        "cityZone": row.city_zone
+    }
+
+def traffic_json(row):
+    return {
+        "trace_id": row.trace_id,
+        "sensorId": row.sensor_id,
+        "trafficDensity": row.traffic_density,
+        "timestamp": row.date_created.isoformat(),
+        "incidentReport": row.incident_report
+    }
+
+def encode_cursor(date_created, event_id):
+    """Build the opaque cursor pointing just past the given row."""
+    return base64.urlsafe_b64encode(f"{date_created.isoformat()}|{event_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    date_created, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(date_created), int(event_id)
+
+def stream_rows(statement, to_json):
+    """Yield rows as NDJSON, fetching them from a server-side cursor in chunks."""
+    db = next(get_db())
+    try:
+        result = db.execute(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+        for rows in result.partitions():
+            yield "".join(json.dumps(to_json(row)) + "\n" for row in rows)
+    finally:
+        db.close()
+
 @use_db_session
-def get_temperature_events(db: Session, start_timestamp, end_timestamp):
+def query_events(db: Session, model, columns, to_json, start_timestamp, end_timestamp, limit=None, after=None):
+    """Return the events of one type created within [start_timestamp, end_timestamp).
+
+    Rows are ordered by (date_created, id). With `limit`, at most that many
+    rows are returned and, if there may be more, the X-Next-Cursor header
+    holds the value to pass as `after` for the next page. Clients that
+    accept application/x-ndjson get the rows streamed one per line.
+
+    JSON pages of windows that ended before the cache watermark are served
+    from the result cache; X-Cache says whether the response was a HIT, a
+    MISS (and is now cached) or BYPASSed the cache.
+    """
+    start_time = parse_timestamp(start_timestamp)
+    end_time = parse_timestamp(end_timestamp)
+
+    event_logger.debug("Querying %s from %s to %s (after=%s, limit=%s)", model.__tablename__, start_time, end_time, after, limit)
+
+    statement = select(*columns).where(
+        model.date_created >= start_time,
+        model.date_created < end_time
+    ).order_by(model.date_created, model.id)
+    if after:
+        try:
+            after_date, after_id = decode_cursor(after)
+        except ValueError:
+            return {"message": "Invalid cursor"}, 400, {"Content-Type": "application/json"}
+        statement = statement.where(or_(
+            model.date_created > after_date,
+            and_(model.date_created == after_date, model.id > after_id)
+        ))
+
+    ndjson = request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON
+    cacheable = not ndjson and results.closed(start_time, end_time)
+    key = (model.__tablename__, start_time.isoformat(), end_time.isoformat(), limit, after)
+    if cacheable:
+        cached = results.get(key)
+        if cached is not None:
+            body, headers, tier = cached
+            metrics.CACHE_REQUESTS.labels("events", f"{tier}_hit").inc()
+            event_logger.debug("Served %s from %s to %s from the %s cache", model.__tablename__, start_time, end_time,
+                               tier)
+            return Response(body, mimetype="application/json", headers={**headers, "X-Cache": "HIT"})
+        metrics.CACHE_REQUESTS.labels("events", "miss").inc()
+    else:
+        results.bypass()
+        metrics.CACHE_REQUESTS.labels("events", "bypass").inc()
+
+    headers = {}
+    if limit:
+        statement = statement.limit(limit)
+        last = db.execute(
+            statement.with_only_columns(model.date_created, model.id).offset(limit - 1).limit(1)
+        ).first()
+        if last is not None:
+            headers["X-Next-Cursor"] = encode_cursor(last.date_created, last.id)
+
+    if ndjson:
+        return Response(stream_rows(statement, to_json), mimetype=NDJSON, headers={**headers, "X-Cache": "BYPASS"})
+
+    rows = db.execute(statement).all()
+    event_logger.debug("Found %d %s", len(rows), model.__tablename__)
+    if cacheable:
+        body = json.dumps([to_json(row) for row in rows]).encode()
+        results.put(key, body, headers)
+        return Response(body, mimetype="application/json", headers={**headers, "X-Cache": "MISS"})
+    headers["Content-Type"] = "application/json"
+    headers["X-Cache"] = "BYPASS"
+    return jsonify([to_json(row) for row in rows]), 200, headers
+
+def get_temperature_events(start_timestamp, end_timestamp, limit=None, after=None):
     """Retrieve temperature events within a given time range."""
+    return query_events(TemperatureEvent, TEMPERATURE_COLUMNS, temperature_json,
+                        start_timestamp, end_timestamp, limit, after)
+
+def get_traffic_events(start_timestamp, end_timestamp, limit=None, after=None):
+    """Retrieve traffic events within a given time range."""
+    return query_events(TrafficEvent, TRAFFIC_COLUMNS, traffic_json,
+                        start_timestamp, end_timestamp, limit, after)
+
+# API for bulk exports
+def stream_export(model, start_time, end_time, fmt):
+    """Yield an export as it is encoded, reading the rows from a server-side cursor in batches.
+
+    Failures are raised again once logged, so a response already under way
+    is aborted rather than ended as if the export were complete.
+    """
+    db = next(get_db())
+    try:
+        yield from export.stream(export.batches(db, model, start_time, end_time, EXPORT_BATCH_ROWS),
+                                 export.schema(model), fmt, EXPORT_COMPRESSION)
+    except Exception as e:
+        logger.error(f"Exporting {model.__tablename__} stopped early ({e})")
+        raise
+    finally:
+        db.close()
+
+def export_events(model, start_timestamp, end_timestamp, fmt):
+    """Stream the events of one type created within [start_timestamp, end_timestamp) as Arrow or Parquet.
+
+    The first batch is read and encoded before the response starts, so an
+    export that fails from the outset is answered with a 500.
+    """
     start_time = parse_timestamp(start_timestamp)
     end_time = parse_timestamp(end_timestamp)
+    event_logger.info("Exporting %s from %s to %s as %s", model.__tablename__, start_time, end_time, fmt)
+    media_type, extension = export.FORMATS[fmt]
+    filename = f"{model.__tablename__}-{start_time:%Y%m%dT%H%M%S}-{end_time:%Y%m%dT%H%M%S}{extension}"
+    chunks = stream_export(model, start_time, end_time, fmt)
+    try:
+        first = next(chunks)
+    except Exception:
+        return {"message": f"Exporting {model.__tablename__} failed"}, 500
+    return Response(itertools.chain([first], chunks), mimetype=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
-    logger.debug(f"Querying temperature events from {start_time} to {end_time}")
+def export_temperature_events(start_timestamp, end_timestamp, format="arrow"):
+    """Export temperature events within a given time range."""
+    return export_events(TemperatureEvent, start_timestamp, end_timestamp, format)
 
-    statement = select(TemperatureEvent).where(
-        TemperatureEvent.date_created >= start_time,
-        TemperatureEvent.date_created < end_time
-    )
+def export_traffic_events(start_timestamp, end_timestamp, format="arrow"):
+    """Export traffic events within a given time range."""
+    return export_events(TrafficEvent, start_timestamp, end_timestamp, format)
 
-    events = db.execute(statement).scalars().all()
-    logger.debug(f"Found {len(events)} temperature events")
+# API for aggregate queries
+ROLLUP_GROUPS = {
+    TemperatureRollup: {"bucket": "bucket_start", "sensor": "sensor_id", "zone": "city_zone"},
+    TrafficRollup: {"bucket": "bucket_start", "sensor": "sensor_id"},
+}
 
-    return jsonify([
-        {
-            "trace_id": event.trace_id,
-            "sensorId": event.sensor_id,
-            "temperature": event.temperature,
-            "timestamp": event.date_created.isoformat(),
-            "cityZone": event.city_zone
-        }
-        for event in events
-    ]), 200
+def rollup_json(row, group_by):
+    stats = {
+        "count": row.count or 0,
+        "min": row.min,
+        "max": row.max,
+        "sum": row.sum or 0,
+        "mean": row.sum / row.count if row.count else None,
+    }
+    for name, column in group_by.items():
+        value = getattr(row, column)
+        stats[name] = value.isoformat() if isinstance(value, datetime) else value
+    return stats
 
 @use_db_session
-def get_traffic_events(db: Session, start_timestamp, end_timestamp):
-    """Retrieve traffic events within a given time range."""
+def query_rollup(db: Session, model, start_timestamp, end_timestamp, granularity, filters, group_by):
+    """Aggregate the rollup buckets of one event type that start within [start_timestamp, end_timestamp).
+
+    Buckets are whole minutes or hours, so the range is widened to the start
+    of the bucket containing start_timestamp.
+    """
     start_time = parse_timestamp(start_timestamp)
     end_time = parse_timestamp(end_timestamp)
+    filters = {column: value for column, value in filters.items() if value is not None}
+    groups = {name: ROLLUP_GROUPS[model][name] for name in group_by or []}
+
+    total = rollups.query(db, model, granularity, start_time, end_time, filters, [])[0]
+    result = {
+        "granularity": granularity,
+        "start_timestamp": rollups.bucket_start(start_time, granularity).isoformat(),
+        "end_timestamp": end_time.isoformat(),
+        **rollup_json(total, {}),
+    }
+    if groups:
+        rows = rollups.query(db, model, granularity, start_time, end_time, filters, list(groups.values()))
+        result["groups"] = [rollup_json(row, groups) for row in rows]
+    event_logger.debug("Aggregated %s %s by %s from %s to %s", result["count"], model.__tablename__, granularity,
+                       start_time, end_time)
+    return result, 200
+
+def get_temperature_rollup(start_timestamp, end_timestamp, granularity="hour", sensorId=None, cityZone=None,
+                           group_by=None):
+    """Aggregate temperature readings within a given time range."""
+    return query_rollup(TemperatureRollup, start_timestamp, end_timestamp, granularity,
+                        {"sensor_id": sensorId, "city_zone": cityZone}, group_by)
+
+def get_traffic_rollup(start_timestamp, end_timestamp, granularity="hour", sensorId=None, group_by=None):
+    """Aggregate traffic density within a given time range."""
+    return query_rollup(TrafficRollup, start_timestamp, end_timestamp, granularity,
+                        {"sensor_id": sensorId}, group_by)
+
+def record_flush(worker, batch_size, flush_ms):
+    """Update the consumer metrics after a batch has been stored."""
+    with consumer_stats_lock:
+        consumer_stats["batches"] += 1
+        consumer_stats["events"] += batch_size
+        consumer_stats["last_batch_size"] = batch_size
+        consumer_stats["max_batch_size"] = max(consumer_stats["max_batch_size"], batch_size)
+        consumer_stats["last_flush_ms"] = flush_ms
+        consumer_stats["max_flush_ms"] = max(consumer_stats["max_flush_ms"], flush_ms)
+        consumer_stats["total_flush_ms"] += flush_ms
+        worker_stats[worker]["batches"] += 1
+        worker_stats[worker]["events"] += batch_size
+    batch_sizes.observe(batch_size)
+
+def store_each(batch):
+    """Store messages one at a time so a bad message cannot block the rest."""
+    for msg in batch:
+        try:
+            store_batch([msg])
+        except OperationalError:
+            raise
+        except Exception as e:
+            logger.error(f"Dropping {msg['type']} event {msg['payload'].get('trace_id')} ({e})")
+
+def flush_batch(worker, consumer, batch):
+    """Store a batch, retrying while the database is unreachable, then commit its offsets.
+
+    Once the service is stopping it gives up instead, leaving the offsets
+    uncommitted so the batch is consumed again after a restart.
+    """
+    delay = 1
+    while True:
+        started = time.monotonic()
+        try:
+            try:
+                store_batch(batch)
+            except OperationalError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to store batch of {len(batch)} events ({e}), storing them one by one")
+                store_each(batch)
+            break
+        except OperationalError as e:
+            if stopping.is_set():
+                logger.error(f"Database unavailable ({e}), leaving batch of {len(batch)} events to be replayed")
+                return
+            logger.error(f"Database unavailable ({e}), retrying batch of {len(batch)} events in {delay}s")
+            stopping.wait(delay)
+            delay = min(delay * 2, 30)
+    flush_ms = (time.monotonic() - started) * 1000
+    # Offsets are only committed once the rows are safely in the database
+    commit_offsets(worker, consumer)
+    record_flush(worker, len(batch), flush_ms)
+
+def commit_offsets(worker, consumer):
+    try:
+        consumer.commit_offsets()
+    except Exception as e:
+        # Happens while partitions are being reassigned. The events will be
+        # redelivered to their new owner, which skips them as duplicates.
+        logger.warning(f"{worker} could not commit offsets ({e})")
+
+def build_consumer(topic, worker, rebalanced):
+    """Create the consumer for one worker.
+
+    In balanced mode every worker of every storage replica joins the same
+    Kafka-managed consumer group, and Kafka spreads the topic's partitions
+    across them. In simple mode a single worker reads every partition.
+    """
+    if CONSUMER_MODE == 'simple':
+        return topic.get_simple_consumer(consumer_group=CONSUMER_GROUP,
+                                         reset_offset_on_start=False,
+                                         auto_offset_reset=OffsetType.LATEST,
+                                         consumer_timeout_ms=FLUSH_INTERVAL_MS)
 
-    logger.debug(f"Querying traffic events from {start_time} to {end_time}")
-
-    statement = select(TrafficEvent).where(
-        TrafficEvent.date_created >= start_time,
-        TrafficEvent.date_created < end_time
-    )
-
-    events = db.execute(statement).scalars().all()
-    logger.debug(f"Found {len(events)} traffic events")
-    return jsonify([
-        {
-            "trace_id": event.trace_id,
-            "sensorId": event.sensor_id,
-            "trafficDensity": event.traffic_density,
-            "timestamp": event.date_created.isoformat(),
-            "incidentReport": event.incident_report
-        }
-        for event in events
-    ]), 200
-
-def process_messages():
-    """Process event messages from Kafka"""
+    def on_rebalance(consumer, old_offsets, new_offsets):
+        with consumer_stats_lock:
+            worker_stats[worker]["partitions"] = sorted(new_offsets)
+            worker_stats[worker]["rebalances"] += 1
+        logger.info(f"{worker} now holds partitions {sorted(new_offsets)} (was {sorted(old_offsets)})")
+        rebalanced.set()
+
+    return topic.get_balanced_consumer(consumer_group=CONSUMER_GROUP,
+                                       managed=True,
+                                       reset_offset_on_start=False,
+                                       auto_offset_reset=OffsetType.LATEST,
+                                       consumer_timeout_ms=FLUSH_INTERVAL_MS,
+                                       post_rebalance_callback=on_rebalance)
+
+def record_lag(worker, topic, consumer):
+    """Store how many events are waiting in each partition the worker holds."""
+    held = consumer.held_offsets or {}
+    latest = topic.latest_available_offsets()
+    lag = {str(partition): max(0, latest[partition].offset[0] - offset - 1)
+           for partition, offset in held.items() if partition in latest}
+    with consumer_stats_lock:
+        worker_stats[worker]["partitions"] = sorted(held)
+        worker_stats[worker]["partition_lag"] = lag
+        worker_stats[worker]["lag"] = sum(lag.values())
+    for partition, messages in lag.items():
+        metrics.CONSUMER_LAG.labels("storage", partition).set(messages)
+
+def process_messages(worker):
+    """Process event messages from Kafka in batches.
+
+    Messages are collected until there are BATCH_SIZE of them or
+    FLUSH_INTERVAL_MS has passed since the first one arrived, then written in
+    one transaction. When the worker's partitions are reassigned the batch is
+    flushed straight away; events from partitions it lost are redelivered to
+    their new owner, which skips the ones already stored.
+    """
     client = KafkaClient(hosts=KAFKA_HOST)
     topic = client.topics[str.encode(KAFKA_TOPIC)]
+    rebalanced = Event()
+    consumer = build_consumer(topic, worker, rebalanced)
+    logger.info(f"{worker} started in {CONSUMER_MODE} mode")
 
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group',
-                                         reset_offset_on_start=False,
-                                         auto_offset_reset=OffsetType.LATEST)
-
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        # logger.info(f"Message: {msg}")
-        payload = msg["payload"]
-        logger.info(f"Payload: {payload}")
-        if msg["type"] == "temperature_condition":
-            report_temperature(payload)
-        elif msg["type"] == "traffic_condition":
-            report_traffic(payload)
+    batch = []
+    deadline = None
+    next_lag_check = 0
+    while not stopping.is_set():
+        msg = consumer.consume(block=True)
+        if msg is not None:
+            try:
+                event = envelope.decode(msg.value)
+            except envelope.MalformedEnvelope as e:
+                logger.error(f"{worker} skipped the message at partition {msg.partition_id} offset {msg.offset} ({e})")
+                # Otherwise its offset is committed with the batch in progress
+                if not batch:
+                    commit_offsets(worker, consumer)
+            else:
+                event["consumed"] = time.time()
+                metrics.observe_consumed(consume_lag, event["datetime"])
+                batch.append(event)
+                if deadline is None:
+                    deadline = time.monotonic() + FLUSH_INTERVAL_MS / 1000
+        reassigned = rebalanced.is_set()
+        if reassigned:
+            rebalanced.clear()
+        if batch and (len(batch) >= BATCH_SIZE or time.monotonic() >= deadline or reassigned):
+            flush_batch(worker, consumer, batch)
+            batch = []
+            deadline = None
+        if time.monotonic() >= next_lag_check:
+            try:
+                record_lag(worker, topic, consumer)
+            except Exception as e:
+                logger.warning(f"{worker} could not fetch partition offsets ({e})")
+            next_lag_check = time.monotonic() + LAG_INTERVAL_S
+    if batch:
+        flush_batch(worker, consumer, batch)
+    consumer.stop()
+    logger.info(f"{worker} stopped")
 
-        # Commit the message as processed
-        consumer.commit_offsets()
+def get_consumer_stats():
+    """Report batch size and flush latency of the Kafka consumer, and the lag of each worker."""
+    with consumer_stats_lock:
+        stats = dict(consumer_stats)
+        workers = [{"name": name, **dict(worker)} for name, worker in worker_stats.items()]
+    total_flush_ms = stats.pop("total_flush_ms")
+    stats["avg_batch_size"] = stats["events"] / stats["batches"] if stats["batches"] else 0
+    stats["avg_flush_ms"] = total_flush_ms / stats["batches"] if stats["batches"] else 0
+    stats["lag"] = sum(worker["lag"] for worker in workers)
+    stats["workers"] = workers
+    return stats, 200
+
+def get_cache_stats():
+    """Report hits, misses and size of the result cache of this process."""
+    return results.summary(), 200
+
+def get_latency(trace_id=None):
+    """Report the latency of each stage from the receiver to storage, and the timeline of one event."""
+    event_logger.info("Fetching event latency")
+    body = {"window_s": hops.window_s, "stages": hops.summary()}
+    if trace_id is not None:
+        timeline = hops.timeline(trace_id)
+        if timeline is None:
+            return {"message": f"No timeline kept for trace id {trace_id}"}, 404
+        body["timeline"] = timeline
+    return body, 200
 
 def setup_kafka_thread():
-    """Set up Kafka consumer in a separate thread"""
-    t1 = Thread(target=process_messages)
-    t1.daemon = True
-    t1.start()
+    """Start the Kafka consumer workers, each in a separate thread"""
+    workers = 1 if CONSUMER_MODE == 'simple' else CONSUMER_WORKERS
+    for index in range(workers):
+        worker = f"{socket.gethostname()}-{index}"
+        worker_stats[worker] = {"partitions": [], "partition_lag": {}, "lag": 0,
+                                "batches": 0, "events": 0, "rebalances": 0}
+        t = Thread(target=process_messages, args=(worker,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+def check_partitioned():
+    """Warn, once per table, when an event table is partitioned and so no longer has a unique trace_id."""
+    with engine.connect() as conn:
+        tables = {model.__tablename__ for model in partitions.EVENT_MODELS if partitions.list_partitions(conn, model)}
+    for table in sorted(tables - partitioned_tables):
+        logger.warning(f"{table} is partitioned, so the database no longer enforces unique trace ids; duplicate "
+                       f"events are only skipped by the lookup before each insert, which can race between replicas")
+    partitioned_tables.update(tables)
+
+def enforce_retention():
+    """Periodically add upcoming partitions and drop or delete expired data."""
+    while not stopping.is_set():
+        try:
+            with metrics.JOB_DURATION.labels("retention").time():
+                summary = partitions.maintain(engine, EVENT_RETENTION_DAYS, MINUTE_ROLLUP_RETENTION_DAYS,
+                                              PARTITION_DAYS, PARTITIONS_AHEAD)
+            logger.info(f"Retention run finished: {summary}")
+            check_partitioned()
+        except Exception as e:
+            logger.error(f"Retention run failed ({e})")
+        stopping.wait(RETENTION_INTERVAL_S)
+
+def setup_retention_thread():
+    """Run the retention job in a separate thread"""
+    t2 = Thread(target=enforce_retention)
+    t2.daemon = True
+    t2.start()
+    threads.append(t2)
+
+def start():
+    """Create the tables, and in the background role start the consumers and the retention job."""
+    Base.metadata.create_all(bind=engine)
+    if server.runs_background():
+        setup_kafka_thread()  # Start Kafka consumer in a separate thread
+        setup_retention_thread()
+
+def stop():
+    """Store the batches in progress, commit their offsets and stop the consumers."""
+    stopping.set()
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT_S
+    for t in threads:
+        t.join(max(0, deadline - time.monotonic()))
+
+class StreamedResponseValidator(AbstractResponseBodyValidator):
+    """Pass NDJSON and export responses through unvalidated so the stream is not buffered."""
+
+    def wrap_send(self, send):
+        return send
 
-app = connexion.FlaskApp(__name__, specification_dir="")
-app.add_api("AARONDIMA-Smart-City-App-1.0.0.yaml", strict_validation=True, base_path="/storage", validate_responses=True)
+# Consumer stats and latency are kept by the process running the consumers,
+# so /consumer/stats and /latency are only filled in on the background role
+app = connexion.FlaskApp(__name__, specification_dir="", lifespan=server.lifespan(start, stop))
+app.add_middleware(metrics.MetricsMiddleware, position=MiddlewarePosition.BEFORE_EXCEPTION, path="/storage/metrics")
+app.add_api("AARONDIMA-Smart-City-App-1.0.0.yaml", strict_validation=True, base_path="/storage", validate_responses=True,
+            validator_map={"response": MediaTypeDict({
+                **VALIDATOR_MAP["response"], NDJSON: StreamedResponseValidator,
+                **{media_type: StreamedResponseValidator for media_type, _ in export.FORMATS.values()}})})
 
 if __name__ == "__main__":
-    setup_kafka_thread()  # Start Kafka consumer in a separate thread
     app.run(port=8090, host="0.0.0.0")
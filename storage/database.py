@@ -16,13 +16,13 @@ with open(app_conf_file, 'r') as f:
 # Extract datastore configuration
 db_config = app_config['datastore']
 
-# Build the database URL using substituted values
-DATABASE_URL = (
+# Build the database URL using substituted values; a full `url` (e.g. sqlite:///bench.db) takes precedence
+DATABASE_URL = db_config.get('url') or (
     f"mysql://{db_config['user']}:{db_config['password']}"
     f"@{db_config['hostname']}:{db_config['port']}/{db_config['db']}"
 )
 
-engine = create_engine(DATABASE_URL, echo=True)  
+engine = create_engine(DATABASE_URL, echo=db_config.get('echo', True))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -1,6 +1,18 @@
-from sqlalchemy import create_engine
-from database import Base, engine
-from models import Base
+import os
+from datetime import date, datetime, timedelta
+from sqlalchemy import delete, func, select
+from database import Base, app_config, engine
+from sqlalchemy.orm import Session
+from models import Base, TemperatureEvent, TemperatureRollup, TrafficEvent, TrafficRollup
+import rollups
+import partitions
+import export
+
+RETENTION_CONFIG = app_config.get('retention', {})
+PARTITION_DAYS = RETENTION_CONFIG.get('partition_days', 1)
+PARTITIONS_AHEAD = RETENTION_CONFIG.get('partitions_ahead', 7)
+EXPORT_CONFIG = app_config.get('export', {})
+EXPORT_MODELS = {"temperature": TemperatureEvent, "traffic": TrafficEvent}
 def create_tables():
     """Create all database tables."""
     Base.metadata.create_all(engine)
@@ -12,15 +24,113 @@ def drop_tables():
     Base.metadata.drop_all(engine)
     print("Tables dropped successfully.")
 
+def dedupe_tables():
+    """Remove duplicate events and make the trace_id index unique.
+
+    Tables created before trace_id was unique may hold the same event more
+    than once; the copy with the lowest id is kept.
+    """
+    for model in (TemperatureEvent, TrafficEvent):
+        with engine.begin() as conn:
+            # Wrapped in a derived table because MySQL cannot select from the
+            # table it is deleting from.
+            keep = select(func.min(model.id).label("id")).group_by(model.trace_id).subquery()
+            result = conn.execute(delete(model).where(model.id.not_in(select(keep.c.id))))
+            print(f"Removed {result.rowcount} duplicate rows from {model.__tablename__}.")
+            index = next(index for index in model.__table__.indexes if "trace_id" in index.columns)
+            index.drop(conn)
+            index.create(conn)
+    print("Trace id indexes are now unique.")
+
+def rebuild_rollups():
+    """Recompute the rollup tables from the stored events.
+
+    Stop the storage consumer first, events stored during the rebuild may be
+    counted twice.
+    """
+    with Session(engine) as db:
+        for model in (TemperatureRollup, TrafficRollup):
+            events = rollups.rebuild(db, model)
+            print(f"Rebuilt {model.__tablename__} from {events} events.")
+
+def partition_tables():
+    """Partition the event tables by day of date_created (MySQL only)."""
+    for model in partitions.EVENT_MODELS:
+        with engine.begin() as conn:
+            if partitions.enable(conn, model, PARTITION_DAYS, PARTITIONS_AHEAD):
+                print(f"Partitioned {model.__tablename__}.")
+                print(f"Warning: trace_id is no longer unique in {model.__tablename__}. Duplicate events are "
+                      f"only skipped by storage's lookup before each insert, which can race between replicas.")
+            else:
+                print(f"{model.__tablename__} is already partitioned.")
+
+def list_partitions():
+    """Print the partitions of the event tables."""
+    for model in partitions.EVENT_MODELS:
+        with engine.connect() as conn:
+            rows = partitions.list_partitions(conn, model)
+        print(f"{model.__tablename__}: {len(rows) or 'not'} partitions")
+        for name, start, end in rows:
+            print(f"  {name}  {start or ''} - {end or ''}")
+
+def prune_tables():
+    """Run the retention job once."""
+    summary = partitions.maintain(engine, RETENTION_CONFIG.get('event_days', 30),
+                                  RETENTION_CONFIG.get('minute_rollup_days', 7), PARTITION_DAYS, PARTITIONS_AHEAD)
+    for table, result in summary.items():
+        print(f"{table}: {result}")
+
+def export_events(event_types, start, end, fmt, directory):
+    """Export the events created on each day in [start, end) to <directory>/<table>/<day>.<format>.
+
+    Each file is read from the database and written in batches, so memory
+    use does not grow with the size of a day. Days without events get no file.
+    """
+    _, extension = export.FORMATS[fmt]
+    batch_rows = EXPORT_CONFIG.get('batch_rows', 50000)
+    compression = EXPORT_CONFIG.get('compression', 'zstd')
+    for event_type in event_types:
+        model = EXPORT_MODELS[event_type]
+        os.makedirs(os.path.join(directory, model.__tablename__), exist_ok=True)
+        day = start
+        while day < end:
+            day_start = datetime.combine(day, datetime.min.time())
+            path = os.path.join(directory, model.__tablename__, f"{day.isoformat()}{extension}")
+            with Session(engine) as db:
+                rows = export.write(path, export.batches(db, model, day_start, day_start + timedelta(days=1), batch_rows),
+                                    export.schema(model), fmt, compression)
+            if rows:
+                print(f"Exported {rows} {model.__tablename__} to {path}.")
+            day += timedelta(days=1)
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Manage database tables.")
-    parser.add_argument("action", choices=["create", "drop"], help="Action to perform on tables.")
+    parser.add_argument("action", choices=["create", "drop", "dedupe", "rebuild-rollups", "partition", "list-partitions", "prune", "export"], help="Action to perform on tables.")
+    parser.add_argument("--type", choices=["temperature", "traffic"], action="append", dest="types", help="Event type to export (default: both).")
+    parser.add_argument("--start", type=date.fromisoformat, help="First day to export, YYYY-MM-DD.")
+    parser.add_argument("--end", type=date.fromisoformat, help="Day after the last day to export (default: today).")
+    parser.add_argument("--format", choices=list(export.FORMATS), default="parquet", help="File format of the export.")
+    parser.add_argument("--directory", default="export", help="Directory to write the export to.")
 
     args = parser.parse_args()
 
     if args.action == "create":
         create_tables()
     elif args.action == "drop":
-        drop_tables()
\ No newline at end of file
+        drop_tables()
+    elif args.action == "dedupe":
+        dedupe_tables()
+    elif args.action == "rebuild-rollups":
+        rebuild_rollups()
+    elif args.action == "partition":
+        partition_tables()
+    elif args.action == "list-partitions":
+        list_partitions()
+    elif args.action == "prune":
+        prune_tables()
+    elif args.action == "export":
+        if args.start is None:
+            parser.error("export needs --start")
+        export_events(args.types or list(EXPORT_MODELS), args.start, args.end or date.today(), args.format, args.directory)
@@ -0,0 +1,117 @@
+"""Columnar export of stored events, as Arrow IPC or Parquet.
+
+Events of one table within [start, end) of date_created are read in
+(date_created, id) order through a server-side cursor, `batch_rows` rows at
+a time, and each batch becomes one Arrow record batch, or one Parquet row
+group. Only one batch is held in memory at a time, whatever the size of the
+range. Every column of the table is exported, typed from the model.
+
+`stream` yields the encoded bytes batch by batch, for HTTP responses;
+`write` writes them to a file. Over HTTP, Arrow is sent in the IPC stream
+format; files use the IPC file format, which readers can map and seek in.
+"""
+import contextlib
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import DateTime, Float, Integer, String, select
+
+# Media type and file extension of each format
+FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", ".arrow"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+ARROW_TYPES = ((DateTime, pa.timestamp("us")), (Float, pa.float64()), (Integer, pa.int64()), (String, pa.string()))
+
+
+def schema(model):
+    """The Arrow schema of an event table."""
+    fields = []
+    for column in model.__table__.columns:
+        arrow_type = next(arrow_type for sql_type, arrow_type in ARROW_TYPES if isinstance(column.type, sql_type))
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+def batches(db, model, start, end, batch_rows):
+    """Yield the events of a table created within [start, end) as record batches of up to `batch_rows` rows."""
+    arrow_schema = schema(model)
+    statement = select(*model.__table__.columns).where(
+        model.date_created >= start,
+        model.date_created < end
+    ).order_by(model.date_created, model.id)
+    result = db.execute(statement.execution_options(yield_per=batch_rows))
+    for rows in result.partitions():
+        columns = zip(*rows)
+        yield pa.record_batch([pa.array(values, type=field.type) for values, field in zip(columns, arrow_schema)],
+                              schema=arrow_schema)
+
+
+class Chunks:
+    """A write-only file handing back what was written to it since the last `take`."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def writer(sink, arrow_schema, fmt, compression="zstd", stream=False):
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, arrow_schema, compression=compression)
+    if stream:
+        return pa.ipc.new_stream(sink, arrow_schema)
+    return pa.ipc.new_file(sink, arrow_schema)
+
+
+def stream(record_batches, arrow_schema, fmt, compression="zstd"):
+    """Yield a whole export in `fmt` as bytes, one chunk per record batch."""
+    chunks = Chunks()
+    with writer(pa.PythonFile(chunks, mode="w"), arrow_schema, fmt, compression, stream=True) as out:
+        for batch in record_batches:
+            out.write_batch(batch)
+            yield chunks.take()
+    yield chunks.take()
+
+
+def write(path, record_batches, arrow_schema, fmt, compression="zstd"):
+    """Write an export to `path`, replacing it only once complete. Returns the number of rows.
+
+    Nothing is written when there are no rows.
+    """
+    rows = 0
+    tmp = path + ".tmp"
+    out = None
+    try:
+        with contextlib.ExitStack() as stack:
+            for batch in record_batches:
+                if out is None:
+                    out = stack.enter_context(writer(tmp, arrow_schema, fmt, compression))
+                out.write_batch(batch)
+                rows += batch.num_rows
+        if out is not None:
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return rows
@@ -0,0 +1,107 @@
+"""Where the time goes between an event reaching the receiver and it being stored.
+
+Each event is timed at four hops: received (the envelope datetime, set when
+the receiver accepted it), produced (stamped on the envelope when the
+receiver handed it to the Kafka producer), consumed (when a storage worker
+decoded it) and committed (when the transaction storing it committed).
+Consecutive hops give the stages:
+
+    receiver    received -> produced   queuing in the receiver or its spool
+    kafka       produced -> consumed   the topic, and consumer lag
+    storage     consumed -> committed  batching and the database transaction
+    end_to_end  received -> committed
+
+HopTracker keeps the samples of the last `window_s` seconds for the
+percentiles of each stage, and the timelines of the most recently stored
+events for lookup by trace_id. Both live in memory, per storage replica.
+Receiver and storage clocks are assumed to agree; any skew between them
+shows up in the kafka stage.
+"""
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from threading import Lock
+
+HOPS = ("received", "produced", "consumed", "committed")
+STAGES = {
+    "receiver": ("received", "produced"),
+    "kafka": ("produced", "consumed"),
+    "storage": ("consumed", "committed"),
+    "end_to_end": ("received", "committed"),
+}
+
+
+def epoch(value):
+    """Seconds since the epoch of an ISO 8601 envelope time, or None."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HopTracker:
+    """Rolling per-stage latency samples, and the timelines of recent events."""
+
+    def __init__(self, window_s=300, max_samples=100000, timelines=10000):
+        self.window_s = window_s
+        self.max_timelines = timelines
+        # (committed, seconds) pairs, oldest first
+        self.samples = {stage: deque(maxlen=max_samples) for stage in STAGES}
+        self.timelines = OrderedDict()
+        self.lock = Lock()
+
+    def record(self, events, committed=None):
+        """Add the hops of events stored in one transaction.
+
+        `events` maps trace ids to their decoded envelopes, each with the
+        epoch seconds it was consumed at under "consumed".
+        """
+        committed = committed or time.time()
+        with self.lock:
+            for trace_id, event in events.items():
+                hops = (epoch(event.get("datetime")), epoch(event.get("produced")), event.get("consumed"), committed)
+                timeline = dict(zip(HOPS, hops))
+                for stage, (start, end) in STAGES.items():
+                    if timeline[start] is not None and timeline[end] is not None:
+                        self.samples[stage].append((committed, timeline[end] - timeline[start]))
+                self.timelines[trace_id] = (event["type"], timeline)
+            while len(self.timelines) > self.max_timelines:
+                self.timelines.popitem(last=False)
+
+    def summary(self):
+        """Count and p50/p95/p99/max in milliseconds of each stage, over the window."""
+        cutoff = time.time() - self.window_s
+        stages = {}
+        with self.lock:
+            for stage, samples in self.samples.items():
+                while samples and samples[0][0] < cutoff:
+                    samples.popleft()
+                stages[stage] = sorted(seconds for _, seconds in samples)
+        return {stage: {
+            "count": len(ordered),
+            "p50_ms": percentile(ordered, 0.50) * 1000 if ordered else None,
+            "p95_ms": percentile(ordered, 0.95) * 1000 if ordered else None,
+            "p99_ms": percentile(ordered, 0.99) * 1000 if ordered else None,
+            "max_ms": ordered[-1] * 1000 if ordered else None,
+        } for stage, ordered in stages.items()}
+
+    def timeline(self, trace_id):
+        """The hops of a recently stored event and the time spent in each stage, or None."""
+        with self.lock:
+            entry = self.timelines.get(trace_id)
+        if entry is None:
+            return None
+        event_type, timeline = entry
+        return {
+            "trace_id": trace_id,
+            "type": event_type,
+            "hops": {hop: datetime.fromtimestamp(at, timezone.utc).isoformat() if at is not None else None
+                     for hop, at in timeline.items()},
+            "stages_ms": {stage: (timeline[end] - timeline[start]) * 1000
+                          if timeline[start] is not None and timeline[end] is not None else None
+                          for stage, (start, end) in STAGES.items()},
+        }
@@ -0,0 +1,109 @@
+"""Prometheus metrics of the services, served at /<service>/metrics.
+
+MetricsMiddleware times every API request and labels it with the
+operationId connexion routed it to, so request rate and latency come per
+operation of the OpenAPI spec. The other metrics are updated by the service
+code on its hot paths: Kafka produce, fetch and consume, batch sizes,
+database transactions, consumer lag, periodic jobs and response caches. Each update is a few
+counter increments, cheap enough to leave on in production; callers on
+per-event paths bind their labels once with `.labels()` at startup.
+
+Metrics a service never updates are exported without samples. When
+server.py runs several worker processes, they share
+PROMETHEUS_MULTIPROC_DIR and every scrape reports the sum over all of them.
+
+This module is shared by the receiver, storage, processing and analyzer
+services; keep the copies identical.
+"""
+import os
+import time
+from datetime import datetime
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Where connexion's routing middleware leaves the operationId in the ASGI scope
+ROUTING_CONTEXT = "connexion_routing"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "API requests, by operationId, method and status class",
+    ["operation", "method", "status"])
+KAFKA_PRODUCE_LATENCY = Histogram(
+    "kafka_produce_duration_seconds",
+    "Time to hand events to the Kafka producer, or to have them acknowledged where delivery is awaited",
+    ["mode"])
+KAFKA_FETCH_LATENCY = Histogram(
+    "kafka_fetch_duration_seconds", "Time to fetch messages from a partition leader by offset", ["consumer"])
+CONSUME_LAG = Histogram(
+    "kafka_consume_lag_seconds", "Time from an event being put on the topic to it being consumed", ["consumer"],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+CONSUMER_LAG = Gauge(
+    "kafka_consumer_lag_messages", "Messages on the topic not yet consumed, per partition", ["consumer", "partition"],
+    multiprocess_mode="livemax")
+BATCH_SIZE = Histogram(
+    "batch_size_events", "Events per batch", ["operation"],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+DB_TRANSACTION = Histogram(
+    "db_transaction_duration_seconds", "Time to write and commit a transaction", ["operation"])
+HTTP_CLIENT_LATENCY = Histogram(
+    "http_client_request_duration_seconds", "Requests to other services, by URL and status", ["url", "status"])
+JOB_DURATION = Histogram(
+    "scheduler_run_duration_seconds", "Duration of periodic jobs", ["job"],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Lookups in response caches, by result: memory_hit, disk_hit, miss or bypass",
+    ["cache", "result"])
+
+
+def registry():
+    """The registry to export: this process's, or one gathering every worker process's metrics."""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    gathered = CollectorRegistry()
+    multiprocess.MultiProcessCollector(gathered)
+    return gathered
+
+
+def observe_consumed(histogram, envelope_datetime):
+    """Record how long ago an event was put on the topic, from its envelope datetime."""
+    try:
+        produced = datetime.fromisoformat(envelope_datetime).timestamp()
+    except (TypeError, ValueError):
+        return
+    histogram.observe(max(0.0, time.time() - produced))
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing API requests and serving GET `path` in the Prometheus text format."""
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"] == self.path and scope["method"] == "GET":
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", CONTENT_TYPE_LATEST.encode())]})
+            await send({"type": "http.response.body", "body": generate_latest(registry())})
+            return
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        # The routing middleware adds the operationId to this dict
+        extensions = scope.setdefault("extensions", {})
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            operation = extensions.get(ROUTING_CONTEXT, {}).get("operation_id") or "unmatched"
+            REQUEST_LATENCY.labels(operation, scope["method"], f"{status // 100}xx").observe(
+                time.perf_counter() - started)
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, String, Float, DateTime, func
+from sqlalchemy import BigInteger, Integer, String, Float, DateTime, func
 
 class Base(DeclarativeBase):
     pass
@@ -13,8 +13,8 @@ class TemperatureEvent(Base):
     timestamp = mapped_column(DateTime, nullable=False)
     temperature = mapped_column(Float, nullable=False)
     city_zone = mapped_column(String(255), nullable=True)
-    date_created = mapped_column(DateTime, nullable=False, default=func.now())
-    trace_id = mapped_column(String(255), nullable=False, index=True)
+    date_created = mapped_column(DateTime, nullable=False, default=func.now(), index=True)
+    trace_id = mapped_column(String(255), nullable=False, index=True, unique=True)
 
 class TrafficEvent(Base):
     __tablename__ = "traffic_events"
@@ -25,5 +25,30 @@ class TrafficEvent(Base):
     timestamp = mapped_column(DateTime, nullable=False)
     traffic_density = mapped_column(Integer, nullable=False)
     incident_report = mapped_column(String(255), nullable=True)
-    date_created = mapped_column(DateTime, nullable=False, default=func.now())
-    trace_id = mapped_column(String(255), nullable=False, index=True)
+    date_created = mapped_column(DateTime, nullable=False, default=func.now(), index=True)
+    trace_id = mapped_column(String(255), nullable=False, index=True, unique=True)
+
+class TemperatureRollup(Base):
+    """Per-minute or per-hour aggregate of temperature readings for one sensor."""
+    __tablename__ = "temperature_rollups"
+
+    granularity = mapped_column(String(8), primary_key=True)
+    bucket_start = mapped_column(DateTime, primary_key=True)
+    sensor_id = mapped_column(String(255), primary_key=True)
+    city_zone = mapped_column(String(255), primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+    min = mapped_column(Float, nullable=False)
+    max = mapped_column(Float, nullable=False)
+    sum = mapped_column(Float, nullable=False)
+
+class TrafficRollup(Base):
+    """Per-minute or per-hour aggregate of traffic density for one sensor."""
+    __tablename__ = "traffic_rollups"
+
+    granularity = mapped_column(String(8), primary_key=True)
+    bucket_start = mapped_column(DateTime, primary_key=True)
+    sensor_id = mapped_column(String(255), primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+    min = mapped_column(Integer, nullable=False)
+    max = mapped_column(Integer, nullable=False)
+    sum = mapped_column(BigInteger, nullable=False)
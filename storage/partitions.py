@@ -0,0 +1,158 @@
+"""Daily range partitions for the event tables, and the retention job that drops them.
+
+On MySQL the event tables can be partitioned by RANGE (TO_DAYS(date_created))
+so that expiring old events is a metadata-only DROP PARTITION instead of a
+DELETE of millions of rows. Each partition is named after the first day it
+holds (p20261018) and a catch-all `pmax` partition takes rows past the last
+one, so inserts never fail when maintenance falls behind.
+
+MySQL requires every unique key of a partitioned table to include the
+partitioning column, so partitioning widens the primary key to
+(id, date_created) and turns the unique trace_id index into a plain one.
+Duplicate events are then caught by the lookup in `app.insert_new` alone.
+
+Other backends are not partitioned; expired events are removed with one
+ranged DELETE on the date_created index instead.
+"""
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import delete, inspect, text
+from models import TemperatureEvent, TemperatureRollup, TrafficEvent, TrafficRollup
+
+EVENT_MODELS = (TemperatureEvent, TrafficEvent)
+ROLLUP_MODELS = (TemperatureRollup, TrafficRollup)
+MAX_PARTITION = "pmax"
+# MySQL TO_DAYS() counts from year 0, Python ordinals from year 1.
+TO_DAYS_OFFSET = 365
+
+
+def utcnow():
+    """date_created is stored as naive UTC."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def partition_name(day):
+    return f"p{day:%Y%m%d}"
+
+
+def partition_definition(day, period_days):
+    upper = day + timedelta(days=period_days)
+    return f"PARTITION {partition_name(day)} VALUES LESS THAN ({upper.toordinal() + TO_DAYS_OFFSET})"
+
+
+def is_mysql(conn):
+    return conn.dialect.name == "mysql"
+
+
+def list_partitions(conn, model):
+    """Return (name, first day, day after the last) for each range partition of a table, oldest first.
+
+    The catch-all partition has no bounds. Unpartitioned tables give [].
+    """
+    if not is_mysql(conn):
+        return []
+    rows = conn.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    ), {"table": model.__tablename__}).all()
+    partitions = []
+    for name, description in rows:
+        if name == MAX_PARTITION:
+            partitions.append((name, None, None))
+        else:
+            start = datetime.strptime(name[1:], "%Y%m%d").date()
+            partitions.append((name, start, date.fromordinal(int(description) - TO_DAYS_OFFSET)))
+    return partitions
+
+
+def enable(conn, model, period_days, ahead):
+    """Partition an existing event table, starting from the day of its oldest row.
+
+    This rebuilds the table, so run it during a quiet period.
+    """
+    table = model.__tablename__
+    if not is_mysql(conn):
+        raise RuntimeError(f"Partitioning needs MySQL, not {conn.dialect.name}")
+    if list_partitions(conn, model):
+        return False
+
+    oldest = conn.execute(text(f"SELECT MIN(date_created) FROM `{table}`")).scalar()
+    day = oldest.date() if oldest else utcnow().date()
+    last = utcnow().date() + timedelta(days=ahead)
+    definitions = []
+    while day <= last:
+        definitions.append(partition_definition(day, period_days))
+        day += timedelta(days=period_days)
+    definitions.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+
+    indexes = {index["name"] for index in inspect(conn).get_indexes(table)}
+    trace_index = f"ix_{table}_trace_id"
+    date_index = f"ix_{table}_date_created"
+    changes = [
+        "DROP PRIMARY KEY, ADD PRIMARY KEY (id, date_created)",
+        f"DROP INDEX `{trace_index}`, ADD INDEX `{trace_index}` (trace_id)",
+    ]
+    if date_index not in indexes:
+        changes.append(f"ADD INDEX `{date_index}` (date_created)")
+    conn.execute(text(f"ALTER TABLE `{table}` {', '.join(changes)}"))
+    conn.execute(text(
+        f"ALTER TABLE `{table}` PARTITION BY RANGE (TO_DAYS(date_created)) ({', '.join(definitions)})"
+    ))
+    return True
+
+
+def add_ahead(conn, model, period_days, ahead):
+    """Split partitions for the coming days off the catch-all partition. Returns their names."""
+    partitions = [p for p in list_partitions(conn, model) if p[0] != MAX_PARTITION]
+    if not partitions:
+        return []
+    day = partitions[-1][2]
+    last = utcnow().date() + timedelta(days=ahead)
+    new = []
+    while day <= last:
+        new.append(day)
+        day += timedelta(days=period_days)
+    if new:
+        definitions = [partition_definition(day, period_days) for day in new]
+        definitions.append(f"PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+        conn.execute(text(
+            f"ALTER TABLE `{model.__tablename__}` REORGANIZE PARTITION {MAX_PARTITION} INTO ({', '.join(definitions)})"
+        ))
+    return [partition_name(day) for day in new]
+
+
+def drop_expired(conn, model, cutoff):
+    """Drop the partitions holding only rows created before `cutoff`. Returns their names."""
+    expired = [name for name, _, end in list_partitions(conn, model) if end is not None and end <= cutoff.date()]
+    if expired:
+        conn.execute(text(f"ALTER TABLE `{model.__tablename__}` DROP PARTITION {', '.join(expired)}"))
+    return expired
+
+
+def maintain(engine, event_days, minute_rollup_days, period_days, ahead):
+    """Create upcoming partitions and expire old events and minute rollups.
+
+    Hourly rollups are kept, so aggregates outlive the raw events they were
+    built from. Returns a summary of what was done per table.
+    """
+    now = utcnow()
+    summary = {}
+    for model in EVENT_MODELS:
+        with engine.begin() as conn:
+            if list_partitions(conn, model):
+                summary[model.__tablename__] = {
+                    "added": add_ahead(conn, model, period_days, ahead),
+                    "dropped": drop_expired(conn, model, now - timedelta(days=event_days)),
+                }
+            else:
+                result = conn.execute(delete(model).where(model.date_created < now - timedelta(days=event_days)))
+                summary[model.__tablename__] = {"deleted": result.rowcount}
+    for model in ROLLUP_MODELS:
+        with engine.begin() as conn:
+            # The primary key starts with (granularity, bucket_start), so this is a range delete.
+            result = conn.execute(delete(model).where(
+                model.granularity == "minute",
+                model.bucket_start < now - timedelta(days=minute_rollup_days)
+            ))
+            summary[model.__tablename__] = {"deleted": result.rowcount}
+    return summary
@@ -0,0 +1,168 @@
+"""Cache of event query responses for time windows that can no longer change.
+
+Events are stamped with date_created when storage commits them, so once a
+window [start, end) ends further back than the time a batch takes to commit,
+no more rows can fall into it. Windows that ended more than `watermark_s`
+seconds ago are closed: their serialized response (one page of them, for a
+given `limit` and `after`) is kept and served without querying the database.
+
+Responses are held in memory up to `max_bytes`, evicting the least recently
+used. With a `directory`, they are also written there, up to
+`disk_max_bytes`, and a response evicted from memory is still found on
+disk; when the directory grows past its budget the least recently used
+files are deleted. Every process of storage keeps its own memory tier; the
+directory can be shared, since a closed window's response is the same
+whoever computes it.
+
+Windows reaching back past `retention_s` are not served from the cache, as
+their oldest rows may have been deleted by the retention job since.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock, get_ident
+
+SUFFIX = ".json"
+
+
+class ResultCache:
+    """LRU of serialized responses by key, in memory and optionally on disk."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, watermark_s=60, retention_s=None, directory=None,
+                 disk_max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.watermark_s = watermark_s
+        self.retention_s = retention_s
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        # Estimate of the directory's size; measured again when it passes the budget
+        self.disk_bytes = 0
+        self.lock = Lock()
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0,
+                      "evictions": 0, "disk_evictions": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = self._measure()
+
+    def closed(self, start, end):
+        """Whether the window [start, end) (naive UTC datetimes) can be cached."""
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if end > now - timedelta(seconds=self.watermark_s):
+            return False
+        return self.retention_s is None or start >= now - timedelta(seconds=self.retention_s)
+
+    def get(self, key):
+        """Return (body, headers, tier) of a cached response, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return (*entry, "memory")
+        entry = self._read(key)
+        with self.lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+            self._remember(key, *entry)
+        return (*entry, "disk")
+
+    def put(self, key, body, headers):
+        with self.lock:
+            self._remember(key, body, headers)
+        self._write(key, body, headers)
+
+    def bypass(self):
+        with self.lock:
+            self.stats["bypassed"] += 1
+
+    def summary(self):
+        with self.lock:
+            return {**self.stats, "entries": len(self.entries), "bytes": self.nbytes, "max_bytes": self.max_bytes,
+                    "disk_bytes": self.disk_bytes if self.directory else None, "watermark_s": self.watermark_s}
+
+    def _remember(self, key, body, headers):
+        if key in self.entries:
+            return
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (body, headers)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + SUFFIX)
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                headers = json.loads(f.readline())
+                body = f.read()
+            # The modification time orders the files for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return body, headers
+
+    def _write(self, key, body, headers):
+        if not self.directory or len(body) > self.disk_max_bytes:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        tmp = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(headers).encode() + b"\n")
+            f.write(body)
+        os.replace(tmp, path)
+        with self.lock:
+            self.disk_bytes += len(body)
+            over = self.disk_bytes > self.disk_max_bytes
+        if over:
+            self._evict_files()
+
+    def _files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _measure(self):
+        return sum(size for _, size, _ in self._files())
+
+    def _evict_files(self):
+        """Delete the least recently used files until the directory is within its budget."""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self.lock:
+            self.disk_bytes = total
+            self.stats["disk_evictions"] += evicted
@@ -0,0 +1,124 @@
+from sqlalchemy import func, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import TemperatureEvent, TemperatureRollup, TrafficEvent, TrafficRollup
+
+GRANULARITIES = ("minute", "hour")
+
+# For each rollup table: the event table it summarizes, the event column that
+# is aggregated, and the event columns that key a bucket besides its start.
+ROLLUPS = {
+    TemperatureRollup: (TemperatureEvent, "temperature", ("sensor_id", "city_zone")),
+    TrafficRollup: (TrafficEvent, "traffic_density", ("sensor_id",)),
+}
+
+
+def bucket_start(value, granularity):
+    """Truncate a datetime to the start of its minute or hour bucket."""
+    if granularity == "minute":
+        return value.replace(second=0, microsecond=0)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def aggregate(model, rows):
+    """Fold event rows (dicts of event columns) into rollup rows for every granularity."""
+    _, value_column, key_columns = ROLLUPS[model]
+    buckets = {}
+    for row in rows:
+        value = row[value_column]
+        keys = tuple(row[column] or "" for column in key_columns)
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(row["date_created"], granularity)) + keys
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, value, value, value]
+            else:
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], value)
+                bucket[2] = max(bucket[2], value)
+                bucket[3] += value
+    return [
+        dict(zip(("granularity", "bucket_start") + key_columns, key),
+             count=count, min=low, max=high, sum=total)
+        for key, (count, low, high, total) in buckets.items()
+    ]
+
+
+def upsert_statement(db, model):
+    """INSERT that merges into an existing bucket instead of failing on its key."""
+    table = model.__table__
+    if db.get_bind().dialect.name == "sqlite":
+        statement = sqlite_insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={
+                "count": table.c.count + statement.excluded["count"],
+                "min": func.min(table.c.min, statement.excluded["min"]),
+                "max": func.max(table.c.max, statement.excluded["max"]),
+                "sum": table.c.sum + statement.excluded["sum"],
+            })
+    statement = mysql_insert(table)
+    return statement.on_duplicate_key_update(
+        count=table.c.count + statement.inserted["count"],
+        min=func.least(table.c.min, statement.inserted["min"]),
+        max=func.greatest(table.c.max, statement.inserted["max"]),
+        sum=table.c.sum + statement.inserted["sum"],
+    )
+
+
+def add(db, model, rows):
+    """Add newly stored event rows to the rollup table, in the caller's transaction."""
+    if rows:
+        db.execute(upsert_statement(db, model), aggregate(model, rows))
+
+
+def rebuild(db, model, chunk_size=10000):
+    """Recompute a rollup table from its event table, reading events in chunks.
+
+    Only buckets from the hour of the oldest stored event on are replaced, so
+    rollups of events already removed by retention are kept. Events are read
+    on a separate connection because a streaming MySQL cursor blocks its
+    connection until it is exhausted. Events stored while this runs may be
+    counted twice, so stop the consumer first.
+    """
+    event_model, value_column, key_columns = ROLLUPS[model]
+    oldest = db.execute(select(func.min(event_model.date_created))).scalar()
+    if oldest is None:
+        return 0
+    db.execute(model.__table__.delete().where(model.bucket_start >= bucket_start(oldest, "hour")))
+    columns = [event_model.date_created, getattr(event_model, value_column)]
+    columns += [getattr(event_model, column) for column in key_columns]
+    total = 0
+    with db.get_bind().connect() as reader:
+        result = reader.execution_options(yield_per=chunk_size).execute(select(*columns))
+        for chunk in result.partitions():
+            add(db, model, [row._asdict() for row in chunk])
+            total += len(chunk)
+    db.commit()
+    return total
+
+
+def query(db, model, granularity, start, end, filters, group_by):
+    """Aggregate the buckets of a rollup table that start within [start, end).
+
+    `filters` maps rollup columns to required values and `group_by` is a list
+    of rollup columns to break the totals down by.
+    """
+    table = model.__table__
+    group_columns = [table.c[column] for column in group_by]
+    statement = select(
+        *group_columns,
+        func.sum(table.c.count).label("count"),
+        func.min(table.c.min).label("min"),
+        func.max(table.c.max).label("max"),
+        func.sum(table.c.sum).label("sum"),
+    ).where(
+        table.c.granularity == granularity,
+        table.c.bucket_start >= bucket_start(start, granularity),
+        table.c.bucket_start < end,
+    )
+    for column, value in filters.items():
+        statement = statement.where(table.c[column] == value)
+    if group_columns:
+        statement = statement.group_by(*group_columns).order_by(*group_columns)
+    return db.execute(statement).all()
@@ -0,0 +1,109 @@
+"""Tests of the storage API against a SQLite database.
+
+Run from the repository root with `python -m pytest storage`.
+"""
+import importlib
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import yaml
+from starlette.testclient import TestClient
+
+STORAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(STORAGE_DIR)
+
+
+@pytest.fixture(scope="module")
+def storage(tmp_path_factory):
+    """The storage app module in the API role, with its database and cache in a temporary directory."""
+    workdir = tmp_path_factory.mktemp("storage")
+    with open(os.path.join(REPO_DIR, "configs", "dev", "storage", "app_conf.yml")) as f:
+        config = yaml.safe_load(f)
+    config["datastore"] = {"url": f"sqlite:///{workdir / 'storage.db'}", "echo": False}
+    config["cache"] = {"directory": str(workdir / "cache"), "watermark_s": 60}
+    with open(workdir / "app_conf.yml", "w") as f:
+        yaml.safe_dump(config, f)
+    (workdir / "logs").mkdir()
+
+    env = {"APP_CONF_FILE": str(workdir / "app_conf.yml"),
+           "LOG_CONF_FILE": os.path.join(REPO_DIR, "configs", "log_conf.yml"),
+           "SERVICE_ROLE": "api"}
+    saved = {name: os.environ.get(name) for name in env}
+    cwd = os.getcwd()
+    os.environ.update(env)
+    os.chdir(workdir)
+    sys.path.insert(0, STORAGE_DIR)
+    try:
+        yield importlib.import_module("app")
+    finally:
+        sys.path.remove(STORAGE_DIR)
+        os.chdir(cwd)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@pytest.fixture(scope="module")
+def client(storage):
+    with TestClient(storage.app) as test_client:
+        yield test_client
+
+
+def windows():
+    """A closed window from yesterday and an open one ending in the future."""
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    return [(now - timedelta(days=1, hours=1), now - timedelta(days=1)),
+            (now - timedelta(hours=1), now + timedelta(hours=1))]
+
+
+@pytest.mark.parametrize("path", ["/storage/temperature/condition", "/storage/traffic/condition"])
+@pytest.mark.parametrize("suffix", ["Z", "+00:00"])
+def test_event_windows_accept_utc_suffixes(client, path, suffix):
+    for start, end in windows():
+        params = {"start_timestamp": start.replace(tzinfo=None).isoformat() + suffix,
+                  "end_timestamp": end.replace(tzinfo=None).isoformat() + suffix}
+        response = client.get(path, params=params)
+        assert response.status_code == 200, response.text
+        assert response.json() == []
+
+
+def export_params(fmt):
+    start, end = windows()[0]
+    return {"start_timestamp": start.isoformat(), "end_timestamp": end.isoformat(), "format": fmt}
+
+
+@pytest.mark.parametrize("fmt", ["arrow", "parquet"])
+def test_export_of_empty_window_is_complete(client, fmt):
+    pa = pytest.importorskip("pyarrow")
+    response = client.get("/storage/temperature/export", params=export_params(fmt))
+    assert response.status_code == 200
+    if fmt == "arrow":
+        table = pa.ipc.open_stream(response.content).read_all()
+    else:
+        table = pytest.importorskip("pyarrow.parquet").read_table(pa.BufferReader(response.content))
+    assert table.num_rows == 0
+
+
+def test_export_failing_at_the_start_is_an_error(client, storage, monkeypatch):
+    def batches(*args):
+        raise RuntimeError("database is gone")
+        yield
+    monkeypatch.setattr(storage.export, "batches", batches)
+    response = client.get("/storage/traffic/export", params=export_params("arrow"))
+    assert response.status_code == 500
+
+
+def test_export_failing_midway_is_cut_short(client, storage, monkeypatch):
+    pa = pytest.importorskip("pyarrow")
+
+    def batches(db, model, start, end, batch_rows):
+        arrow_schema = storage.export.schema(model)
+        yield pa.record_batch([pa.array([], type=field.type) for field in arrow_schema], schema=arrow_schema)
+        raise RuntimeError("connection lost")
+    monkeypatch.setattr(storage.export, "batches", batches)
+    with pytest.raises(RuntimeError):
+        client.get("/storage/traffic/export", params=export_params("parquet"))